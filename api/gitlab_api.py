@@ -25,6 +25,9 @@ from flask import Flask, request, Response
 GITLAB_API = 'https://gitlab.com/api/v4'
 GITHUB_API = 'https://api.github.com'
 
+# (connect, read) seconds, so that a stuck upstream does not hang the service
+HTTP_TIMEOUT = (10, 60)
+
 TARGET_REPO_DIR = '/var/lib/openqa/factory/repo'
 TARGET_ISO_DIR = '/var/lib/openqa/factory/iso'
 STATE_DIR = '/var/lib/openqa/db'
@@ -49,6 +52,15 @@ config_defaults = {
 
 app = Flask(__name__)
 
+class HttpSession(requests.Session):
+    """Pooled connections, with HTTP_TIMEOUT by default"""
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+http_session = HttpSession()
+
 class GithubAppCli:
     def __init__(self, app_id, private_key, installation_id):
         self.app_id = app_id
@@ -71,7 +83,7 @@ class GithubAppCli:
     def gen_token(self):
         bearer_token = self.get_jwt()
         url = f"https://api.github.com/app/installations/{self.installation_id}/access_tokens"
-        r = requests.post(
+        r = http_session.post(
             url,
             headers={
                 "Authorization": "Bearer {}".format(bearer_token),
@@ -98,27 +110,27 @@ class GithubAppCli:
         return self.token
 
     def get_or_create_deployment(self, repo, ref):
-        r = requests.get('/'.join([GITHUB_API, 'repos', repo, 'deployments']),
-                          params={
-                              'ref': ref,
-                              'environment': 'qa',
-                          },
-                          headers={'Authorization': 'token {}'.format(self.get_token())},
-                         )
+        r = http_session.get('/'.join([GITHUB_API, 'repos', repo, 'deployments']),
+                              params={
+                                  'ref': ref,
+                                  'environment': 'qa',
+                              },
+                              headers={'Authorization': 'token {}'.format(self.get_token())},
+                             )
         r.raise_for_status()
         deployments_list = r.json()
         if deployments_list:
             return deployments_list[0]['url']
 
-        r = requests.post('/'.join([GITHUB_API, 'repos', repo, 'deployments']),
-                          json={
-                              'ref': ref,
-                              'auto_merge': False,
-                              'environment': 'qa',
-                              'required_contexts': [],
-                          },
-                          headers={'Authorization': 'token {}'.format(self.get_token())},
-                         )
+        r = http_session.post('/'.join([GITHUB_API, 'repos', repo, 'deployments']),
+                              json={
+                                  'ref': ref,
+                                  'auto_merge': False,
+                                  'environment': 'qa',
+                                  'required_contexts': [],
+                              },
+                              headers={'Authorization': 'token {}'.format(self.get_token())},
+                             )
         r.raise_for_status()
         return r.json()['url']
 
@@ -128,16 +140,16 @@ class GithubAppCli:
             kwargs['log_url'] = url
         if description:
             kwargs['description'] = description
-        r = requests.post('/'.join([deployment_url, 'statuses']),
-                          json={
-                              'state': state,
-                              'environment': 'qa',
-                              **kwargs,
-                          },
-                          headers={
-                              'Authorization': 'token {}'.format(self.get_token()),
-                              'Accept': 'application/vnd.github.ant-man-preview+json',
-                          })
+        r = http_session.post('/'.join([deployment_url, 'statuses']),
+                              json={
+                                  'state': state,
+                                  'environment': 'qa',
+                                  **kwargs,
+                              },
+                              headers={
+                                  'Authorization': 'token {}'.format(self.get_token()),
+                                  'Accept': 'application/vnd.github.ant-man-preview+json',
+                              })
         log(f"deployment {deployment_url} set to {url}")
         r.raise_for_status()
 
@@ -193,7 +205,7 @@ def verify_if_job_allowed():
 
     # validate the token with gitlab, and retrieve job details
 
-    r = requests.get(GITLAB_API + '/job', headers={'JOB-TOKEN': job_token})
+    r = http_session.get(GITLAB_API + '/job', headers={'JOB-TOKEN': job_token})
     r.raise_for_status()
 
     job_details = r.json()
@@ -270,7 +282,7 @@ def get_job_from_pr(pr_details, job_name="publish:repo"):
     """
     found_running = False
 
-    r = requests.get(pr_details['_links']['statuses']['href'])
+    r = http_session.get(pr_details['_links']['statuses']['href'])
     r.raise_for_status()
     for status in r.json():
         if status['context'] != "continuous-integration/pullrequest":
@@ -278,7 +290,7 @@ def get_job_from_pr(pr_details, job_name="publish:repo"):
         repo, _, pipeline = status['target_url'] \
                      .replace('https://gitlab.com/', '') \
                      .partition('/-/pipelines/')
-        r = requests.get(f"{GITLAB_API}/projects/{repo.replace('/', '%2F')}/pipelines/{pipeline}/jobs")
+        r = http_session.get(f"{GITLAB_API}/projects/{repo.replace('/', '%2F')}/pipelines/{pipeline}/jobs")
         r.raise_for_status()
         for job in r.json():
             if job_name not in job['name']:
@@ -316,7 +328,7 @@ def run_test():
 
     # cannot serve repo directly from gitlab, because it refuses connections via Tor :/
     repo_url = req_values['REPO_JOB'] + '/artifacts/raw/repo'
-    with requests.get(req_values['REPO_JOB'] + '/artifacts/download', stream=True) as r:
+    with http_session.get(req_values['REPO_JOB'] + '/artifacts/download', stream=True) as r:
         r.raise_for_status()
         with tempfile.NamedTemporaryFile() as f:
             for chunk in r.iter_content(chunk_size=8192):
@@ -444,7 +456,7 @@ def schedule_pr_build(params, pr_details=None):
             req_params[f"variables[{param}]"] = params[param]
     req_params["token"] = config['gitlab_trigger_token']
     req_params["ref"] = "main"
-    r = requests.post(config['gitlab_trigger_url'],
+    r = http_session.post(config['gitlab_trigger_url'],
         data=req_params)
     r.raise_for_status()
     if pr_details and github_app:
@@ -480,10 +492,10 @@ def run_test_pr(comment_details):
 
     # get PR info
     issue_url = comment_details['issue_url']
-    r = requests.get(issue_url)
+    r = http_session.get(issue_url)
     r.raise_for_status()
     pr_url = r.json()['pull_request']['url']
-    r = requests.get(pr_url)
+    r = http_session.get(pr_url)
     r.raise_for_status()
     pr_details = r.json()
     commit_id = pr_details['head']['sha']
@@ -538,7 +550,7 @@ def run_test_pr(comment_details):
     buildid = time.strftime('%Y%m%d%H%M-') + version
     # cannot serve repo directly from gitlab, because it refuses connections via Tor :/
     repo_url = repo_job + '/artifacts/raw/repo'
-    with requests.get(repo_job + '/artifacts/download', stream=True) as r:
+    with http_session.get(repo_job + '/artifacts/download', stream=True) as r:
         r.raise_for_status()
         with tempfile.NamedTemporaryFile() as f:
             for chunk in r.iter_content(chunk_size=8192):
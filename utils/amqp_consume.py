@@ -9,6 +9,8 @@ import requests
 import subprocess
 import sys
 
+from lib import http_client
+
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DEFAULT_PACKAGE_LIST = os.path.join(SCRIPT_DIR, 'github_package_mapping.json')
 DEFAULT_JOBS_COMPARE_TO = '/var/lib/openqa/db/qubes_base_jobs.json'
@@ -56,7 +58,11 @@ def callback_done(ch, method, properties, body):
     print('received %r, properties %r, body %r' % (
         method.routing_key, properties, body), file=sys.stderr)
     job_data = json.loads(body)
-    r = requests.get('{}/jobs/{}/details'.format(API_BASE, job_data['id']))
+    try:
+        r = http_client.get('{}/jobs/{}/details'.format(API_BASE, job_data['id']))
+    except requests.exceptions.RequestException as e:
+        print('failed to get job {} info: {}'.format(job_data['id'], e), file=sys.stderr)
+        return
     if not r.ok:
         print('failed to get job {} info: {}'.format(job_data['id'], r.text), file=sys.stderr)
         return
@@ -106,7 +112,11 @@ def callback_done(ch, method, properties, body):
 
 def callback_create(ch, method, properties, body):
     job_data = json.loads(body)
-    r = requests.get('{}/jobs/{}'.format(API_BASE, job_data['id']))
+    try:
+        r = http_client.get('{}/jobs/{}'.format(API_BASE, job_data['id']))
+    except requests.exceptions.RequestException as e:
+        print('failed to get job {} info: {}'.format(job_data['id'], e), file=sys.stderr)
+        return
     if not r.ok:
         print('failed to get job {} info: {}'.format(job_data['id'], r.text), file=sys.stderr)
         return
@@ -0,0 +1,546 @@
+#!/usr/bin/python3
+
+# Benchmarks of parsers used on openQA job data, comparing their speed and
+# output with the implementations they replaced. Inputs are real logs,
+# either local files or downloaded from openQA jobs.
+
+from argparse import ArgumentParser
+import json
+import logging
+import math
+import random
+import re
+import sys
+import time
+
+from lib import http_client, flakiness_model, error_signatures
+from lib.junit_parser import DescriptionParser, ParsedDescription, truncate
+from lib.openqa_api import OPENQA_API, OPENQA_URL
+from lib.package_parser import parse_packages, get_title_version
+
+
+def legacy_parse_package_line(line):
+    """Package line parsing of PackageName before lib/package_parser.py"""
+    if line.startswith('ii '):
+        columns = line.split()
+        raw_name = columns[1]
+        raw_version = columns[2]
+        release = None
+        if '-' in raw_version:
+            version = raw_version.split('-', maxsplit=1)[0]
+            release = raw_version.split('-', maxsplit=1)[1].split('+', maxsplit=1)[0]
+        elif '+' in raw_version:
+            version = raw_version.split('+', maxsplit=1)[0]
+        else:
+            version = raw_version
+        return raw_name, version, release
+
+    if ' ' not in line:
+        line_parts = line.split('-')
+        if len(line_parts) < 3:
+            return None
+        return ("-".join(line_parts[:-2]), line_parts[-2],
+                line_parts[-1].split('.', maxsplit=1)[0])
+    return None
+
+
+def legacy_parse_description(description, max_chars=70):
+    """TestFailure.parse_description before lib/junit_parser.py"""
+    result = ParsedDescription()
+
+    def get_relevant_error(max_chars=70):
+        # find relevant line(s)
+        try:
+            i = len(lines) - 1
+            while re.match(r"^\s", lines[i]): # non whitespace-starting
+                i -= 1
+            while not re.match(r"^\s", lines[i]): # until it finds whitespace
+                i -= 1
+
+            relev_line_prev = lines[i].strip()
+            relev_line = lines[i+1].strip()
+
+            # show relevant line (truncated if needed) and the previous one if
+            # there is enough space.
+            if len(relev_line) < max_chars - 30:
+                max_len_prev_line = max_chars -4 -len(relev_line)
+                return "{}... {}".format(
+                    relev_line_prev[:max_len_prev_line],
+                    relev_line)
+            if len(relev_line) <= max_chars:
+                return relev_line
+            else:
+                return relev_line[:max_chars-len("...")] + "..."
+        except IndexError:
+            logging.warning("Failed to extract error from: " + "\n".join(lines))
+            # just get the last line non-empty
+            line = [l for l in lines if l][-1]
+            if len(line) <= max_chars:
+                return line
+            return line[:max_chars-len("...")] + "..."
+
+    description = description.strip()
+
+    if "timed out" in description:
+        result.timed_out = True
+
+    # non-standard error messages / test descriptions
+    if "# system-out:" not in description:
+        if "# wait_serial expected:" in description:
+            result.reason = "wait serial expected"
+        if "# Test died: " in description:
+            result.reason = "test died"
+
+        first_line = description.split("\n")[0]
+        result.relevant_error = first_line.strip()[:max_chars-3] + "..."
+        result.fail_error = description
+        return result
+
+    (result.fail_error, result.cleanup_error)=description.split("# system-out:")
+    lines = result.fail_error.split("\n")
+
+    if "# error:" in lines[1]:
+        result.reason = "error"
+    elif "# failure:" in lines[1]:
+        result.reason = "failure"
+    elif "# skipped:" in lines[1]:
+        result.reason = "skipped"
+        return result
+    else:
+        result.reason = "unknown"
+        return result
+    result.relevant_error = get_relevant_error(max_chars=max_chars)
+    return result
+
+
+def get_job_details(job_id):
+    return http_client.get(
+        "{}/jobs/{}/details".format(OPENQA_API, job_id)).json()
+
+
+def get_job_logs(job_id, suffix):
+    details = get_job_details(job_id)
+    logs = []
+    for log in details['job']['ulogs']:
+        if log.endswith(suffix):
+            logs.append(http_client.get("{}/tests/{}/file/{}".format(
+                OPENQA_URL, job_id, log)).text)
+    return logs
+
+
+def get_corpus(args, suffix):
+    corpus = []
+    for path in args.files:
+        with open(path) as f:
+            corpus.append(f.read())
+    for job_id in args.job:
+        corpus += get_job_logs(job_id, suffix)
+    if not corpus:
+        print("Error: no input, give files or --job", file=sys.stderr)
+        sys.exit(1)
+    return corpus
+
+
+def get_descriptions(job_details):
+    """Descriptions of failed test cases, as given to TestFailure"""
+    descriptions = []
+    for test_group in job_details['job']['testresults']:
+        for test in test_group['details']:
+            if test['result'] == 'fail' and test.get('text_data'):
+                descriptions.append(test['text_data'])
+    return descriptions
+
+
+def get_description_corpus(args):
+    corpus = []
+    for path in args.files:
+        with open(path) as f:
+            corpus += get_descriptions(json.load(f))
+    for job_id in args.job:
+        corpus += get_descriptions(get_job_details(job_id))
+    if not corpus:
+        print("Error: no input, give files or --job", file=sys.stderr)
+        sys.exit(1)
+    return corpus
+
+
+def measure(function, corpus, repeat):
+    """Best time of parsing the whole corpus, out of `repeat` runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            function(text)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_packages(args):
+    corpus = get_corpus(args, "packages.txt")
+    lines = sum(len(text.splitlines()) for text in corpus)
+
+    def legacy(text):
+        return [parsed for parsed in map(legacy_parse_package_line,
+                                         text.split('\n'))
+                if parsed is not None]
+
+    def parse_uncached(text):
+        return parse_packages.__wrapped__(text)
+
+    # the jobs of a build upload the same package lists, each download
+    # being a new string
+    build = [text[:1] + text[1:]
+             for _ in range(args.jobs_per_build) for text in corpus]
+
+    def parse_build(texts):
+        parse_packages.cache_clear()
+        for text in texts:
+            parse_packages(text)
+
+    legacy_time = measure(legacy, corpus, args.repeat)
+    batch_time = measure(parse_uncached, corpus, args.repeat)
+    legacy_build_time = legacy_time * args.jobs_per_build
+    build_time = measure(parse_build, [build], args.repeat)
+
+    print("{} logs, {} lines".format(len(corpus), lines))
+    print("legacy: {:.1f} ms, {:.0f} lines/s".format(
+        legacy_time * 1000, lines / legacy_time))
+    print("batch:  {:.1f} ms, {:.0f} lines/s ({:.1f}x)".format(
+        batch_time * 1000, lines / batch_time, legacy_time / batch_time))
+    print("build of {} jobs with these logs: legacy {:.1f} ms, "
+          "batch {:.1f} ms ({:.1f}x)".format(
+              args.jobs_per_build, legacy_build_time * 1000,
+              build_time * 1000, legacy_build_time / build_time))
+
+    # issue titles keep the legacy versions, except for Debian upstream
+    # versions with a '-', which the legacy parser split at the first one
+    differences = []
+    for text in corpus:
+        legacy_packages = set(legacy(text))
+        batch_packages = {
+            (record.name, *get_title_version(*record.get_manifest_version(),
+                                             record.format))
+            for record in parse_packages(text)}
+        differences += sorted(
+            [("legacy", *package)
+             for package in legacy_packages - batch_packages] +
+            [("batch", *package)
+             for package in batch_packages - legacy_packages],
+            key=lambda difference: (difference[1], difference[0]))
+    print("{} differences".format(len(differences)))
+    for difference in differences[:args.show]:
+        print("  {}: {} {} {}".format(*difference))
+
+
+def benchmark_descriptions(args):
+    corpus = get_description_corpus(args)
+    parser = DescriptionParser()
+
+    # warnings of descriptions the heuristics cannot handle, for each run
+    logging.disable(logging.WARNING)
+    legacy_results = []
+    legacy_failures = 0
+    for description in corpus:
+        try:
+            legacy_results.append(legacy_parse_description(description))
+        except (ValueError, IndexError):
+            # more than one system-out section, or a single line
+            legacy_results.append(None)
+            legacy_failures += 1
+    parseable = [description for description, result
+                 in zip(corpus, legacy_results) if result is not None]
+
+    def legacy(description):
+        return legacy_parse_description(description)
+
+    legacy_time = measure(legacy, parseable, args.repeat)
+    parser_time = measure(parser.parse, parseable, args.repeat)
+
+    print("{} descriptions ({} not handled by the legacy parser)".format(
+        len(corpus), legacy_failures))
+    print("legacy: {:.1f} ms, {:.0f} descriptions/s".format(
+        legacy_time * 1000, len(parseable) / legacy_time))
+    print("parser: {:.1f} ms, {:.0f} descriptions/s ({:.1f}x)".format(
+        parser_time * 1000, len(parseable) / parser_time,
+        legacy_time / parser_time))
+
+    differences = 0
+    for description, legacy_result in zip(corpus, legacy_results):
+        if legacy_result is None:
+            continue
+        result = parser.parse(description)
+        # traceback frames are new
+        result.frames = ()
+        if result != legacy_result:
+            differences += 1
+            if differences <= args.show:
+                print("Difference for:\n{}\n  legacy: {!r}\n  parser: {!r}".format(
+                    description, legacy_result, result))
+    logging.disable(logging.NOTSET)
+    print("{} differences".format(differences))
+    if differences:
+        sys.exit(1)
+
+
+def get_flakiness_corpus(args):
+    """Random failures of args.tests tests over args.jobs jobs
+
+    Most tests never fail, some fail at random (flaky) and a few always do.
+    """
+    generator = random.Random(args.seed)
+    job_ids = list(range(1, args.jobs + 1))
+    failures = []
+    for test in range(args.tests):
+        kind = generator.random()
+        if kind < 0.8:
+            continue
+        rate = 1 if kind > 0.97 else generator.uniform(0.005, 0.3)
+        errors = generator.randint(1, 3)
+        for job_id in job_ids:
+            if generator.random() < rate:
+                failures.append((job_id, "test_{}".format(test),
+                                 "error {}".format(generator.randrange(errors))))
+    return job_ids, failures
+
+
+def scalar_wilson_interval(failures, runs, confidence):
+    """Wilson score interval of a single test, for checking the results"""
+    z = flakiness_model.stats.norm.ppf(0.5 + confidence / 2)
+    rate = failures / runs
+    denominator = 1 + z**2 / runs
+    center = (rate + z**2 / (2 * runs)) / denominator
+    margin = z * math.sqrt(
+        rate * (1 - rate) / runs + z**2 / (4 * runs**2)) / denominator
+    return center - margin, center + margin
+
+
+def benchmark_flakiness(args):
+    if not flakiness_model.available:
+        print("Error: numpy and scipy are required", file=sys.stderr)
+        sys.exit(1)
+    job_ids, failures = get_flakiness_corpus(args)
+
+    def build():
+        return flakiness_model.FailureMatrix(job_ids, failures)
+
+    matrix = build()
+    build_time = measure(lambda _: build(), [None], args.repeat)
+    print("{} jobs, {} tests, {} failures".format(
+        len(job_ids), len(matrix.tests), len(failures)))
+    print("matrix: {:.1f} ms".format(build_time * 1000))
+    for interval in flakiness_model.INTERVALS:
+        estimate_time = measure(
+            lambda _: flakiness_model.estimate(matrix, interval=interval),
+            [None], args.repeat)
+        estimate = flakiness_model.estimate(matrix, interval=interval)
+        print("{}: {:.1f} ms, {} unstable tests".format(
+            interval, estimate_time * 1000, estimate.unstable.sum()))
+
+    # vectorized intervals against a computation per test
+    estimate = flakiness_model.estimate(matrix)
+    differences = 0
+    for column in range(len(matrix.tests)):
+        low, high = scalar_wilson_interval(
+            estimate.failures[column], len(job_ids),
+            flakiness_model.DEFAULT_CONFIDENCE)
+        if not (math.isclose(low, estimate.low[column], abs_tol=1e-9) and
+                math.isclose(high, estimate.high[column], abs_tol=1e-9)):
+            differences += 1
+    print("{} differences".format(differences))
+    if differences:
+        sys.exit(1)
+
+
+# relevant errors, with their parts varying between runs
+ERROR_TEMPLATES = [
+    "AssertionError: vm disp{n} failed at 0x{hex}",
+    "qubes.exc.QubesVMError: Cannot connect to qrexec agent for {n} seconds, "
+    "see /var/log/xen/console/guest-test-inst-vm{n}.log for details",
+    "subprocess.CalledProcessError: Command 'qvm-run -p disp{n} true' "
+    "returned non-zero exit status {small}.",
+    "ConnectionRefusedError: [Errno 111] Connect call failed "
+    "('10.137.{small}.{small}', {port})",
+    "AssertionError: {time} qubesd[{n}]: domain disp{n} failed to start",
+    "dogtail.tree.SearchError: descendent of [file chooser | Open File "
+    "{small}]",
+    "AssertionError: {small} != {small} : wrong number of lines in "
+    "/tmp/test-{hex}",
+    "TimeoutError: pid {n} did not exit within {small} seconds",
+]
+
+
+def get_error_corpus(args):
+    generator = random.Random(args.seed)
+
+    def fields():
+        return {
+            'n': generator.randrange(10000),
+            'small': generator.randrange(100),
+            'hex': "{:08x}".format(generator.getrandbits(32)),
+            'port': generator.randrange(1024, 65536),
+            'time': "{:02}:{:02}:{:02}".format(
+                generator.randrange(24), generator.randrange(60),
+                generator.randrange(60)),
+        }
+
+    errors = []
+    for _ in range(args.errors):
+        template = generator.choice(ERROR_TEMPLATES)
+        # str.format() with a new value for each occurrence of a field
+        error = re.sub(r'{(\w+)}', lambda match: str(fields()[match[1]]),
+                       template)
+        errors.append(truncate(error, 70))
+    return errors
+
+
+def get_exhaustive_clusters(signatures, threshold):
+    """Clusters of signatures, comparing all the pairs"""
+    shingles = [error_signatures.get_shingles(signature)
+                for signature in signatures]
+    clusters = list(range(len(signatures)))
+    for i in range(len(signatures)):
+        for j in range(i):
+            if error_signatures.jaccard(shingles[i], shingles[j]) >= threshold:
+                old, new = max(clusters[i], clusters[j]), \
+                    min(clusters[i], clusters[j])
+                clusters = [new if cluster == old else cluster
+                            for cluster in clusters]
+    return clusters
+
+
+def benchmark_errors(args):
+    errors = get_error_corpus(args)
+    normalize_time = measure(error_signatures.normalize.__wrapped__, errors,
+                             args.repeat)
+    signatures = [error_signatures.normalize(error) for error in errors]
+    cluster_time = measure(error_signatures.ErrorClusters, [signatures],
+                           args.repeat)
+    clusters = error_signatures.ErrorClusters(signatures)
+
+    print("{} errors, {} distinct".format(len(errors), len(set(errors))))
+    print("signatures: {:.1f} ms, {} distinct".format(
+        normalize_time * 1000, len(clusters.signatures)))
+    print("clusters: {:.1f} ms, {} clusters".format(
+        cluster_time * 1000, len(clusters.get_clusters())))
+
+    if len(clusters.signatures) > args.max_exhaustive:
+        print("Not comparing with all the pairs, more than {} "
+              "signatures".format(args.max_exhaustive))
+        return
+    # signatures in the same cluster when comparing all the pairs, but not
+    # with locality-sensitive hashing
+    exhaustive = get_exhaustive_clusters(
+        clusters.signatures, error_signatures.DEFAULT_THRESHOLD)
+    split = 0
+    for signature, cluster in zip(clusters.signatures, exhaustive):
+        if clusters.get(signature) != clusters.get(
+                clusters.signatures[cluster]):
+            split += 1
+    print("{} signatures out of their exhaustive cluster".format(split))
+
+
+def main():
+    parser = ArgumentParser(
+        description="Benchmark parsers of openQA job logs")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    packages_parser = subparsers.add_parser(
+        'packages',
+        help="Parsing of *packages.txt logs (dpkg and rpm package lists)")
+    packages_parser.set_defaults(function=benchmark_packages)
+    packages_parser.add_argument(
+        '--jobs-per-build',
+        type=int,
+        default=20,
+        help="Jobs uploading the same logs, for the time of a whole build. "
+             "Default: 20")
+
+    descriptions_parser = subparsers.add_parser(
+        'descriptions',
+        help="Parsing of failed test case descriptions (JUnit text_data), "
+             "from job details saved as JSON files")
+    descriptions_parser.set_defaults(function=benchmark_descriptions)
+
+    flakiness_parser = subparsers.add_parser(
+        'flakiness',
+        help="Failure rate estimates of lib/flakiness_model.py, over random "
+             "failures")
+    flakiness_parser.set_defaults(function=benchmark_flakiness)
+    flakiness_parser.add_argument(
+        '--jobs',
+        type=int,
+        default=500,
+        help="Number of jobs in the window. Default: 500")
+    flakiness_parser.add_argument(
+        '--tests',
+        type=int,
+        default=2000,
+        help="Number of tests. Default: 2000")
+    flakiness_parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed of the random failures. Default: 0")
+    flakiness_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help="Runs to take the best time of. Default: 5")
+
+    errors_parser = subparsers.add_parser(
+        'errors',
+        help="Error signatures and clusters of lib/error_signatures.py, over "
+             "random errors")
+    errors_parser.set_defaults(function=benchmark_errors)
+    errors_parser.add_argument(
+        '--errors',
+        type=int,
+        default=50000,
+        help="Number of errors. Default: 50000")
+    errors_parser.add_argument(
+        '--max-exhaustive',
+        type=int,
+        default=2000,
+        help="Compare clusters with those of all the pairs of signatures up "
+             "to that many signatures. Default: 2000")
+    errors_parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed of the random errors. Default: 0")
+    errors_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help="Runs to take the best time of. Default: 5")
+
+    for subparser in (packages_parser, descriptions_parser):
+        subparser.add_argument(
+            'files',
+            nargs='*',
+            help="Local copies of logs to parse.")
+        subparser.add_argument(
+            '--job',
+            action='append',
+            type=int,
+            default=[],
+            help="openQA job to download logs from (can be repeated).")
+        subparser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help="Runs to take the best time of. Default: 5")
+        subparser.add_argument(
+            '--show',
+            type=int,
+            default=20,
+            help="Number of output differences to show. Default: 20")
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
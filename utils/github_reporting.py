@@ -1,18 +1,67 @@
 import json
+import logging
+import sys
 
 import requests
 from argparse import ArgumentParser
 import re
 import os
 
-from lib.github_api import setup_github_environ, GitHubIssue, get_labels_from_results
-from lib.openqa_api import setup_openqa_environ, OpenQA
-from lib.instability_analysis import InstabilityAnalysis
+from lib.github_api import (
+    setup_github_environ,
+    GitHubIssue,
+    get_labels_from_results,
+    reconcile_issues,
+    DEFAULT_POST_CONCURRENCY,
+    FAILED,
+)
+from lib.github_client import client as github_client
+from lib.openqa_api import (
+    setup_openqa_environ, get_db_session, OpenQA, DEFAULT_FETCH_CONCURRENCY,
+    STATS_WINDOW, get_failure_keys, has_failure
+)
+from lib.instability_analysis import (
+    InstabilityAnalysis, MODELS, HEURISTIC_MODEL, CACHED_MODEL,
+    STATISTICAL_MODEL, DEFAULT_WINDOWS, ERROR_GROUPINGS, GROUP_BY_ERROR,
+    GROUP_BY_SIGNATURE, GROUP_BY_CLUSTER
+)
+from lib import flakiness_model
+try:
+    from lib import openqa_async
+except ImportError:
+    # aiohttp not available, download with threads
+    openqa_async = None
 from lib.common import ISSUE_TITLE_PREFIX, COMMENT_TITLE
 
 def setup_environ(args):
     setup_github_environ(args.auth_token)
-    setup_openqa_environ(args.package_list, args.db_path, verbose=args.verbose)
+    setup_openqa_environ(args.package_list, args.db_path, verbose=args.verbose,
+                         fetch_concurrency=args.fetch_concurrency,
+                         http_cache_path=args.http_cache_path)
+
+def get_jobs(job_ids, with_logs=False, with_manifests=False):
+    """Jobs with full details
+
+    :param bool with_logs: also download logs looked up for related GitHub
+        issues, of jobs not naming them in their settings
+    :param bool with_manifests: also download package lists of all jobs
+    """
+    if openqa_async is None:
+        return OpenQA.get_jobs(job_ids, full_details=True)
+
+    async def get_jobs_with_logs(openqa):
+        jobs = await openqa.get_jobs(job_ids, full_details=True)
+        if with_manifests:
+            await openqa.prefetch_ulogs(
+                jobs, logs=lambda log: log.endswith("packages.txt"))
+        if with_logs:
+            await openqa.prefetch_ulogs([
+                job for job in jobs
+                if not job.get_notification_issue()
+                and not job.get_pull_requests()])
+        return jobs
+
+    return openqa_async.run(get_jobs_with_logs)
 
 def fill_results_context(results, jobs, reference_jobs=None, instability_analysis=None):
     if reference_jobs:
@@ -23,15 +72,18 @@ def fill_results_context(results, jobs, reference_jobs=None, instability_analysi
         for k in results:
             current_fails = results[k]
             old_fails = reference_job_results.get(k, [])
+            current_keys = get_failure_keys(current_fails)
+            old_keys = get_failure_keys(old_fails)
 
             for fail in old_fails:
-                if fail in current_fails:
+                if has_failure(current_keys, fail):
                     continue
                 fail.fixed = True
                 current_fails.append(fail)
+                current_keys.add(fail.get_key())
 
             for fail in current_fails:
-                if fail not in old_fails:
+                if not has_failure(old_keys, fail):
                     fail.regression = True
 
     if instability_analysis is not None:
@@ -49,6 +101,37 @@ def format_github_link(link):
     return link
 
 
+def format_package_changes(jobs, reference_jobs):
+    changes = OpenQA.diff_manifests(OpenQA.get_build_manifest(reference_jobs),
+                                    OpenQA.get_build_manifest(jobs))
+
+    output_string = "## Package changes\n" \
+                    "Compared to: {}\n".format(
+                        reference_jobs[0].get_build_url())
+    if not changes:
+        output_string += "No changes\n"
+        return output_string
+
+    changes_details = ""
+    last_log = None
+    for log, package, old_versions, new_versions in changes:
+        if log != last_log:
+            changes_details += '* ' + log + "\n"
+            last_log = log
+        if not old_versions:
+            change = "added " + ", ".join(new_versions)
+        elif not new_versions:
+            change = "removed " + ", ".join(old_versions)
+        else:
+            change = "{} -> {}".format(", ".join(old_versions),
+                                       ", ".join(new_versions))
+        changes_details += '  * {}: {}\n'.format(package, change)
+
+    output_string += "<details><summary>{} packages changed</summary>\n\n" \
+                     "{}</details>\n\n".format(len(changes), changes_details)
+    return output_string
+
+
 def format_results(results, jobs, reference_jobs=None, instability_analysis=None, github_links=None):
 
     output_string = "{}\n" \
@@ -325,12 +408,55 @@ def main():
         help="Provide build id to compare results to (looked up in the same version and 'update' flavor)."
     )
 
+    parser.add_argument(
+        '--package-changes',
+        action='store_true',
+        help="Requires --compare-to-build. List packages installed in "
+             "different versions than in the reference build."
+    )
+
     parser.add_argument(
         '--instability',
         action='store_true',
         help="Report on test's instability."
     )
 
+    parser.add_argument(
+        '--instability-model',
+        choices=MODELS,
+        default=HEURISTIC_MODEL,
+        help="Where --instability gets past results from: '{}' looks up "
+             "similar past jobs on openQA, '{}' reads the flakiness "
+             "statistics kept in the local DB by openqa_sync (needs "
+             "--db-path), '{}' estimates failure rates over the jobs in "
+             "the local DB (needs --db-path, numpy and scipy). "
+             "Default: {}".format(
+                 HEURISTIC_MODEL, CACHED_MODEL, STATISTICAL_MODEL,
+                 HEURISTIC_MODEL)
+    )
+
+    parser.add_argument(
+        '--instability-window',
+        type=int,
+        help="Number of past jobs --instability compares each job to "
+             "(up to {} with the cached model). Default: {}".format(
+                 STATS_WINDOW, ", ".join(
+                     "{} for {}".format(window, model)
+                     for model, window in DEFAULT_WINDOWS.items()))
+    )
+
+    parser.add_argument(
+        '--instability-errors',
+        choices=ERROR_GROUPINGS,
+        default=GROUP_BY_SIGNATURE,
+        help="When --instability considers errors of a test the same: '{}' "
+             "when identical, '{}' when identical but for VM names, PIDs, "
+             "addresses, ports and times, '{}' when their signatures are "
+             "similar. Default: {}".format(
+                 GROUP_BY_ERROR, GROUP_BY_SIGNATURE, GROUP_BY_CLUSTER,
+                 GROUP_BY_SIGNATURE)
+    )
+
     parser.add_argument(
         '--verbose',
         action='store_true',
@@ -345,6 +471,30 @@ def main():
             "Stored in memory only if not set. "
     )
 
+    parser.add_argument(
+        '--fetch-concurrency',
+        type=int,
+        default=DEFAULT_FETCH_CONCURRENCY,
+        help="Number of openQA job details downloaded in parallel. "
+             "Default: {}".format(DEFAULT_FETCH_CONCURRENCY)
+    )
+
+    parser.add_argument(
+        '--post-concurrency',
+        type=int,
+        default=DEFAULT_POST_CONCURRENCY,
+        help="Number of pull requests and issues updated in parallel. "
+             "Default: {}".format(DEFAULT_POST_CONCURRENCY)
+    )
+
+    parser.add_argument(
+        '--http-cache-path',
+        default=os.getenv("LOCAL_OPENQA_HTTP_CACHE_PATH"),
+        help="Directory for caching downloaded openQA job details and logs. "\
+            "Can be set via the env variable LOCAL_OPENQA_HTTP_CACHE_PATH. "\
+            "Cached in memory only if not set. "
+    )
+
     args = parser.parse_args()
 
     if (args.build or args.version or args.flavor) and args.job_id:
@@ -356,6 +506,24 @@ def main():
         parser.error("Error: --package-list required.")
         return
 
+    if args.instability_model == STATISTICAL_MODEL and \
+            not flakiness_model.available:
+        parser.error("Error: the {} model requires numpy and scipy".format(
+            STATISTICAL_MODEL))
+        return
+
+    if args.instability_model == CACHED_MODEL and \
+            args.instability_window is not None and \
+            args.instability_window > STATS_WINDOW:
+        parser.error("Error: --instability-window can be at most {} with the "
+                     "{} model".format(STATS_WINDOW, CACHED_MODEL))
+        return
+
+    if args.package_changes and not args.compare_to_build:
+        parser.error("Error: --compare-to-build required to use "
+                     "--package-changes")
+        return
+
     setup_environ(args)
 
     jobs = []
@@ -369,7 +537,8 @@ def main():
             parser.error('No jobs found for build id {}.'.format(args.build))
             return
 
-    jobs = [OpenQA.get_job(job_id) for job_id in jobs]
+    jobs = get_jobs(jobs, with_logs=True,
+                    with_manifests=args.package_changes)
 
     reference_jobs = None
     if args.compare_to_build:
@@ -380,7 +549,8 @@ def main():
         if not reference_jobs:
             parser.error('No reference jobs found for build id {}.'.format(args.compare_to_build))
             return
-        reference_jobs = [OpenQA.get_job(job_id) for job_id in reference_jobs]
+        reference_jobs = get_jobs(reference_jobs,
+                                  with_manifests=args.package_changes)
 
     result = {}
     prs = set()
@@ -392,7 +562,10 @@ def main():
     prs = sorted(prs)
 
     if args.instability:
-        instability_analysis = InstabilityAnalysis(jobs)
+        instability_analysis = InstabilityAnalysis(
+            jobs, model=args.instability_model,
+            window=args.instability_window,
+            group_errors_by=args.instability_errors)
     else:
         instability_analysis = None
 
@@ -400,6 +573,10 @@ def main():
 
     formatted_result = format_results(result, jobs, reference_jobs,
                                       instability_analysis, github_links=prs)
+    if args.package_changes:
+        formatted_result += format_package_changes(jobs, reference_jobs)
+    # keep what was parsed for the report (package lists, performance data)
+    get_db_session().commit()
 
     labels = get_labels_from_results(result)
 
@@ -417,11 +594,17 @@ def main():
         return
 
     issue_title = ISSUE_TITLE_PREFIX + job.get_job_build()
-    for pr in prs:
-        issue = GitHubIssue(pr)
-        issue.post_comment(formatted_result, title=issue_title)
-        if args.enable_labels:
-            issue.add_labels(labels)
+    results = reconcile_issues(
+        [GitHubIssue(pr) for pr in prs], formatted_result,
+        labels=labels if args.enable_labels else None, title=issue_title,
+        workers=args.post_concurrency)
+    for outcome, issues in results.items():
+        if issues:
+            print("{}: {}".format(outcome.capitalize(),
+                                  ", ".join(str(issue) for issue in issues)))
+    logging.info(github_client.get_stats_report())
+    if results[FAILED]:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
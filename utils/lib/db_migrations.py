@@ -0,0 +1,68 @@
+"""Schema versioning of the local openQA cache DB
+
+The schema_version table holds the number of migrations applied to the DB.
+Missing tables are created first with create_all(), then pending migrations
+run in order, each in its own transaction. Migrations must cope with tables
+that create_all() just made in their final shape (see has_column()).
+A new DB already has the current schema and only gets stamped with the
+latest version.
+"""
+import logging
+
+import sqlalchemy
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+def has_column(connection, table_name, column_name):
+    inspector = sqlalchemy.inspect(connection)
+    if not inspector.has_table(table_name):
+        return False
+    return column_name in {
+        column['name'] for column in inspector.get_columns(table_name)}
+
+
+def get_schema_version(connection):
+    if not sqlalchemy.inspect(connection).has_table(SCHEMA_VERSION_TABLE):
+        return None
+    return connection.exec_driver_sql(
+        "SELECT version FROM {}".format(SCHEMA_VERSION_TABLE)).scalar()
+
+
+def set_schema_version(connection, version):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS {} (version INTEGER NOT NULL)".format(
+            SCHEMA_VERSION_TABLE))
+    connection.exec_driver_sql(
+        "DELETE FROM {}".format(SCHEMA_VERSION_TABLE))
+    connection.exec_driver_sql(
+        "INSERT INTO {} (version) VALUES (?)".format(SCHEMA_VERSION_TABLE),
+        (version,))
+
+
+def migrate(db_engine, metadata, migrations):
+    """Brings the DB schema up to date
+
+    :param list migrations: functions taking a connection, in order
+    :return int: number of migrations applied
+    """
+    with db_engine.begin() as connection:
+        version = get_schema_version(connection)
+        if version is None and \
+                not sqlalchemy.inspect(connection).get_table_names():
+            version = len(migrations)
+        metadata.create_all(connection)
+        if version is None:
+            # created before schema versioning
+            version = 0
+        set_schema_version(connection, version)
+
+    for number, migration in enumerate(migrations[version:],
+                                       start=version + 1):
+        logging.info("Migrating local DB to schema version {}: {}".format(
+            number, migration.__doc__.strip().splitlines()[0]))
+        with db_engine.begin() as connection:
+            migration(connection)
+            set_schema_version(connection, number)
+
+    return len(migrations) - version
@@ -0,0 +1,170 @@
+"""Signatures of test errors, and clustering of similar ones
+
+Relevant errors of test failures (see lib/junit_parser.py) often differ
+only by the names of disposable VMs, PIDs, addresses, ports or times, like:
+
+    AssertionError: vm disp1264 failed at 0x162ccc2d
+    AssertionError: vm disp4477 failed at 0x27d34b09
+
+normalize() replaces these parts with placeholders, giving the error
+signature stored with each TestFailure:
+
+    AssertionError: vm disp<n> failed at <hex>
+
+Signatures still differing in other ways (truncated tracebacks, file names,
+messages with numbers) are grouped by ErrorClusters: MinHash sketches of
+their character shingles are bucketed by locality-sensitive hashing, so
+that only signatures sharing a bucket are compared, in near-linear time
+overall. numpy, when available, speeds the sketches up.
+"""
+import functools
+import hashlib
+import random
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (pattern, replacement), applied in order
+NORMALIZATIONS = [
+    # 2024-05-03T12:34:56.789+02:00, 2024-05-03 12:34:56
+    (re.compile(r'\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?'
+                r'(Z|[+-]\d{2}:?\d{2})?'),
+     '<time>'),
+    (re.compile(r'\b\d{1,2}:\d{2}:\d{2}(\.\d+)?\b'), '<time>'),
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'),
+     '<uuid>'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'), '<hex>'),
+    # hashes, object ids
+    (re.compile(r'\b(?=[0-9a-f]*\d)(?=[0-9a-f]*[a-f])[0-9a-f]{8,}\b'),
+     '<hex>'),
+    (re.compile(r'\b\d{1,3}(\.\d{1,3}){3}\b'), '<ip>'),
+    (re.compile(r'(?<=[\w>]):\d{2,5}\b'), ':<port>'),
+    (re.compile(r'\b(port)([ =:]*)\d+\b', re.IGNORECASE), r'\1\2<port>'),
+    (re.compile(r'\b(pid)([ =:]*)\d+\b', re.IGNORECASE), r'\1\2<pid>'),
+    (re.compile(r'\[\d+\]'), '[<pid>]'),
+    # disposable VMs and VMs made by the tests
+    (re.compile(r'\bdisp\d+\b'), 'disp<n>'),
+    (re.compile(r'\b(test-inst-[a-zA-Z]+)[\w-]*'), r'\1<n>'),
+]
+
+# characters per shingle
+SHINGLE_SIZE = 4
+# MinHash sketch size, as BANDS bands of ROWS hashes; signatures with a
+# Jaccard similarity around (1/BANDS)**(1/ROWS) = 0.5 share a bucket about
+# half of the time, above 0.7 almost always
+BANDS = 16
+ROWS = 4
+# minimum Jaccard similarity of the shingles of two signatures in a cluster
+DEFAULT_THRESHOLD = 0.7
+
+# fixed, so that clusters do not change from one run to the next
+MASKS = [random.Random(seed).getrandbits(64) for seed in range(BANDS * ROWS)]
+if numpy is not None:
+    MASK_ARRAY = numpy.array(MASKS, dtype=numpy.uint64)
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize(error):
+    """Signature of a relevant error: the error without the parts that vary
+    from one run to another
+
+    :param str error: relevant error, may be None
+    :return str: signature, None without error
+    """
+    if error is None:
+        return None
+    for pattern, replacement in NORMALIZATIONS:
+        error = pattern.sub(replacement, error)
+    return error
+
+
+def get_shingles(text):
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i+SHINGLE_SIZE]
+            for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def get_minhash(shingles):
+    hashes = [
+        int.from_bytes(
+            hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'big')
+        for shingle in shingles]
+    if numpy is not None:
+        hashes = numpy.array(hashes, dtype=numpy.uint64)
+        return (hashes[:, None] ^ MASK_ARRAY).min(axis=0).tolist()
+    return [min([value ^ mask for value in hashes]) for mask in MASKS]
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+class ErrorClusters:
+    """Clusters of similar error signatures
+
+    Each cluster is named after its most frequent signature.
+    """
+
+    def __init__(self, signatures, threshold=DEFAULT_THRESHOLD):
+        """
+        :param iterable signatures: error signatures, repeated as often as
+            they occur; None are ignored
+        :param float threshold: minimum similarity of signatures clustered
+            together
+        """
+        counts = {}
+        for signature in signatures:
+            if signature is not None:
+                counts[signature] = counts.get(signature, 0) + 1
+        # most frequent first, so that they name their cluster
+        self.signatures = sorted(counts, key=lambda s: (-counts[s], s))
+        shingles = [get_shingles(signature) for signature in self.signatures]
+
+        parents = list(range(len(self.signatures)))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        # (band, hashes of the band) -> signatures, one per cluster seen
+        # in the bucket, so that buckets of similar signatures stay small
+        buckets = {}
+        for i, signature_shingles in enumerate(shingles):
+            minhash = get_minhash(signature_shingles)
+            for band in range(BANDS):
+                key = (band, tuple(minhash[band*ROWS:(band+1)*ROWS]))
+                bucket = buckets.setdefault(key, [])
+                for j in bucket:
+                    root_i, root_j = find(i), find(j)
+                    if root_i == root_j:
+                        break
+                    if jaccard(signature_shingles, shingles[j]) >= threshold:
+                        # the lower index, more frequent, is the root
+                        parents[max(root_i, root_j)] = min(root_i, root_j)
+                        break
+                else:
+                    bucket.append(i)
+
+        self.cluster_of = {
+            signature: self.signatures[find(i)]
+            for i, signature in enumerate(self.signatures)}
+
+    def get(self, signature):
+        """Name of the cluster of a signature given to the constructor"""
+        return self.cluster_of.get(signature, signature)
+
+    def get_clusters(self):
+        """
+        :return dict: cluster name -> signatures in it, most frequent first
+        """
+        clusters = {}
+        for signature in self.signatures:
+            clusters.setdefault(self.get(signature), []).append(signature)
+        return clusters
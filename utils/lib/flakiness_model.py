@@ -0,0 +1,117 @@
+"""Statistical model of test flakiness
+
+Failures of the tests of a test suite over its past jobs are put in a
+sparse matrix of jobs (rows) by tests (columns). The failure rate of every
+test is then estimated at once, with a confidence interval: Wilson score
+interval, or the Beta posterior of a uniform prior. A test is considered
+unstable when it did not fail in every job and its failure rate is, with
+that confidence, at least MIN_FLAKE_RATE. Like in the heuristic of
+lib/instability_analysis.py, a test failing in every job with different
+errors is unstable too.
+
+numpy and scipy are optional dependencies of the scripts, `available` tells
+whether this model can be used.
+"""
+import collections
+
+try:
+    import numpy
+    from scipy import sparse, stats
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+
+DEFAULT_CONFIDENCE = 0.95
+# failure rate from which a test that does not always fail is unstable
+MIN_FLAKE_RATE = 0.05
+
+FlakinessEstimate = collections.namedtuple(
+    'FlakinessEstimate',
+    'tests failures runs probability low high unstable')
+
+
+class FailureMatrix:
+    """Failures of tests in jobs, as a sparse jobs x tests matrix"""
+
+    def __init__(self, job_ids, failures):
+        """
+        :param list job_ids: ids of the jobs (rows)
+        :param iterable failures: (job id, test, relevant error) tuples,
+            with tests identified by any hashable key; failures of other jobs
+            are ignored
+        """
+        self.job_ids = list(job_ids)
+        rows = {job_id: row for row, job_id in enumerate(self.job_ids)}
+        columns = {}
+        errors = []
+        row_indices = []
+        column_indices = []
+        for job_id, test, relevant_error in failures:
+            row = rows.get(job_id)
+            if row is None:
+                continue
+            column = columns.setdefault(test, len(columns))
+            if column == len(errors):
+                errors.append(set())
+            errors[column].add(relevant_error)
+            row_indices.append(row)
+            column_indices.append(column)
+
+        self.tests = list(columns)
+        self.matrix = sparse.csr_matrix(
+            (numpy.ones(len(row_indices), dtype=numpy.int32),
+             (row_indices, column_indices)),
+            shape=(len(self.job_ids), len(self.tests)))
+        # a test fails at most once per job
+        self.matrix.data[:] = 1
+        self.distinct_errors = numpy.array(
+            [len(test_errors) for test_errors in errors], dtype=numpy.int32)
+
+
+def wilson_interval(failures, runs, confidence):
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    rate = failures / runs
+    denominator = 1 + z**2 / runs
+    center = (rate + z**2 / (2 * runs)) / denominator
+    margin = z * numpy.sqrt(
+        rate * (1 - rate) / runs + z**2 / (4 * runs**2)) / denominator
+    return center - margin, center + margin
+
+
+def beta_interval(failures, runs, confidence):
+    tail = (1 - confidence) / 2
+    alpha = failures + 1
+    beta = runs - failures + 1
+    return (stats.beta.ppf(tail, alpha, beta),
+            stats.beta.ppf(1 - tail, alpha, beta))
+
+
+INTERVALS = {
+    'wilson': wilson_interval,
+    'beta': beta_interval,
+}
+
+
+def estimate(failure_matrix, confidence=DEFAULT_CONFIDENCE,
+             interval='wilson', min_flake_rate=MIN_FLAKE_RATE):
+    """Estimates the failure rate of all the tests of a FailureMatrix
+
+    :param str interval: confidence interval, one of INTERVALS
+    :return FlakinessEstimate: numpy arrays, in the order of
+        failure_matrix.tests; probability is the posterior mean failure rate
+    """
+    runs = len(failure_matrix.job_ids)
+    failures = numpy.asarray(
+        failure_matrix.matrix.sum(axis=0), dtype=numpy.float64).ravel()
+    if runs == 0:
+        empty = numpy.zeros(0)
+        return FlakinessEstimate(failure_matrix.tests, empty, runs, empty,
+                                 empty, empty, empty.astype(bool))
+
+    probability = (failures + 1) / (runs + 2)
+    low, high = INTERVALS[interval](failures, runs, confidence)
+    unstable = ((failures < runs) & (low >= min_flake_rate)) | \
+        ((failures == runs) & (failure_matrix.distinct_errors > 1))
+    return FlakinessEstimate(failure_matrix.tests, failures, runs,
+                             probability, low, high, unstable)
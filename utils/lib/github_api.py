@@ -1,22 +1,60 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import os
 import re
+import urllib.parse
+
+import requests
 
 from lib.common import *
+from lib.github_client import client
 
 GITHUB_API_PREFIX = "https://api.github.com/repos"
+# issues updated in parallel
+DEFAULT_POST_CONCURRENCY = 4
+
+# outcomes of GitHubIssue.reconcile()
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+FAILED = 'failed'
+
+# issues looked up by each GraphQL query
+GRAPHQL_BATCH_SIZE = 25
+# comments and labels looked up per issue, issues with more are looked up
+# with REST
+GRAPHQL_PAGE_SIZE = 100
+
+ISSUE_STATE_FIELDS = """
+    labels(first: {size}) {{ nodes {{ name }} pageInfo {{ hasNextPage }} }}
+    comments(first: {size}) {{
+        nodes {{ databaseId body }}
+        pageInfo {{ hasNextPage }}
+    }}
+""".format(size=GRAPHQL_PAGE_SIZE)
 
 github_auth = {}
 
+
+class GitHubError(Exception):
+    pass
+
+
 class GitHubRepo:
-    def __init__(self, repo_name, owner="QubesOS"):
+    def __init__(self, repo_name, owner="QubesOS", issue_mirror=None):
+        """
+        :param issue_mirror: local copy of the issues of the repo, looked up
+            instead of listing them (see openqa_api.IssueMirror)
+        """
         self.data = []
         self.owner = owner
         self.repo = repo_name
         self.repo_url = "{}/{}/{}".format(GITHUB_BASE_PREFIX, owner, self.repo)
         self.url = "{}/{}/{}/". format(GITHUB_API_PREFIX, owner, self.repo)
+        self.issue_mirror = issue_mirror
 
     def get_issues_by_name(self, name):
+        if self.issue_mirror is not None:
+            return self.issue_mirror.get_issue_url(name)
 
         for json_data in self.data:
             for issue in json_data:
@@ -26,24 +64,50 @@ class GitHubRepo:
         if self.data:
             return None
 
-        url = self.url + 'issues'
-        while url:
-            data = requests.get(url, headers=github_auth)
-            json_data = data.json()
+        for json_data in client.get_pages(self.url + 'issues',
+                                          headers=github_auth):
             self.data.append(json_data)
 
             for issue in json_data:
                 if issue['title'] == name:
                     return issue['html_url']
 
-            if 'next' in data.links.keys():
-                url = data.links['next']['url']
-            else:
-                url = None
+    def list_issues(self, params, etag=None):
+        """Issues (and pull requests) of the repo, all the pages of a listing
+
+        :param dict params: query parameters of the listing
+        :param str etag: ETag of an earlier identical listing, to get nothing
+            back (and not use up the rate limit) if it did not change
+        :return tuple: list of issues, None if unchanged, and ETag of the
+            listing
+        """
+        url = self.url + 'issues?' + urllib.parse.urlencode(params)
+        headers = dict(github_auth)
+        if etag:
+            headers['If-None-Match'] = etag
+        response = client.request('GET', url, headers=headers)
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+
+        issues = []
+        while True:
+            issues += response.json()
+            if 'next' not in response.links:
+                return issues, etag
+            response = client.request('GET', response.links['next']['url'],
+                                      headers=github_auth)
+            response.raise_for_status()
 
 class GitHubIssue:
     def __init__(self, url):
         self.existing_comment_no = None
+        self.existing_comment_body = None
+        # whether existing_comment_no was looked up, even if None
+        self.comments_checked = False
+        # names of the labels, if looked up by fetch_issue_states()
+        self.labels = None
         self.post_as_issue = False
         self.url, self.owner, self.repo, self.issue_no = self.parse_url(url)
         if self.issue_no == 'create-or-update':
@@ -51,27 +115,39 @@ class GitHubIssue:
             self.issue_no = None
 
     def existing_comment(self):
-        if self.existing_comment_no:
+        if self.existing_comment_no or self.comments_checked:
             return self.existing_comment_no
 
         comments_url = self.url + '{}/comments'.format(self.issue_no)
-        while comments_url:
-            comments_data = requests.get(comments_url, headers=github_auth)
-            comments_json = comments_data.json()
-
+        # a page missing could hide the comment, and lead to posting another
+        for comments_json in client.get_pages(comments_url,
+                                              headers=github_auth,
+                                              strict=True):
             for comment in comments_json:
                 comment_title = comment['body'][:len(COMMENT_TITLE)]
                 if comment_title == COMMENT_TITLE:
                     self.existing_comment_no = comment['id']
+                    self.existing_comment_body = comment['body']
                     return self.existing_comment_no
 
-            if 'next' in comments_data.links.keys():
-                comments_url = comments_data.links['next']['url']
-            else:
-                comments_url = None
-
         return None
 
+    def set_state(self, node):
+        """Takes the summary comment and the labels from the GraphQL node
+        of the issue, see fetch_issue_states()"""
+        comments = node['comments']
+        for comment in comments['nodes']:
+            if comment['body'][:len(COMMENT_TITLE)] == COMMENT_TITLE:
+                self.existing_comment_no = comment['databaseId']
+                self.existing_comment_body = comment['body']
+                break
+        else:
+            # otherwise, it may be on the following pages
+            self.comments_checked = not comments['pageInfo']['hasNextPage']
+        labels = node['labels']
+        if not labels['pageInfo']['hasNextPage']:
+            self.labels = [label['name'] for label in labels['nodes']]
+
     def existing_issue(self, title):
         if self.issue_no is not None:
             return self.issue_no
@@ -102,68 +178,216 @@ class GitHubIssue:
 
         return parsed_url, owner, repo, no
 
-    def post_comment(self, message_text, title=None):
-        if self.post_as_issue and not title:
-            print('Posting as an issue requested, but no issue title given')
-            return
+    def __str__(self):
+        if self.issue_no is None:
+            return "{}/{} (new issue)".format(self.owner, self.repo)
+        return "{}/{}#{}".format(self.owner, self.repo, self.issue_no)
+
+    def get_labels(self):
+        """Names of the labels of the issue, all of them"""
+        if self.labels is None:
+            url = self.url + "{}/labels".format(self.issue_no)
+            self.labels = [
+                label['name']
+                for labels in client.get_pages(url, headers=github_auth,
+                                               strict=True)
+                for label in labels]
+        return self.labels
+
+    def reconcile_comment(self, message_text, title=None, labels=()):
+        """Posts the message as the summary comment (or as the issue, when
+        posting as an issue), unless it is there already
+
+        :param list labels: labels of the issue, if created
+        :return bool: whether anything was written
+        """
         if self.post_as_issue:
+            if not title:
+                raise GitHubError("Posting as an issue requested, but no "
+                                  "issue title given")
             if self.existing_issue(title):
-                api_method = requests.patch
                 url = self.url + self.issue_no
+                response = client.get(url, headers=github_auth)
+                if not response.ok:
+                    raise GitHubError("Error {}: {}".format(
+                        response.status_code, response.content))
+                issue = response.json()
+                if self.labels is None:
+                    self.labels = [label['name'] for label in issue['labels']]
+                if issue['title'] == title and issue['body'] == message_text:
+                    return False
+                response = client.patch(url,
+                                        json={'title': title,
+                                              'body': message_text},
+                                        headers=github_auth)
             else:
-                api_method = requests.post
-                url = self.url[:-1]
-
-            response = api_method(url,
-                                  json={'title': title,
-                                        'body': message_text},
-                                  headers=github_auth)
+                # labelled at once
+                response = client.post(self.url[:-1],
+                                       json={'title': title,
+                                             'body': message_text,
+                                             'labels': list(labels)},
+                                       headers=github_auth)
+                if response.ok:
+                    self.issue_no = str(response.json()['number'])
+                    self.labels = list(labels)
         else:
             if self.existing_comment():
+                if self.existing_comment_body == message_text:
+                    return False
                 url = self.url + 'comments/' + str(self.existing_comment())
-                api_method = requests.patch
+                api_method = client.patch
             else:
                 url = self.url + '{}/comments'.format(self.issue_no)
-                api_method = requests.post
+                api_method = client.post
 
             response = api_method(url,
                                   json={'body': message_text},
                                   headers=github_auth)
 
         if not response.ok:
-            print("FAILED TO COMMENT. Error {}: {}".format(
+            raise GitHubError("Failed to comment, error {}: {}".format(
                 response.status_code, response.content))
+        return True
 
+    def reconcile_labels(self, labels):
+        """Adds the labels, and removes the opposite ones (openqa-ok or
+        openqa-failed), in at most one request
 
-    def add_labels(self, labels):
-        # labels should be provided as a list of strings
-
-        # check existing labels
-        url = self.url + "{}/labels".format(self.issue_no)
-        labels_to_remove = []
-
-        if LABEL_OK in labels:
-            labels_to_remove.append(LABEL_FAILED)
-        if LABEL_FAILED in labels:
-            labels_to_remove.append(LABEL_OK)
-
-        result = requests.get(url, headers=github_auth).json()
-        for label in result:
-            if label['name'] in labels_to_remove:
-                url_remove = url + "/" + label['name']
-                requests.delete(url_remove, headers=github_auth)
-            if label['name'] in labels:
-                labels.remove(label['name'])
-
-        if not labels:
-            return
+        :param list labels: names of the labels
+        :return bool: whether anything was written
+        """
+        existing_labels = set(self.get_labels())
+        wanted_labels = get_wanted_labels(existing_labels, labels)
+        if wanted_labels == existing_labels:
+            return False
 
         url = self.url + "{}/labels".format(self.issue_no)
-        result = \
-            requests.post(url, json={'labels': labels}, headers=github_auth)
-
-        if not result.ok:
-            print("Warning: failed to add labels to issue.")
+        if wanted_labels > existing_labels:
+            # leaves labels added meanwhile alone
+            response = client.post(
+                url, json={'labels': sorted(wanted_labels - existing_labels)},
+                headers=github_auth)
+        else:
+            # replaces all the labels
+            response = client.put(
+                url, json={'labels': sorted(wanted_labels)},
+                headers=github_auth)
+        if not response.ok:
+            raise GitHubError("Failed to label, error {}: {}".format(
+                response.status_code, response.content))
+        self.labels = sorted(wanted_labels)
+        return True
+
+    def reconcile(self, message_text, labels=None, title=None):
+        """Brings the summary comment and the labels up to date
+
+        :param list labels: labels to set, None to leave them alone
+        :return str: UNCHANGED or UPDATED
+        """
+        updated = self.reconcile_comment(message_text, title=title,
+                                         labels=labels or ())
+        if labels is not None:
+            updated = self.reconcile_labels(labels) or updated
+        return UPDATED if updated else UNCHANGED
+
+def get_wanted_labels(existing_labels, labels):
+    """
+    :param set existing_labels: names of the labels an issue has
+    :param list labels: labels to add, the opposite ones are removed
+    :return set: labels the issue should have
+    """
+    labels_to_remove = set()
+    if LABEL_OK in labels:
+        labels_to_remove.add(LABEL_FAILED)
+    if LABEL_FAILED in labels:
+        labels_to_remove.add(LABEL_OK)
+    return (existing_labels - labels_to_remove) | set(labels)
+
+def fetch_issue_states(issues):
+    """Looks the summary comments and the labels of issues up with GraphQL,
+    GRAPHQL_BATCH_SIZE issues per query, instead of a few REST requests per
+    issue
+
+    Issues that could not be looked up this way (no GitHub token, errors,
+    more than GRAPHQL_PAGE_SIZE comments or labels) are looked up with REST
+    when posting.
+
+    :param list issues: GitHubIssue objects
+    """
+    if 'Authorization' not in github_auth:
+        # GraphQL needs a token
+        return
+    issues = [issue for issue in issues if issue.issue_no is not None]
+    for start in range(0, len(issues), GRAPHQL_BATCH_SIZE):
+        batch = issues[start:start + GRAPHQL_BATCH_SIZE]
+        parameters = []
+        fields = []
+        variables = {}
+        for i, issue in enumerate(batch):
+            parameters.append("$owner{0}: String!, $repo{0}: String!, "
+                              "$number{0}: Int!".format(i))
+            fields.append(
+                "issue{0}: repository(owner: $owner{0}, name: $repo{0}) {{\n"
+                "  issueOrPullRequest(number: $number{0}) {{\n"
+                "    ... on Issue {{ {1} }}\n"
+                "    ... on PullRequest {{ {1} }}\n"
+                "  }}\n"
+                "}}".format(i, ISSUE_STATE_FIELDS))
+            variables['owner{}'.format(i)] = issue.owner
+            variables['repo{}'.format(i)] = issue.repo
+            variables['number{}'.format(i)] = int(issue.issue_no)
+        query = "query({}) {{\n{}\n}}".format(
+            ", ".join(parameters), "\n".join(fields))
+
+        response = client.graphql(query, variables, headers=github_auth)
+        if not response.ok:
+            logging.warning("GraphQL lookup of issues failed, error {}: "
+                            "{}".format(response.status_code,
+                                        response.content))
+            continue
+        result = response.json()
+        for error in result.get('errors') or []:
+            logging.warning("GraphQL lookup of issues: {}".format(
+                error.get('message')))
+        data = result.get('data') or {}
+        for i, issue in enumerate(batch):
+            repository = data.get('issue{}'.format(i)) or {}
+            node = repository.get('issueOrPullRequest')
+            if node:
+                issue.set_state(node)
+
+def reconcile_issues(issues, message_text, labels=None, title=None,
+                     workers=DEFAULT_POST_CONCURRENCY):
+    """Brings the summary comments and labels of issues up to date, up to
+    `workers` issues at once
+
+    Only what differs is written. Requests go through lib/github_client.py,
+    which keeps writes apart and pauses all the workers on rate limits.
+
+    :param list issues: GitHubIssue objects
+    :param list labels: labels to set, None to leave them alone
+    :return dict: outcome (UNCHANGED, UPDATED, FAILED) -> issues
+    """
+    fetch_issue_states(issues)
+
+    def reconcile(issue):
+        try:
+            return issue.reconcile(message_text, labels=labels, title=title)
+        except (GitHubError, requests.RequestException) as e:
+            logging.warning("Failed to update {}: {}".format(issue, e))
+            return FAILED
+
+    if workers <= 1 or len(issues) <= 1:
+        outcomes = [reconcile(issue) for issue in issues]
+    else:
+        with ThreadPoolExecutor(
+                max_workers=min(workers, len(issues))) as executor:
+            outcomes = list(executor.map(reconcile, issues))
+
+    results = {UNCHANGED: [], UPDATED: [], FAILED: []}
+    for issue, outcome in zip(issues, outcomes):
+        results[outcome].append(issue)
+    return results
 
 def get_labels_from_results(results, only_regressions=True, ignore_unstable=True):
     failures = [fail for fails in results.values() for fail in fails
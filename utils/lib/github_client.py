@@ -0,0 +1,253 @@
+"""GitHub API requests within the rate limit
+
+GitHub allows a budget of requests per hour (X-RateLimit-* headers of every
+response), and answers too many requests in a short time with 403 or 429
+and a Retry-After header (secondary rate limits). GitHubClient goes through
+lib/http_client.py and:
+
+- tracks the remaining budget, and spaces requests out once it runs low,
+  waiting for its reset when it is almost exhausted
+- waits as asked by Retry-After (or until the reset) before retrying a
+  rate-limited request, unless that is more than max_wait; requests of
+  other threads wait as well
+- spaces requests changing data out by MUTATION_INTERVAL, as GitHub
+  recommends
+- makes GETs conditional on the ETag of the copy kept by lib/http_cache.py:
+  unchanged resources come back as 304, which does not use the budget
+- counts requests made, requests saved (304) and time spent throttled
+
+GraphQL queries (see graphql()) are budgeted apart from REST requests, as
+GitHub does.
+"""
+import collections
+import logging
+import threading
+import time
+import urllib.parse
+
+from lib import http_client, http_cache
+
+# requests kept in reserve, waited for when reached
+DEFAULT_RESERVE = 50
+# fraction of the budget below which requests are spaced out over the time
+# left until the reset
+SLOW_DOWN_FRACTION = 0.1
+# longest wait (seconds) for the budget or a Retry-After, longer waits give
+# the rate-limited response to the caller instead
+DEFAULT_MAX_WAIT = 900
+# wait (seconds) for a secondary rate limit without Retry-After, doubled at
+# each retry
+SECONDARY_LIMIT_WAIT = 60
+RATE_LIMIT_RETRIES = 3
+# seconds between POST, PATCH, PUT and DELETE requests
+MUTATION_INTERVAL = 1
+MUTATING_METHODS = ('POST', 'PATCH', 'PUT', 'DELETE')
+# items per page of listings
+PER_PAGE = 100
+GRAPHQL_URL = "https://api.github.com/graphql"
+CORE = 'core'
+GRAPHQL = 'graphql'
+
+
+class RateLimitBudget:
+    """Rate limit state, as last reported by GitHub"""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        # epoch time
+        self.reset = None
+
+    def update(self, headers):
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = float(headers['X-RateLimit-Reset'])
+            limit = int(headers.get('X-RateLimit-Limit', 0)) or None
+        except (KeyError, ValueError):
+            return
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def get_delay(self, reserve, now):
+        """Seconds to wait before the next request"""
+        if self.remaining is None or self.reset is None:
+            return 0
+        until_reset = max(self.reset - now, 0)
+        if until_reset == 0:
+            return 0
+        if self.remaining <= reserve:
+            return until_reset
+        if self.limit and self.remaining < self.limit * SLOW_DOWN_FRACTION:
+            return until_reset / (self.remaining - reserve)
+        return 0
+
+
+class GitHubClient:
+    def __init__(self, reserve=DEFAULT_RESERVE, max_wait=DEFAULT_MAX_WAIT):
+        self.reserve = reserve
+        self.max_wait = max_wait
+        # resource (CORE, GRAPHQL) -> RateLimitBudget
+        self.budgets = collections.defaultdict(RateLimitBudget)
+        self.last_mutation = None
+        # time.monotonic() until which a rate limit holds requests back
+        self.blocked_until = 0
+        # requests: sent, not_modified: answered with 304, rate_limited:
+        # responses asking to wait, throttled_seconds: time waited
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def wait(self, delay, reason):
+        logging.info("Waiting {:.1f}s before the next GitHub request: "
+                     "{}".format(delay, reason))
+        with self.lock:
+            self.stats['throttled_seconds'] += delay
+        time.sleep(delay)
+
+    def throttle(self, resource, mutating):
+        budget = self.budgets[resource]
+        with self.lock:
+            delay = budget.get_delay(self.reserve, time.time())
+            if delay > self.max_wait:
+                # better fail on the rate limit than hang
+                delay = 0
+            reason = "{} {} requests left".format(budget.remaining, resource)
+            if self.blocked_until - time.monotonic() > delay:
+                delay = self.blocked_until - time.monotonic()
+                reason = "rate limit hit"
+            if mutating:
+                if self.last_mutation is not None:
+                    delay = max(delay, MUTATION_INTERVAL -
+                                (time.monotonic() - self.last_mutation))
+                self.last_mutation = time.monotonic() + max(delay, 0)
+        if delay > 0:
+            self.wait(delay, reason)
+
+    def get_retry_delay(self, response, attempt):
+        """Seconds to wait before retrying a request, None if it was not
+        rate-limited"""
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return max(float(response.headers.get(
+                'X-RateLimit-Reset', time.time())) - time.time(), 0) + 1
+        if response.status_code == 429 or \
+                'secondary rate limit' in response.text:
+            return SECONDARY_LIMIT_WAIT * 2 ** attempt
+        # not about the rate limit (permissions, ...)
+        return None
+
+    def request(self, method, url, mutating=None, **kwargs):
+        """
+        :param bool mutating: whether the request changes data, by default
+            if its method is one of MUTATING_METHODS
+        """
+        method = method.upper()
+        if mutating is None:
+            mutating = method in MUTATING_METHODS
+        resource = GRAPHQL if url == GRAPHQL_URL else CORE
+        attempt = 0
+        while True:
+            self.throttle(resource, mutating)
+            response = http_client.request(method, url, **kwargs)
+            with self.lock:
+                self.stats['requests'] += 1
+                if response.status_code == 304:
+                    self.stats['not_modified'] += 1
+                self.budgets[resource].update(response.headers)
+
+            delay = self.get_retry_delay(response, attempt)
+            if delay is None:
+                return response
+            with self.lock:
+                self.stats['rate_limited'] += 1
+            if attempt >= RATE_LIMIT_RETRIES or delay > self.max_wait:
+                logging.warning("GitHub rate limit hit for {} {}, not "
+                                "retrying".format(method, url))
+                return response
+            attempt += 1
+            response.close()
+            with self.lock:
+                # waited for by throttle(), in all the threads
+                self.blocked_until = max(self.blocked_until,
+                                         time.monotonic() + delay)
+
+    def get(self, url, headers=None):
+        """GET, conditional on the ETag of the copy in lib/http_cache.py
+
+        :return: http_cache.CachedResponse, or the requests.Response of a
+            failure
+        """
+        cache = http_cache.response_cache
+        entry = cache.lookup(url)
+        headers = dict(headers or {})
+        headers.update(cache.validation_headers(entry))
+        response = self.request('GET', url, headers=headers)
+        if response.status_code != 304 and not response.ok:
+            return response
+        return cache.update(
+            url, entry, response.status_code, response.content,
+            response.encoding or response.apparent_encoding,
+            response.headers)
+
+    def get_pages(self, url, headers=None, strict=False):
+        """Items of a listing, page after page (numbered pages, so that each
+        one is cached on its own)
+
+        :param bool strict: raise requests.HTTPError on a failure, instead
+            of stopping there
+        :return generator: lists of items, until a failure or the last page
+        """
+        separator = '&' if urllib.parse.urlsplit(url).query else '?'
+        page = 1
+        while True:
+            response = self.get("{}{}per_page={}&page={}".format(
+                url, separator, PER_PAGE, page), headers=headers)
+            if not response.ok:
+                if strict:
+                    response.raise_for_status()
+                return
+            items = response.json()
+            yield items
+            if len(items) < PER_PAGE:
+                return
+            page += 1
+
+    def graphql(self, query, variables=None, headers=None):
+        """Runs a GraphQL query (not a mutation)
+
+        :return requests.Response: response, with the data and errors as
+            JSON
+        """
+        return self.request(
+            'POST', GRAPHQL_URL, mutating=False, headers=headers,
+            json={'query': query, 'variables': variables or {}})
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def get_stats_report(self):
+        return "GitHub: {} requests, {} answered unchanged (304), {} " \
+            "rate-limited, {:.1f}s throttled, {} left".format(
+                self.stats['requests'], self.stats['not_modified'],
+                self.stats['rate_limited'], self.stats['throttled_seconds'],
+                "?" if self.budgets[CORE].remaining is None
+                else self.budgets[CORE].remaining)
+
+
+client = GitHubClient()
@@ -0,0 +1,324 @@
+"""Columnar export of the local openQA cache
+
+Jobs, test failures, performance results and package manifests are written
+to a directory, one dataset per table:
+
+    <directory>/export_state.json
+    <directory>/jobs/<low job id>-<high job id>.arrow
+    <directory>/test_failures/<low job id>-<high job id>.arrow
+    ...
+
+Each export appends one file per table, covering a range of job ids above
+the ones already exported, so that files never have to be rewritten. Rows
+added to the cache below that range later (history fetched by reports or
+openqa_investigator.py, results parsed after their job was exported) are
+appended by export_backfill(), to files named
+<low job id>-<high job id>-backfill<n>. The
+files are Arrow IPC files (memory-mapped when read) or Parquet files
+(smaller), both read as a single pyarrow dataset per table:
+
+    from lib import history_export
+    failures = history_export.open_table(directory, "test_failures")
+    df = failures.to_table(filter=...).to_pandas()
+
+Full error texts and job details are not exported.
+
+pyarrow is an optional dependency of the scripts, `available` tells whether
+the export can be used.
+"""
+import collections
+import enum
+import json
+import os
+
+import sqlalchemy
+from sqlalchemy import select
+
+from lib.openqa_api import (
+    JobData,
+    ChildJob,
+    TestFailure,
+    PerformanceResult,
+    PackageManifestEntry,
+)
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.fs
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+available = pyarrow is not None
+
+STATE_FILE = "export_state.json"
+ARROW = "arrow"
+PARQUET = "parquet"
+FORMATS = (ARROW, PARQUET)
+# rows read from the DB and written at once
+ROWS_PER_BATCH = 50000
+# job ids per query of backfilled jobs, below the SQLite variable limit
+JOB_IDS_PER_QUERY = 500
+
+job = JobData.__table__.c
+child_job = ChildJob.__table__.c
+test_failure = TestFailure.__table__.c
+performance_result = PerformanceResult.__table__.c
+package_manifest_entry = PackageManifestEntry.__table__.c
+
+# exported table -> columns, the job id first
+TABLES = {
+    "jobs": [
+        job.job_id, job.job_name, job.job_type, job.valid, job.machine,
+        job.worker, job.version, job.flavor, job.result, job.build,
+        job.clone_id, job.t_started, child_job.parent_job_id,
+    ],
+    "test_failures": [
+        test_failure.job_id, test_failure.name, test_failure.title,
+        test_failure.test_id, test_failure.fail_reason,
+        test_failure.relevant_error, test_failure.error_signature,
+        test_failure.has_cleanup_error, test_failure.timed_out,
+        test_failure.has_description, test_failure.template,
+    ],
+    "performance_results": [
+        performance_result.job_id, performance_result.name,
+        performance_result.position, performance_result.value,
+    ],
+    "package_manifest": [
+        package_manifest_entry.job_id, package_manifest_entry.log,
+        package_manifest_entry.raw_name, package_manifest_entry.version,
+        package_manifest_entry.release,
+        # null in files exported before it was
+        package_manifest_entry.package_format,
+    ],
+}
+
+ExportState = collections.namedtuple('ExportState', 'file_format high_job_id')
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_arrow_type(column):
+    if isinstance(column.type, sqlalchemy.Boolean):
+        return pyarrow.bool_()
+    if isinstance(column.type, sqlalchemy.Integer):
+        return pyarrow.int64()
+    if isinstance(column.type, sqlalchemy.Float):
+        return pyarrow.float64()
+    # strings, and enums as their values
+    return pyarrow.string()
+
+
+def get_schema(table):
+    return pyarrow.schema([
+        (column.key, get_arrow_type(column)) for column in TABLES[table]])
+
+
+def get_query(table, low_job_id=None, high_job_id=None, job_ids=None):
+    """Rows of a table for a range of job ids, or for the given job ids"""
+    columns = TABLES[table]
+    job_id = columns[0]
+    query = select(*columns)
+    if table == "jobs":
+        query = query.select_from(JobData.__table__.outerjoin(
+            ChildJob.__table__, child_job.job_id == job.job_id))
+    if job_ids is not None:
+        query = query.where(job_id.in_(job_ids))
+    else:
+        query = query.where(job_id >= low_job_id)\
+                     .where(job_id <= high_job_id)
+    return query.order_by(job_id)
+
+
+def to_arrow_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+
+def get_state(directory):
+    """
+    :return ExportState: what the directory holds, None if nothing yet
+    """
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as state_file:
+            return ExportState(**json.load(state_file))
+    except FileNotFoundError:
+        return None
+
+
+def set_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + ".tmp", "w") as state_file:
+        json.dump(state._asdict(), state_file)
+    os.replace(path + ".tmp", path)
+
+
+def open_writer(path, schema, file_format):
+    if file_format == PARQUET:
+        return pyarrow.parquet.ParquetWriter(path, schema)
+    return pyarrow.ipc.new_file(path, schema)
+
+
+def export_table(connection, directory, table, low_job_id, high_job_id,
+                 file_format):
+    """Writes the rows of a table for a range of job ids to a new file
+
+    :return int: number of rows written
+    """
+    return write_table(
+        connection, directory, table,
+        "{}-{}.{}".format(low_job_id, high_job_id, file_format),
+        [get_query(table, low_job_id, high_job_id)], file_format)
+
+
+def write_table(connection, directory, table, file_name, queries,
+                file_format):
+    """Writes the rows of a table returned by queries to a new file
+
+    :return int: number of rows written
+    """
+    schema = get_schema(table)
+    table_dir = os.path.join(directory, table)
+    os.makedirs(table_dir, exist_ok=True)
+    path = os.path.join(table_dir, file_name)
+    # written under a temporary name, hidden from readers, so that they
+    # never see half files
+    temporary_path = os.path.join(table_dir, "." + file_name)
+
+    rows = 0
+    with open_writer(temporary_path, schema, file_format) as writer:
+        for query in queries:
+            result = connection.execution_options(
+                stream_results=True).execute(query)
+            for chunk in result.partitions(ROWS_PER_BATCH):
+                columns = zip(*chunk)
+                writer.write_batch(pyarrow.record_batch([
+                    pyarrow.array(
+                        [to_arrow_value(value) for value in values],
+                        type=field.type)
+                    for field, values in zip(schema, columns)],
+                    schema=schema))
+                rows += len(chunk)
+    if rows:
+        os.replace(temporary_path, path)
+    else:
+        os.remove(temporary_path)
+    return rows
+
+
+def export(connection, directory, high_job_id, low_job_id=None,
+           file_format=ARROW):
+    """Appends jobs up to high_job_id, and their results, to an export
+
+    :param int low_job_id: first job id to export; by default the one after
+        the last exported job id
+    :return dict: table -> number of rows written, None if there was nothing
+        new to export
+    """
+    state = get_state(directory)
+    if state is not None:
+        if state.file_format != file_format:
+            raise ExportError("{} holds {} files, not {}".format(
+                directory, state.file_format, file_format))
+        if low_job_id is None:
+            low_job_id = state.high_job_id + 1
+        elif low_job_id <= state.high_job_id:
+            raise ExportError("{} already holds jobs up to {}".format(
+                directory, state.high_job_id))
+    elif low_job_id is None:
+        low_job_id = 0
+
+    if low_job_id > high_job_id:
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+    rows = {
+        table: export_table(connection, directory, table, low_job_id,
+                            high_job_id, file_format)
+        for table in TABLES}
+    set_state(directory, ExportState(file_format, high_job_id))
+    return rows
+
+
+def export_backfill(connection, directory):
+    """Appends the rows of the cache missing from an export below its last
+    exported job id
+
+    Such rows were added to the cache after later jobs were exported: jobs
+    of the history fetched by reports or openqa_investigator.py, results
+    parsed after their job was exported. Each table gets the rows of the
+    job ids it does not hold yet.
+
+    :return dict: table -> number of rows written, None if no row was
+        missing
+    """
+    state = get_state(directory)
+    if state is None:
+        return None
+    rows = {}
+    for table in TABLES:
+        column = TABLES[table][0]
+        exported = set(open_table(directory, table).to_table(
+            columns=[column.key]).column(column.key).to_pylist())
+        job_ids = [
+            job_id for job_id in connection.execute(
+                select(column).distinct().where(column <= state.high_job_id)
+                              .order_by(column)).scalars()
+            if job_id not in exported]
+        if not job_ids:
+            continue
+
+        # numbered after the backfills already there, so that names are
+        # unique
+        table_dir = os.path.join(directory, table)
+        backfill = 1
+        if os.path.isdir(table_dir):
+            backfill += sum(
+                1 for name in os.listdir(table_dir)
+                if "-backfill" in name and not name.startswith("."))
+        file_name = "{}-{}-backfill{}.{}".format(
+            job_ids[0], job_ids[-1], backfill, state.file_format)
+        rows[table] = write_table(
+            connection, directory, table, file_name,
+            [get_query(table, job_ids=job_ids[i:i + JOB_IDS_PER_QUERY])
+             for i in range(0, len(job_ids), JOB_IDS_PER_QUERY)],
+            state.file_format)
+    return rows or None
+
+
+def open_table(directory, table):
+    """The exported rows of a table
+
+    :return pyarrow.dataset.Dataset: dataset over all the files of the table
+    """
+    state = get_state(directory)
+    if state is None:
+        raise ExportError("No export in {}".format(directory))
+    table_dir = os.path.join(directory, table)
+    if not os.path.isdir(table_dir):
+        # no rows exported yet
+        return pyarrow.dataset.dataset(get_schema(table).empty_table())
+    if state.file_format == PARQUET:
+        return pyarrow.dataset.dataset(table_dir, format="parquet",
+                                       schema=get_schema(table))
+    return pyarrow.dataset.dataset(
+        table_dir, format="ipc", schema=get_schema(table),
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+
+def read_rows(directory, table, filter=None):
+    """Exported rows of a table, as namedtuples named after the table
+
+    :param pyarrow.dataset.Expression filter: rows to read
+    :return list: rows
+    """
+    Row = collections.namedtuple(
+        table, [column.key for column in TABLES[table]])
+    columns = open_table(directory, table).to_table(filter=filter)\
+        .to_pydict()
+    return [Row(*values) for values in zip(*columns.values())]
@@ -0,0 +1,230 @@
+"""Cache of HTTP GET responses, keyed by URL
+
+Two tiers: an in-process LRU of recent responses, and optionally an
+on-disk store (blobs named by the hash of their content, plus an SQLite
+index) limited in size, evicting least recently used entries.
+
+Cached entries are revalidated with If-None-Match/If-Modified-Since when
+the server gave an ETag or Last-Modified. Responses fetched as immutable
+(for example logs of finished openQA jobs) are never requested again.
+Responses kept in memory are reused without revalidation for
+MEMORY_MAX_AGE seconds, which covers repeated requests within one run.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from lib import http_client
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+MEMORY_MAX_ENTRIES = 256
+MEMORY_MAX_AGE = 300
+
+
+class CachedResponse:
+    """The parts of requests.Response used by callers, for a cached body"""
+
+    status_code = 200
+    ok = True
+
+    def __init__(self, url, content, encoding=None, etag=None,
+                 last_modified=None, immutable=False):
+        self.url = url
+        self.content = content
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.immutable = immutable
+        self.fetched_at = time.monotonic()
+
+    @property
+    def text(self):
+        return str(self.content, self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                      check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " url TEXT PRIMARY KEY, digest TEXT NOT NULL,"
+                " size INTEGER NOT NULL, encoding TEXT, etag TEXT,"
+                " last_modified TEXT, immutable INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used"
+                            " ON entries (last_used)")
+            self.db.commit()
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is not None:
+                self.memory.move_to_end(url)
+                return entry
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                "SELECT digest, encoding, etag, last_modified, immutable"
+                " FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            digest, encoding, etag, last_modified, immutable = row
+            try:
+                with open(self.blob_path(digest), 'rb') as blob:
+                    content = blob.read()
+            except FileNotFoundError:
+                self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE url = ?",
+                            (time.time(), url))
+            self.db.commit()
+            entry = CachedResponse(url, content, encoding, etag,
+                                   last_modified, bool(immutable))
+            # loaded from disk, so not known to be recent
+            entry.fetched_at = None
+            self.remember(entry)
+            return entry
+
+    def remember(self, entry):
+        self.memory[entry.url] = entry
+        self.memory.move_to_end(entry.url)
+        while len(self.memory) > MEMORY_MAX_ENTRIES:
+            self.memory.popitem(last=False)
+
+    def store(self, entry):
+        with self.lock:
+            self.remember(entry)
+            if self.db is None:
+                return
+            digest = hashlib.sha256(entry.content).hexdigest()
+            blob_path = self.blob_path(digest)
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                with open(blob_path + '.tmp', 'wb') as blob:
+                    blob.write(entry.content)
+                os.replace(blob_path + '.tmp', blob_path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.url, digest, len(entry.content), entry.encoding,
+                 entry.etag, entry.last_modified, int(entry.immutable),
+                 time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total_size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for url, digest, size in self.db.execute(
+                "SELECT url, digest, size FROM entries"
+                " ORDER BY last_used").fetchall():
+            if total_size <= self.max_size:
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            total_size -= size
+            still_used = self.db.execute(
+                "SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone()
+            if not still_used:
+                try:
+                    os.unlink(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def is_fresh(entry):
+        """Whether the cached entry can be used without asking the server"""
+        if entry is None:
+            return False
+        if entry.immutable:
+            return True
+        return entry.fetched_at is not None and \
+            time.monotonic() - entry.fetched_at < MEMORY_MAX_AGE
+
+    @staticmethod
+    def validation_headers(entry):
+        """Headers making the request for a cached entry conditional"""
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def update(self, url, entry, status_code, content, encoding, headers,
+               immutable=False):
+        """Records the successful response to a request for the URL
+
+        :param CachedResponse entry: entry the request was conditional on
+        :return CachedResponse: the revalidated entry, or the new one
+        """
+        if status_code == 304 and entry is not None:
+            logging.debug("{} not modified".format(url))
+            entry.fetched_at = time.monotonic()
+            with self.lock:
+                self.remember(entry)
+            return entry
+
+        entry = CachedResponse(
+            url, content, encoding=encoding,
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            immutable=immutable)
+        self.store(entry)
+        return entry
+
+    def get(self, url, immutable=False, **kwargs):
+        """GET the URL, reusing a cached response when still valid
+
+        :param bool immutable: the resource never changes once it exists,
+            a cached copy is used without asking the server
+        :return: CachedResponse, or the requests.Response of a failure
+        """
+        entry = self.lookup(url)
+        if self.is_fresh(entry):
+            return entry
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.update(self.validation_headers(entry))
+
+        response = http_client.get(url, headers=headers, **kwargs)
+        if not response.ok:
+            return response
+
+        return self.update(
+            url, entry, response.status_code, response.content,
+            response.encoding or response.apparent_encoding,
+            response.headers, immutable=immutable)
+
+
+response_cache = ResponseCache()
+
+
+def setup_cache(path=None, max_size=DEFAULT_MAX_SIZE):
+    global response_cache
+    response_cache = ResponseCache(path, max_size)
+
+
+def get(url, immutable=False, **kwargs):
+    return response_cache.get(url, immutable=immutable, **kwargs)
@@ -0,0 +1,211 @@
+"""Shared HTTP client for openQA and GitHub APIs
+
+Requests to each host go through a pooled requests.Session (keep-alive,
+compression), with connect/read timeouts. Connection errors and 5xx
+responses are retried with jittered exponential backoff, and a host that
+keeps failing is not contacted at all for a while (circuit breaker), so a
+stuck upstream cannot hang the callers indefinitely.
+
+Timeouts and retries can be set with configure(), or with the
+HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT and HTTP_RETRIES env variables.
+"""
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+import urllib3.exceptions
+
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+DEFAULT_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 60))
+DEFAULT_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+# base and max delay (seconds) between retries
+DEFAULT_BACKOFF = 1
+MAX_BACKOFF = 30
+
+# connections kept open per host
+POOL_SIZE = 16
+
+# consecutive failed requests (after their retries) after which a host is
+# considered down, and for how long (seconds) requests to it fail
+# immediately
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 60
+
+# methods safe to repeat when the request may have reached the server
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Request not attempted, the host failed too many times recently"""
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of a single upstream host"""
+
+    def __init__(self, host, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # half-open: let this request through as a probe, and keep
+            # others out until it succeeds or the timeout passes again
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """Records a request that failed, retries included"""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning(
+                        "{} failed {} times in a row, pausing requests for "
+                        "{}s".format(self.host, self.failures,
+                                     self.reset_timeout))
+                self.opened_at = time.monotonic()
+
+
+def is_unsent(error):
+    """Whether a request that failed with a connection error surely did not
+    reach the server: the connection could not be established (refused,
+    name resolution failure, timeout)
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    # also the parent class of NewConnectionError (refused, DNS failures)
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def configure(self, connect_timeout=None, read_timeout=None,
+                  retries=None, backoff=None):
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+
+    def get_session(self, host):
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self.sessions[host] = session
+                self.breakers[host] = CircuitBreaker(host)
+            return self.sessions[host], self.breakers[host]
+
+    def get_breaker(self, host):
+        """Circuit breaker of the host, also for requests made elsewhere"""
+        return self.get_session(host)[1]
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        host = urllib.parse.urlsplit(url).netloc
+        session, breaker = self.get_session(host)
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+
+        # retries of a request already let through go on, failures count
+        # once the request gives up
+        if not breaker.allow():
+            raise CircuitOpenError(
+                "Not requesting {}, {} is failing".format(url, host))
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                # without a connection, the request surely was not sent
+                retry = method in IDEMPOTENT_METHODS or is_unsent(e)
+                if not retry or attempt >= self.retries:
+                    breaker.record_failure()
+                    raise
+                reason = str(e)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return response
+                if method not in IDEMPOTENT_METHODS \
+                        or attempt >= self.retries:
+                    breaker.record_failure()
+                    return response
+                reason = "HTTP {}".format(response.status_code)
+                response.close()
+
+            delay = random.uniform(
+                0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+            attempt += 1
+            logging.debug("{} {} failed ({}), retry {}/{} in {:.1f}s".format(
+                method, url, reason, attempt, self.retries, delay))
+            time.sleep(delay)
+
+
+default_client = HttpClient()
+
+
+def configure(**kwargs):
+    default_client.configure(**kwargs)
+
+
+def request(method, url, **kwargs):
+    return default_client.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return request('PATCH', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
@@ -1,31 +1,226 @@
-from sqlalchemy import select
-
+from lib import flakiness_model, error_signatures
 from lib.openqa_api import (
     OpenQA,
     get_db_session,
+    JobData,
     ChildJob,
     OrphanJob,
     TestFailure,
+    PastFailure,
+    SuiteHistory,
+    TestStats,
+    STATS_WINDOW,
+    get_failure_keys,
+    has_failure,
 )
+try:
+    from lib import openqa_async
+except ImportError:
+    # aiohttp not available, look histories up one by one
+    openqa_async = None
+
+# past jobs looked up when analyzing a job (heuristic) ...
+HEURISTIC_MODEL = "heuristic"
+# ... or the flakiness statistics cached by openqa_sync
+CACHED_MODEL = "cached"
+# failure rate estimates over the jobs in the cache, see
+# lib/flakiness_model.py
+STATISTICAL_MODEL = "statistical"
+MODELS = (HEURISTIC_MODEL, CACHED_MODEL, STATISTICAL_MODEL)
+
+# number of past jobs each job is compared to
+DEFAULT_WINDOWS = {
+    HEURISTIC_MODEL: 5,
+    CACHED_MODEL: 5,
+    STATISTICAL_MODEL: 500,
+}
+# what makes two failures of a test fail the same way: same relevant error,
+# same error signature, or signatures in the same cluster (see
+# lib/error_signatures.py)
+GROUP_BY_ERROR = "error"
+GROUP_BY_SIGNATURE = "signature"
+GROUP_BY_CLUSTER = "cluster"
+ERROR_GROUPINGS = (GROUP_BY_ERROR, GROUP_BY_SIGNATURE, GROUP_BY_CLUSTER)
+
+# failures listed per test in detailed reports of the statistical model
+REPORTED_FAILURES = 10
+# max number of job ids in a single query
+QUERY_CHUNK = 1000
+
+def get_failures(job_ids):
+    """Failures of the given jobs, with a single query
+
+    :return list: TestFailure objects, ordered by job id
+    """
+    db = get_db_session()
+    return db.query(TestFailure)\
+             .where(TestFailure.job_id.in_(job_ids))\
+             .order_by(TestFailure.job_id)\
+             .all()
+
+def get_history(jobs, n):
+    """Past jobs each job is compared to
+
+    :return dict: job -> list of similar jobs, see OpenQA.get_n_jobs_like()
+    """
+    # obtain jobs' stability from the update pool since those don't have
+    # pull requests included (thus more accurate results)
+    if openqa_async is None:
+        return {job: OpenQA.get_n_jobs_like(job, n, flavor_override="update")
+                for job in jobs}
+    return openqa_async.run(openqa_async.AsyncOpenQA.get_n_jobs_like_each,
+                            jobs, n, flavor_override="update")
+
+def get_stats_history(jobs, n):
+    """Past jobs each job is compared to, and their failures, as recorded in
+    the flakiness statistics (TestStats)
+
+    :return tuple: dict job -> list of past job ids, dict job id -> list of
+        PastFailure objects
+    """
+    db = get_db_session()
+    history = {}
+    failures_by_job_id = {}
+    tests_by_suite = {}
+    for job in jobs:
+        # like get_history(), from the update pool
+        key = SuiteHistory.get_key(job, flavor_override="update")
+        suite = db.get(SuiteHistory, key)
+        history[job] = suite.get_job_ids(job.job_id, n) if suite else []
+
+        suite_key = tuple(key.values())
+        if suite is not None and suite_key not in tests_by_suite:
+            tests_by_suite[suite_key] = db.query(TestStats)\
+                .filter_by(**key).all()
+            for stats in tests_by_suite[suite_key]:
+                for failure in stats.get_failures(suite.job_ids):
+                    failures_by_job_id.setdefault(
+                        failure.job_id, []).append(failure)
+    return history, failures_by_job_id
+
+def get_cached_history(jobs, n):
+    """Past jobs each job is compared to, among those in the cache
+
+    Unlike get_history(), nothing is looked up on openQA: the cache has to
+    be kept up to date by openqa_sync.
+
+    :return dict: job -> list of past job ids
+    """
+    db = get_db_session()
+    history = {}
+    for job in jobs:
+        # like get_history(), from the update pool
+        history[job] = [
+            job_id for job_id, in db.query(JobData.job_id)
+            .filter(JobData.job_name == job.job_name)
+            .filter(JobData.machine == job.machine)
+            .filter(JobData.version == job.version)
+            .filter(JobData.flavor == "update")
+            .filter(JobData.valid == True)
+            .filter(JobData.job_id < job.job_id)
+            .order_by(JobData.job_id.desc())
+            .limit(n)]
+    return history
+
+def get_past_failures(job_ids):
+    """Failures of the given jobs, without loading TestFailure objects
+
+    :return list: PastFailure objects
+    """
+    db = get_db_session()
+    job_ids = list(job_ids)
+    failures = []
+    for start in range(0, len(job_ids), QUERY_CHUNK):
+        failures += [
+            PastFailure(*row) for row in db.query(
+                TestFailure.name, TestFailure.title, TestFailure.test_id,
+                TestFailure.job_id, TestFailure.relevant_error)
+            .where(TestFailure.job_id.in_(job_ids[start:start+QUERY_CHUNK]))]
+    return failures
+
+def get_test_sort_key(test):
+    """Order of (name, title, test_id) tuples, as SQLite sorts them by title,
+    name and test_id (NULLs first)"""
+    name, title, test_id = test
+    return (title is not None, title or "", name, test_id)
+
+def get_error_grouping(failures, group_errors_by):
+    """Function telling the error of a failure, as grouped
+
+    :param iterable failures: all the failures the function is used on
+        (needed to cluster their signatures)
+    :param str group_errors_by: one of ERROR_GROUPINGS
+    """
+    if group_errors_by == GROUP_BY_ERROR:
+        return lambda failure: failure.relevant_error
+    if group_errors_by == GROUP_BY_SIGNATURE:
+        return lambda failure: failure.error_signature
+    clusters = error_signatures.ErrorClusters(
+        failure.error_signature for failure in failures)
+    return lambda failure: clusters.get(failure.error_signature)
 
 class InstabilityAnalysis:
     """Job Instability Analysis"""
 
-    def __init__(self, original_jobs):
+    def __init__(self, original_jobs, model=HEURISTIC_MODEL, window=None,
+                 group_errors_by=GROUP_BY_SIGNATURE):
+        """
+        :param list original_jobs: jobs to analyze
+        :param str model: where past results come from, one of MODELS
+        :param int window: number of past jobs to compare each job to, up to
+            STATS_WINDOW with the cached model; see DEFAULT_WINDOWS
+        :param str group_errors_by: when errors of a test are the same, one
+            of ERROR_GROUPINGS
+        """
         self.unstable_jobs = {} # JobData -> ChildJobInstability
 
         jobs = original_jobs
+        if window is None:
+            window = DEFAULT_WINDOWS[model]
 
+        if model == CACHED_MODEL:
+            if window > STATS_WINDOW:
+                raise ValueError("Flakiness statistics cover only the last "
+                                 "{} jobs".format(STATS_WINDOW))
+            history, failures_by_job_id = get_stats_history(jobs, window)
+        elif model == STATISTICAL_MODEL:
+            if not flakiness_model.available:
+                raise ValueError("The statistical model needs numpy and scipy")
+            history = get_cached_history(jobs, window)
+            failures_by_job_id = {}
+            for failure in get_past_failures(
+                    {job_id for job_ids in history.values()
+                     for job_id in job_ids}):
+                failures_by_job_id.setdefault(
+                    failure.job_id, []).append(failure)
+        else:
+            history = {
+                job: [past_job.job_id for past_job in past_jobs]
+                for job, past_jobs in get_history(jobs, n=window).items()}
+
+            # failures of all the past jobs at once
+            past_job_ids = {job_id for job_ids in history.values()
+                            for job_id in job_ids}
+            failures_by_job_id = {}
+            for failure in get_failures(past_job_ids):
+                failures_by_job_id.setdefault(
+                    failure.job_id, []).append(failure)
+
+        get_error = get_error_grouping(
+            (failure for job_ids in history.values() for job_id in job_ids
+             for failure in failures_by_job_id.get(job_id, [])),
+            group_errors_by)
         for job in jobs:
-            t = ChildJobInstability(job)
+            t = ChildJobInstability(job, history[job], failures_by_job_id,
+                                    model=model, get_error=get_error)
             if t.is_unstable:
                 self.unstable_jobs[job] = t
 
     def is_test_unstable(self, sample_test):
-        for job in self.unstable_jobs:
-            if sample_test.job == job:
-                return self.unstable_jobs[job].is_test_unstable(sample_test)
-        return False
+        job_instability = self.unstable_jobs.get(sample_test.job)
+        if job_instability is None:
+            return False
+        return job_instability.is_test_unstable(sample_test)
 
     def report(self, details=False):
         text = "<details>\n\n"
@@ -44,41 +239,59 @@ class AbstractInstability:
 
 class ChildJobInstability(AbstractInstability):
 
-    def __init__(self, job):
+    def __init__(self, job, job_ids, failures_by_job_id,
+                 model=HEURISTIC_MODEL, get_error=None):
+        """
+        :param JobData job: job to analyze
+        :param list job_ids: ids of past jobs like it
+        :param dict failures_by_job_id: failures of (at least) these past
+            jobs, see get_failures() and get_stats_history()
+        :param str model: one of MODELS
+        :param function get_error: error of a failure, as grouped (see
+            get_error_grouping()); the relevant error by default
+        """
+        if get_error is None:
+            get_error = get_error_grouping((), GROUP_BY_ERROR)
         self.unstable_tests = []
         self.test_instability = []
         self.job = job
 
-        # obtain jobs' stability from the update pool since those don't have
-        # pull requests included (thus more accurate results)
-        jobs = OpenQA.get_n_jobs_like(job, n=5, flavor_override="update")
-        job_ids = [job.job_id for job in jobs]
-
-        db = get_db_session()
-        test_identifiers = db.execute(
-            select(TestFailure.name, TestFailure.title, TestFailure.test_id)\
-            .where(TestFailure.job_id.in_(job_ids))\
-            .group_by(TestFailure.title, TestFailure.name, TestFailure.test_id))
-
-        for (test_name, test_title, test_id) in test_identifiers:
-            sample_test_failure = db.query(TestFailure)\
-                .filter(TestFailure.name == test_name)\
-                .filter(TestFailure.title == test_title)\
-                .filter(TestFailure.test_id == test_id)\
-                .where(TestFailure.job_id.in_(job_ids))\
-                .first()
-
-            t = TestInstability(sample_test_failure, job_ids)
+        # past failures of each test
+        past_failures = {}
+        for job_id in sorted(job_ids):
+            for failure in failures_by_job_id.get(job_id, []):
+                past_failures.setdefault(
+                    (failure.name, failure.title, failure.test_id),
+                    []).append(failure)
+
+        # ordered like the tests were when grouped by the DB
+        tests = sorted(past_failures, key=get_test_sort_key)
+        if model == STATISTICAL_MODEL:
+            estimate = flakiness_model.estimate(flakiness_model.FailureMatrix(
+                job_ids,
+                ((failure.job_id, test, get_error(failure))
+                 for test in tests for failure in past_failures[test])))
+            test_instabilities = [
+                StatisticalTestInstability(
+                    past_failures[test], job_ids, estimate, column)
+                for column, test in enumerate(estimate.tests)]
+        else:
+            test_instabilities = [
+                TestInstability(past_failures[test], job_ids, get_error)
+                for test in tests]
+
+        for t in test_instabilities:
             if t.is_unstable:
-                self.unstable_tests += [sample_test_failure]
+                self.unstable_tests += [t.sample_test_failure]
                 self.test_instability += [t]
+        self.unstable_test_keys = get_failure_keys(self.unstable_tests)
 
     @property
     def is_unstable(self):
         return len(self.unstable_tests) > 0
 
     def is_test_unstable(self, test_failure):
-        return test_failure in self.unstable_tests
+        return has_failure(self.unstable_test_keys, test_failure)
 
     def report(self, details=False):
         if len(self.unstable_tests) == 0:
@@ -93,24 +306,20 @@ class ChildJobInstability(AbstractInstability):
 
 class TestInstability(AbstractInstability):
 
-    def __init__(self, sample_test_failure, job_ids):
+    def __init__(self, past_failures, job_ids, get_error=None):
+        """
+        :param list past_failures: failures of the test in past jobs
+            (TestFailure or PastFailure objects)
+        :param list job_ids: ids of the past jobs
+        :param function get_error: error of a failure, as grouped (see
+            get_error_grouping()); the relevant error by default
+        """
+        if get_error is None:
+            get_error = get_error_grouping((), GROUP_BY_ERROR)
+        self.get_error = get_error
         self.job_ids = job_ids
-        self.sample_test_failure = sample_test_failure
-        self.past_failures = self._get_past_failures()
-
-    def _get_past_failures(self):
-        test_name = self.sample_test_failure.name
-        test_title = self.sample_test_failure.title
-        test_id = self.sample_test_failure.test_id
-
-        db = get_db_session()
-        past_failures = db.query(TestFailure)\
-                          .where(TestFailure.job_id.in_(self.job_ids))\
-                          .filter(TestFailure.name == test_name)\
-                          .filter(TestFailure.title == test_title)\
-                          .filter(TestFailure.test_id == test_id)\
-                          .all()
-        return past_failures
+        self.sample_test_failure = past_failures[0]
+        self.past_failures = past_failures
 
     @property
     def is_unstable(self):
@@ -126,8 +335,8 @@ class TestInstability(AbstractInstability):
 
         # never succeeded
         else:
-            errors = [failure.relevant_error for failure in self.past_failures]
-            unique_errors = list(set(errors))
+            unique_errors = {
+                self.get_error(failure) for failure in self.past_failures}
             return len(unique_errors) != 1
 
     def report(self, details=False):
@@ -141,7 +350,7 @@ class TestInstability(AbstractInstability):
                     len(self.past_failures), len(self.job_ids))
                 for fail in self.past_failures:
                     text += "   - [job {}]({}) `{}`\n".format(
-                        fail.job.job_id,
+                        fail.job_id,
                         fail.get_test_url(),
                         fail.relevant_error)
                 text += "  </details>\n\n"
@@ -153,3 +362,43 @@ class TestInstability(AbstractInstability):
         else:
             return ""
 
+
+class StatisticalTestInstability(TestInstability):
+    """Instability of a test according to lib/flakiness_model.py"""
+
+    def __init__(self, past_failures, job_ids, estimate, column):
+        """
+        :param flakiness_model.FlakinessEstimate estimate: estimate of the
+            tests of the job
+        :param int column: index of this test in the estimate
+        """
+        super().__init__(past_failures, job_ids)
+        self.probability = estimate.probability[column]
+        self.low = estimate.low[column]
+        self.high = estimate.high[column]
+        self.unstable = bool(estimate.unstable[column])
+
+    @property
+    def is_unstable(self):
+        return self.unstable
+
+    def report(self, details=False):
+        if not self.is_unstable:
+            return ""
+
+        summary = "{}/{} ({}/{} times with errors, failure rate {:.0%}, " \
+            "{:.0%} CI {:.0%}-{:.0%})".format(
+                self.sample_test_failure.name, self.sample_test_failure.title,
+                len(self.past_failures), len(self.job_ids), self.probability,
+                flakiness_model.DEFAULT_CONFIDENCE, self.low, self.high)
+        if not details:
+            return "  * {}\n".format(summary)
+
+        text = "  <details><summary>{}</summary>\n\n".format(summary)
+        for fail in self.past_failures[-REPORTED_FAILURES:]:
+            text += "   - [job {}]({}) `{}`\n".format(
+                fail.job_id,
+                fail.get_test_url(),
+                fail.relevant_error)
+        text += "  </details>\n\n"
+        return text
@@ -0,0 +1,182 @@
+"""Parser of JUnit test case descriptions, as found in openQA job details
+
+Failed test cases of a JUnit report come with a text_data description,
+made by openQA from the report
+(https://github.com/os-autoinst/openQA/blob/dae9f4e5/lib/OpenQA/Parser/Format/JUnit.pm#L84),
+usually like:
+
+    # test_003_cleanup_destroyed
+    # error:
+
+    Traceback (most recent call last):
+      File "/usr/lib/python3.8/site-packages/qubes/tests/integ/dispvm.py", line 94, in test_003_cleanup_destroyed
+        self.loop.run_until_complete(asyncio.wait_for(p.wait(), timeout))
+      File "/usr/lib64/python3.8/asyncio/tasks.py", line 501, in wait_for
+        raise exceptions.TimeoutError()
+    asyncio.exceptions.TimeoutError
+
+    # system-out:
+
+    ...
+
+DescriptionParser goes over such a description once and returns a
+ParsedDescription.
+"""
+import collections
+import logging
+import re
+
+SYSTEM_OUT_MARKER = "# system-out:"
+TRACEBACK_START = "Traceback (most recent call last):"
+FRAME_PATTERN = re.compile(
+    r'^\s*File "(?P<file>[^"]*)", line (?P<line>\d+), in (?P<function>.*)$',
+    re.MULTILINE)
+
+# reasons, as TestFailureReason values
+SKIPPED = "skipped"
+ERROR = "error"
+FAILURE = "failure"
+UNKNOWN = "unknown"
+TEST_DIED = "test died"
+WAIT_SERIAL = "wait serial expected"
+
+# status line of the test case, and the resulting reason
+STATUS_REASONS = (
+    ("# error:", ERROR),
+    ("# failure:", FAILURE),
+    ("# skipped:", SKIPPED),
+)
+
+TracebackFrame = collections.namedtuple(
+    'TracebackFrame', 'file line function')
+
+
+class ParsedDescription:
+    """Result of DescriptionParser.parse()
+
+    reason is a TestFailureReason value, fail_error and cleanup_error the
+    description parts before and after the "# system-out:" line, frames
+    the TracebackFrame list of the last traceback in fail_error.
+    """
+
+    def __init__(self, reason=UNKNOWN, relevant_error=None, fail_error=None,
+                 cleanup_error=None, timed_out=False, frames=()):
+        self.reason = reason
+        self.relevant_error = relevant_error
+        self.fail_error = fail_error
+        self.cleanup_error = cleanup_error
+        self.timed_out = timed_out
+        self.frames = frames
+
+    def __eq__(self, other):
+        return vars(self) == vars(other)
+
+    def __repr__(self):
+        return "ParsedDescription({})".format(", ".join(
+            "{}={!r}".format(key, value) for key, value in vars(self).items()))
+
+
+def truncate(line, max_chars):
+    if len(line) <= max_chars:
+        return line
+    return line[:max_chars-len("...")] + "..."
+
+
+def starts_with_whitespace(line):
+    return line[:1].isspace()
+
+
+class DescriptionParser:
+    def __init__(self, max_chars=70):
+        """
+        :param int max_chars: maximum number of characters of the relevant
+            error
+        """
+        self.max_chars = max_chars
+
+    def parse(self, description):
+        """Parses a test case description
+
+        :param str description: text_data of the test case
+        :return ParsedDescription: parsed description
+        """
+        description = description.strip()
+        result = ParsedDescription(timed_out="timed out" in description)
+
+        fail_error, marker, cleanup_error = description.partition(
+            SYSTEM_OUT_MARKER)
+        # non-standard error messages / test descriptions
+        if not marker:
+            if "# Test died: " in description:
+                result.reason = TEST_DIED
+            elif "# wait_serial expected:" in description:
+                result.reason = WAIT_SERIAL
+
+            first_line = description.partition("\n")[0]
+            result.relevant_error = \
+                first_line.strip()[:self.max_chars-3] + "..."
+            result.fail_error = description
+            return result
+
+        result.fail_error = fail_error
+        result.cleanup_error = cleanup_error
+        lines = fail_error.split("\n")
+
+        status_line = lines[1] if len(lines) > 1 else ""
+        for status, reason in STATUS_REASONS:
+            if status in status_line:
+                result.reason = reason
+                break
+        if result.reason in (SKIPPED, UNKNOWN):
+            return result
+
+        result.relevant_error = self.get_relevant_error(lines)
+        traceback_start = fail_error.rfind(TRACEBACK_START)
+        if traceback_start != -1:
+            result.frames = [
+                TracebackFrame(match['file'], int(match['line']),
+                               match['function'])
+                for match in FRAME_PATTERN.finditer(
+                    fail_error, traceback_start)]
+        return result
+
+    def get_relevant_error(self, lines):
+        """Returns the error line(s) that best summarises the error (heuristic)
+
+        The idea is to find the last traceback (when chained exceptions) and
+        return its last line, the exception, preceded by the line raising it
+        if there is enough space.
+        """
+        max_chars = self.max_chars
+        # find relevant line(s), going back over the lines after the
+        # exception, then the exception itself (lines not indented); like
+        # before, a search going past the first line wraps to the last one
+        try:
+            i = len(lines) - 1
+            while starts_with_whitespace(lines[i]):
+                i -= 1
+            while not starts_with_whitespace(lines[i]):
+                i -= 1
+
+            relev_line_prev = lines[i].strip()
+            relev_line = lines[i+1].strip()
+        except IndexError:
+            logging.warning("Failed to extract error from: " + "\n".join(lines))
+            # just get the last line non-empty
+            return truncate([line for line in lines if line][-1], max_chars)
+
+        # show relevant line (truncated if needed) and the previous one if
+        # there is enough space.
+        if len(relev_line) < max_chars - 30:
+            max_len_prev_line = max_chars -4 -len(relev_line)
+            return "{}... {}".format(
+                relev_line_prev[:max_len_prev_line],
+                relev_line)
+        return truncate(relev_line, max_chars)
+
+
+default_parser = DescriptionParser()
+
+
+def parse_description(description):
+    return default_parser.parse(description)
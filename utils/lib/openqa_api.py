@@ -1,22 +1,44 @@
+import collections
+import contextlib
 import csv
+import functools
 import io
+import itertools
+import pickle
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy
 from sqlalchemy import (
-    Column, Boolean, Integer, String, Enum, PickleType,
-    ForeignKey, create_engine
+    Column, Boolean, Integer, Float, String, Enum, LargeBinary, JSON,
+    TypeDecorator, ForeignKey, ForeignKeyConstraint, Index, create_engine,
+    event, insert, tuple_
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import (
-    sessionmaker, reconstructor, relationship, backref
+    sessionmaker, reconstructor, relationship, backref, deferred
 )
-import requests
 import re
 import json
 import enum
 import logging
 import os
 import sys
+import threading
+import time
+
+import requests
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from lib import (
+    http_client, http_cache, db_migrations, package_parser, junit_parser,
+    error_signatures
+)
 from lib.github_api import GitHubRepo, GitHubIssue, setup_github_environ
 from lib.common import *
 
@@ -31,6 +53,136 @@ local_session = None
 
 name_mapping = {}
 
+# number of job details downloaded in parallel
+DEFAULT_FETCH_CONCURRENCY = 8
+fetch_workers = DEFAULT_FETCH_CONCURRENCY
+# job details downloaded ahead of creating their JobData, by job id
+prefetched_job_details = {}
+# set while jobs are created in a batch, see ingest_batch()
+batch_ingest = False
+# finished jobs kept from /jobs listings, and for how long (seconds), see
+# JobListingCache
+JOB_LISTING_CACHE_SIZE = 10000
+JOB_LISTING_CACHE_MAX_AGE = 3600
+# max number of job ids asked for in a single listing request
+JOB_LISTING_CHUNK = 100
+# results of jobs making the history of a test suite
+CONCLUDED_RESULTS = ('passed', 'failed')
+# jobs listed at once when extending the history of a test suite
+LINEAGE_CHUNK = 50
+# latest jobs of a test suite covered by the flakiness statistics
+STATS_WINDOW = 50
+# repo of the issues tracking updates, looked up in a local mirror
+UPDATES_STATUS_REPO = "updates-status"
+# seconds during which the issue mirror is used without syncing it
+ISSUE_MIRROR_MAX_AGE = 300
+# shared by all jobs, see get_updates_status_repo()
+updates_status_repo = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def compress(data):
+    """Compresses bytes with zstd if available, zlib otherwise"""
+    if zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data)
+
+def decompress(data):
+    """Decompresses the output of compress(), whichever format it used"""
+    if data[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise Exception("zstandard module needed to read local DB")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class JobListingCache:
+    """Jobs seen in /jobs listings (settings and dependencies, no test
+    results), by job id
+
+    Only finished jobs are kept, since the others change, and only for
+    max_age seconds (a finished job gets a clone_id when restarted). Least
+    recently used jobs are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=JOB_LISTING_CACHE_SIZE,
+                 max_age=JOB_LISTING_CACHE_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, job_id):
+        """
+        :return dict: listed job, None if not kept
+        """
+        with self.lock:
+            entry = self.entries.get(job_id)
+            if entry is None:
+                return None
+            job, listed_at = entry
+            if time.monotonic() - listed_at > self.max_age:
+                del self.entries[job_id]
+                return None
+            self.entries.move_to_end(job_id)
+            return job
+
+    def add(self, jobs):
+        now = time.monotonic()
+        with self.lock:
+            for job in jobs:
+                if job.get('state') != 'done':
+                    self.entries.pop(job['id'], None)
+                    continue
+                self.entries[job['id']] = (job, now)
+                self.entries.move_to_end(job['id'])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+job_listing_cache = JobListingCache()
+
+
+class CompressedJSON(TypeDecorator):
+    """JSON document stored compressed (zstd if available, zlib otherwise)
+
+    Both formats are recognized when reading, regardless of which one is
+    used for writing.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(json.dumps(value, separators=(',', ':')).encode())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return json.loads(decompress(value))
+
+
+class CompressedText(TypeDecorator):
+    """Text stored compressed, like CompressedJSON"""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(value.encode())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress(value).decode()
+
+
 class PackageName:
     def __init__(self, line):
         self.package_name = None
@@ -38,37 +190,33 @@ class PackageName:
         self.component_names = []
         self.version = None
         self.release = None
+        # package_parser.DEB or RPM, for ordering versions
+        self.package_format = package_parser.RPM
+
+        records = package_parser.parse_packages(line)
+        if not records:
+            self.component_names = [self.package_name]
+            return
+        self.set_package(records[0].name,
+                         *records[0].get_manifest_version(),
+                         package_format=records[0].format)
+
+    @classmethod
+    def from_manifest_entry(cls, entry):
+        package = cls('')
+        package.set_package(entry.raw_name, entry.version,
+                            entry.release or None,
+                            package_format=entry.package_format)
+        return package
+
+    def set_package(self, raw_name, version, release, package_format=None):
+        if package_format is not None:
+            self.package_format = package_format
+        if raw_name in name_mapping:
+            self.package_name = name_mapping[raw_name]
+            self.version = version
+            self.release = release
 
-        # meaningful Debian lines starts with 'ii'
-        if line.startswith('ii '):
-            columns = line.split()
-            raw_name = columns[1]
-            raw_version = columns[2]
-
-            if raw_name in name_mapping:
-                self.package_name = name_mapping[raw_name]
-
-                if '-' in raw_version:
-                    self.version = raw_version.split('-', maxsplit=1)[0]
-                    self.release = raw_version.split('-', maxsplit=1)[1].split('+', maxsplit=1)[0]
-                elif '+' in raw_version:
-                    self.version = raw_version.split('+', maxsplit=1)[0]
-                else:
-                    self.version = raw_version
-
-        # Fedora lines have no spaces
-        if ' ' not in line:
-            try:
-                line_parts = line.split('-')
-                package_name = "-".join(line_parts[:-2])
-                if package_name in name_mapping:
-                    self.version = line_parts[-2]
-                    self.release = line_parts[-1].split('.', maxsplit=1)[0]
-                    self.package_name = name_mapping[package_name]
-            except IndexError:
-                # the package name was malformed
-                # and had an insufficient amount of '-'
-                return
         if isinstance(self.package_name, list):
             self.component_names = self.package_name
             self.package_name = self.package_name[0]
@@ -82,11 +230,16 @@ class PackageName:
 
     def __lt__(self, other):
         if self.package_name == other.package_name:
-            if self.version == other.version:
-                return self.release < other.release
-            return self.version < other.version
+            return package_parser.compare_version_strings(
+                self.get_full_version(), other.get_full_version(),
+                self.package_format) < 0
         return self.package_name < other.package_name
 
+    def get_full_version(self):
+        if self.release:
+            return "{}-{}".format(self.version or '', self.release)
+        return self.version or ''
+
     def __str__(self):
         return "{} v{}-{}".format(self.package_name, self.version, self.release)
 
@@ -98,28 +251,34 @@ class JobData(Base):
     __tablename__ = 'job'
 
     job_id = Column(Integer, primary_key=True)
-    job_name = Column(String)
+    job_name = Column(String) # test suite
     job_type = Column(String(50))
-    job_details = Column(PickleType) # json
+    # loaded only when accessed, frequently used fields are columns below
+    job_details = deferred(Column(CompressedJSON))
     valid = Column(Boolean)
-    machine = Column(String)
+    machine = Column(String, index=True)
     worker = Column(Integer)
-    version = Column(Integer)
-    flavor = Column(Integer)
+    version = Column(String, index=True)
+    flavor = Column(String, index=True)
+    result = Column(String, index=True)
+    build = Column(String, index=True)
+    clone_id = Column(Integer, index=True)
+    t_started = Column(String, index=True)
 
     __mapper_args__ = {
         'polymorphic_identity':'job',
         'polymorphic_on': job_type
     }
 
-    def __init__(self, job_id):
+    __table_args__ = (
+        # job history of a test suite (openqa_investigator)
+        Index('ix_job_history', job_name, version, flavor, valid, job_id),
+    )
+
+    def __init__(self, job_id, job_details=None):
         self.job_id = job_id
-        self.job_details = self.get_job_details()
-        self.job_name = self.get_job_name()
-        self.worker = self.get_job_worker()
-        self.machine = self.get_job_machine()
-        self.version = self.get_job_version()
-        self.flavor = self.get_job_flavor()
+        self.job_details = job_details
+        self.update_from_details()
         self.failures = {}
 
         # must flush at the beginning to avoid recursion
@@ -129,16 +288,14 @@ class JobData(Base):
         local_session.flush()
 
         self.valid = self.is_valid()
-        local_session.commit()
+        if self.valid:
+            TestStats.record_job(self)
+        if not batch_ingest:
+            local_session.commit()
 
     def __hash__(self):
         return hash((self.job_id,))
 
-    @property
-    def clone_id(self):
-        json_data = self.get_job_details()
-        return json_data['job']['clone_id']
-
     @property
     def was_restarted(self):
         return self.clone_id != None
@@ -148,9 +305,9 @@ class JobData(Base):
         self.failures = {}
 
     @staticmethod
-    def get_parent_job_id(job_id):
-        job_details = requests.get(
-            "{}/jobs/{}/details".format(OPENQA_API, job_id)).json()
+    def get_parent_job_id(job_id, job_details=None):
+        if job_details is None:
+            job_details = OpenQA.prefetch_jobs([job_id])[job_id]
         parents = job_details['job']['parents']['Chained']
         if len(parents) == 0:
             return None
@@ -160,9 +317,29 @@ class JobData(Base):
             raise Exception("Implementation does not support more than one "\
                             + "parent job.")
 
+    @staticmethod
+    def columns_from_details(job_details):
+        """Values of the columns holding fields of the job details"""
+        job = job_details['job']
+        return {
+            'job_name': job['test'],
+            'worker': job.get('assigned_worker_id', -1),
+            'machine': job['settings']['MACHINE'],
+            'version': job['settings']['VERSION'],
+            'flavor': job['settings']['FLAVOR'],
+            'result': job['result'],
+            'build': job['settings']['BUILD'],
+            'clone_id': job['clone_id'],
+            't_started': job['t_started'],
+        }
+
+    def update_from_details(self):
+        for column, value in \
+                self.columns_from_details(self.get_job_details()).items():
+            setattr(self, column, value)
+
     def get_job_name(self):
-        json_data = self.get_job_details()
-        return json_data['job']['test']
+        return self.job_name
 
     def get_job_combined_name(self):
         if self.machine == '64bit':
@@ -171,50 +348,80 @@ class JobData(Base):
             return self.job_name + '@' + self.machine
 
     def get_job_build(self):
-        json_data = self.get_job_details()
-        return json_data['job']['settings']['BUILD']
+        return self.build
 
     def get_job_flavor(self):
-        json_data = self.get_job_details()
-        return json_data['job']['settings']['FLAVOR']
+        return self.flavor
 
     def get_job_version(self):
         """Qubes version of job"""
-        json_data = self.get_job_details()
-        return json_data['job']['settings']['VERSION']
+        return self.version
 
     def get_job_start_time(self):
-        json_data = self.get_job_details()
-        return json_data['job']['t_started']
+        return self.t_started
 
     def get_job_worker(self):
-        json_data = self.get_job_details()
-        try:
-            return json_data['job']['assigned_worker_id']
-        except KeyError:
-            return -1
+        return self.worker
 
     def get_job_machine(self):
         """Machine "type": multiple machines can have the same one"""
-        json_data = self.get_job_details()
-        return json_data['job']['settings']['MACHINE']
+        return self.machine
 
     def get_job_details(self):
+        """Job details, possibly only those from a job listing
+
+        Use get_full_job_details() when test results or logs are needed.
+        """
         if self.job_details is None:
-            self.job_details = requests.get(self.get_job_api_url(details=True)).json()
+            self.job_details = prefetched_job_details.pop(self.job_id, None)
+        if self.job_details is None:
+            self.job_details = \
+                OpenQA.prefetch_jobs([self.job_id])[self.job_id]
+        return self.job_details
+
+    def get_full_job_details(self):
+        json_data = self.get_job_details()
+        if 'testresults' not in json_data['job']:
+            logging.debug("fetching full details of job {}".format(
+                self.job_id))
+            self.job_details = \
+                OpenQA.fetch_jobs_details([self.job_id])[self.job_id]
+            self.update_from_details()
         return self.job_details
 
     def is_valid(self):
         # TODO implement method
         return True
 
+    def refresh(self, job_details):
+        """Updates a job that was stored before it finished"""
+        logging.debug("Refreshing {} {}".format(self.job_type, self.job_id))
+        self.job_details = job_details
+        self.update_from_details()
+        self.failures = {}
+        self.valid = self.is_valid()
+        if self.valid:
+            TestStats.record_job(self)
+
+    def is_finished(self):
+        """Whether the job is done, so its logs will not change anymore"""
+        return self.get_job_details()['job']['state'] == 'done'
+
     def get_results(self):
         if self.failures:
             return self.failures
 
-        json_data = self.get_job_details()
+        json_data = self.get_full_job_details()
+
+        # queried before creating any TestFailure, as those are added to
+        # self.test_failures and would get flushed along
+        stored_failures = set(local_session.query(
+                TestFailure.name, TestFailure.title, TestFailure.test_id)
+            .filter(TestFailure.job_id == self.job_id))
 
         failure_list = []
+        # failures to store, by primary key
+        parsed_failures = {}
         for test_group in json_data['job']['testresults']:
             if test_group['result'] == 'passed':
                 continue
@@ -228,21 +435,24 @@ class JobData(Base):
                                           self,
                                           test['num'])
                     if failure.is_valid():
-                        if not TestFailure.exists_in_db(failure):
-                            local_session.add(failure)
-                            local_session.flush()
                         failures.append(failure)
                     elif failure.name == "system_tests":
-                        if not TestFailure.exists_in_db(failure):
-                            local_session.add(failure)
-                            local_session.flush()
                         delayed_failures.append(failure)
+                    else:
+                        continue
+                    parsed_failures.setdefault(
+                        (failure.name, failure.title, failure.test_id),
+                        failure)
 
             if not failures:
                 failure_list.extend(delayed_failures)
             else:
                 failure_list.extend(failures)
 
+        local_session.add_all(
+            failure for key, failure in parsed_failures.items()
+            if key not in stored_failures)
+
         self.failures[self.get_job_combined_name()] = failure_list
 
         return self.failures
@@ -294,6 +504,9 @@ class JobData(Base):
         url = "{}/tests/{}#".format(OPENQA_URL, self.job_id)
         return url
 
+    def get_ulog_url(self, log):
+        return "{}/tests/{}/file/{}".format(OPENQA_URL, self.job_id, log)
+
     def get_job_api_url(self, details, job_id=None):
         if not job_id:
             job_id = self.job_id
@@ -318,9 +531,7 @@ class JobData(Base):
         return self.get_update_issues()
 
     def get_pull_requests(self):
-        if self.job_details is None:
-            self.job_details = requests.get(self.get_job_api_url(details=True)).json()
-        json_data = self.job_details
+        json_data = self.get_job_details()
 
         if 'PULL_REQUESTS' not in json_data['job']['settings']:
             return []
@@ -332,17 +543,29 @@ class JobData(Base):
         return sorted(pr_list)
 
     def get_performance_data(self):
+        """Performance test results, parsed once and then kept in the DB"""
+        if self.performance_results:
+            return {perf.name: perf.value
+                    for perf in self.performance_results}
+
+        result = self.parse_performance_data()
+        if self.is_finished():
+            for position, (name, value) in enumerate(result.items()):
+                local_session.add(PerformanceResult(
+                    self, position, name, value))
+            local_session.flush()
+        return result
+
+    def parse_performance_data(self):
         # this should return numbers, not strings
         result = {}
 
-        json_data = self.get_job_details()
+        json_data = self.get_full_job_details()
 
         for log in json_data['job']['ulogs']:
             if log == 'system_tests-perf_test_results.txt':
-                log_file = "{}/tests/{}/file/{}".format(
-                    OPENQA_URL, self.job_id, log)
-
-                r = requests.get(log_file)
+                r = http_cache.get(self.get_ulog_url(log),
+                                   immutable=self.is_finished())
                 if not r.ok:
                     continue
                 perf_data = r.text
@@ -406,15 +629,15 @@ class JobData(Base):
             return []
 
         test_templates = test_templates.split(" ")
+        json_data = self.get_full_job_details()
 
         all_templates = []
 
         for log in json_data['job']['ulogs']:
             if log == 'update-template-versions.txt' or log == 'update2-template-versions.txt':
-                log_file = "{}/tests/{}/file/{}".format(
-                    OPENQA_URL, self.job_id, log)
-
-                template_list = requests.get(log_file).text.split('\n')
+                template_list = http_cache.get(
+                    self.get_ulog_url(log),
+                    immutable=self.is_finished()).text.split('\n')
                 for line in template_list:
                     all_templates.append(
                         re.sub(r"(.*)-([^-]*-[^-]*)(\.noarch)?", r"\1 \2", line))
@@ -427,7 +650,7 @@ class JobData(Base):
                         "qubes-template-{} ".format(template_name)):
                     templates.append(package_name)
 
-        repo = GitHubRepo("updates-status")
+        repo = get_updates_status_repo()
         issue_urls = []
 
         for t in templates:
@@ -438,49 +661,70 @@ class JobData(Base):
 
         return issue_urls
 
-    def get_update_issues(self):
-        json_data = self.get_job_details()
+    def get_package_manifest(self):
+        """Packages installed in the job, parsed once and then kept in the DB
 
-        logs_to_check = []
+        :return list: PackageManifestEntry objects, of all *packages.txt logs
+        """
+        if self.package_manifest:
+            return self.package_manifest
+
+        json_data = self.get_full_job_details()
 
+        rows = {}
         for log in json_data['job']['ulogs']:
-            if log.endswith("packages.txt"):
-                logs_to_check.append("{}/tests/{}/file/{}".format(
-                    OPENQA_URL, self.job_id, log))
+            if not log.endswith("packages.txt"):
+                continue
+            r = http_cache.get(self.get_ulog_url(log),
+                               immutable=self.is_finished())
+            for record in package_parser.parse_packages(r.text):
+                version, release = record.get_manifest_version()
+                rows.setdefault((log, record.name, version, release or ''),
+                                record.format)
+
+        manifest = [PackageManifestEntry(self.job_id, *row,
+                                         package_format=package_format)
+                    for row, package_format in rows.items()]
+        if self.is_finished():
+            local_session.add_all(manifest)
+            self.package_manifest.extend(manifest)
+            local_session.flush()
+        return manifest
 
+    def get_update_issues(self):
         packages = set()
-
-        for log_url in logs_to_check:
-            log = requests.get(log_url).text.split('\n')
-            for line in log:
-                package = PackageName(line)
-                if package.package_name:
-                    packages.add(package)
+        for entry in self.get_package_manifest():
+            package = PackageName.from_manifest_entry(entry)
+            if package.package_name:
+                packages.add(package)
 
         # Validate if there are no copies of the same package with different
         # versions
-        for package1 in packages:
-            for package2 in packages:
-                if package1.package_name == package2.package_name and \
-                        package1.version != package2.version:
-                    print(
-                        "Warning: found package {} in two different versions: "
-                        "{} and {}".format(
-                            package1.package_name, package1.version,
-                            package2.version))
-
-        repo = GitHubRepo("updates-status")
+        package_versions = {}
+        for package in packages:
+            package_versions.setdefault(
+                package.package_name, set()).add(package.version)
+        for package_name, versions in package_versions.items():
+            for version1, version2 in itertools.combinations(
+                    sorted(versions), 2):
+                print(
+                    "Warning: found package {} in two different versions: "
+                    "{} and {}".format(package_name, version1, version2))
+
+        repo = get_updates_status_repo()
         issue_urls = []
 
         for p in packages:
+            version, release = package_parser.get_title_version(
+                p.version, p.release, p.package_format)
             for name in p.component_names:
                 issue_name = "{} v{}-{} (r{})".format(
-                    name, p.version, p.release,
+                    name, version, release,
                     self.get_job_version())
                 url = repo.get_issues_by_name(issue_name)
                 if url is None:
                     issue_name = "{} v{} (r{})".format(
-                        name, p.version,
+                        name, version,
                         self.get_job_version())
                     url = repo.get_issues_by_name(issue_name)
                 if url:
@@ -490,10 +734,8 @@ class JobData(Base):
         return issue_urls
 
     def get_notification_issue(self, repo_name=None):
-        json_data = self.get_job_details()
-
         issue_urls = []
-        if json_data['job']['settings']['FLAVOR'] == 'qubes-whonix':
+        if self.flavor == 'qubes-whonix':
             issue_urls.append('{}/{}/issues/create-or-update'.format(
                               GITHUB_BASE_PREFIX, WHONIX_NOTIFICATION_REPO))
 
@@ -511,14 +753,23 @@ class OrphanJob(JobData):
 
     job_id = Column(ForeignKey('job.job_id'), primary_key=True)
 
-    def __init__(self, job_id):
-        super().__init__(job_id)
+    def __init__(self, job_id, job_details=None):
+        super().__init__(job_id, job_details=job_details)
 
         # make sure children exist
-        for child_id in self.get_children_ids():
-            child = local_session.get(ChildJob, { "job_id": child_id })
-            if child is None:
-                child = ChildJob(child_id, parent_job=self)
+        missing_children_ids = [
+            child_id for child_id in self.get_children_ids()
+            if local_session.get(ChildJob, { "job_id": child_id }) is None]
+        children_details = {
+            child_id: prefetched_job_details.pop(child_id)
+            for child_id in missing_children_ids
+            if child_id in prefetched_job_details}
+        children_details.update(OpenQA.prefetch_jobs(
+            [child_id for child_id in missing_children_ids
+             if child_id not in children_details]))
+        for child_id in missing_children_ids:
+            ChildJob(child_id, parent_job=self,
+                     job_details=children_details[child_id])
 
 
 class ChildJob(JobData):
@@ -528,14 +779,15 @@ class ChildJob(JobData):
     __mapper_args__ = { 'polymorphic_identity':'child_job' }
 
     job_id = Column(Integer, ForeignKey('job.job_id'), primary_key=True)
-    parent_job_id = Column(Integer, ForeignKey(OrphanJob.job_id))
+    parent_job_id = Column(Integer, ForeignKey(OrphanJob.job_id), index=True)
     parent_job = relationship(
         OrphanJob, backref=backref("child_job", cascade="delete"),
         foreign_keys=[parent_job_id]
     )
 
-    def __init__(self, job_id, parent_job_id=None, parent_job=None):
-        super().__init__(job_id)
+    def __init__(self, job_id, parent_job_id=None, parent_job=None,
+                 job_details=None):
+        super().__init__(job_id, job_details=job_details)
 
         if parent_job:
             self.parent_job = parent_job
@@ -549,13 +801,13 @@ class ChildJob(JobData):
             raise Exception("Must provide a parent_job_id or a parent_job")
 
     def is_valid(self):
-        json_data = self.get_job_details()
-        job_result = json_data['job']['result']
+        job_result = self.result
         if job_result == "passed":
             return True
         elif job_result == "failed":
             has_failures = len(self.get_results()[self.get_job_combined_name()]) > 0
             all_test_groups_ran = True
+            json_data = self.get_full_job_details()
 
             for test_group in json_data['job']['testresults']:
                 if test_group['result'] == 'none':
@@ -569,6 +821,312 @@ class ChildJob(JobData):
             return False
 
 
+class PerformanceResult(Base):
+    __tablename__ = 'performance_results'
+
+    job_id = Column(Integer, ForeignKey('job.job_id'), primary_key=True)
+    job = relationship(
+        JobData,
+        backref=backref("performance_results", cascade="delete",
+                        order_by="PerformanceResult.position")
+    )
+    name = Column(String, primary_key=True)
+    position = Column(Integer)
+    value = Column(Float)
+
+    def __init__(self, job, position, name, value):
+        self.job = job
+        self.job_id = job.job_id
+        self.position = position
+        self.name = name
+        self.value = value
+
+
+class SyncState(Base):
+    """How far openqa_sync got, per synchronized job stream"""
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)
+    last_job_id = Column(Integer)
+
+
+class PendingJob(Base):
+    """Job openqa_sync went past before it finished, to be ingested later"""
+    __tablename__ = 'sync_pending_job'
+
+    name = Column(String, primary_key=True)
+    job_id = Column(Integer, primary_key=True)
+    # time.time() of the sync that found it unfinished
+    first_seen = Column(Float)
+
+
+class MirroredIssue(Base):
+    """Issue (or pull request) of a GitHub repo, as last synced"""
+    __tablename__ = 'github_issue'
+
+    owner = Column(String, primary_key=True)
+    repo = Column(String, primary_key=True)
+    number = Column(Integer, primary_key=True)
+    title = Column(String)
+    html_url = Column(String)
+    state = Column(String)
+    updated_at = Column(String)
+
+    __table_args__ = (
+        # issues looked up by title
+        Index('ix_github_issue_title', owner, repo, title, state),
+    )
+
+
+class IssueMirrorState(Base):
+    """How far the issue mirror of a GitHub repo got"""
+    __tablename__ = 'github_issue_mirror'
+
+    owner = Column(String, primary_key=True)
+    repo = Column(String, primary_key=True)
+    # latest update time of the mirrored issues, where the next sync starts
+    updated_until = Column(String)
+    # time.time() of the last sync
+    synced_at = Column(Float)
+    # of the listing made by the last sync, repeated if nothing changed
+    listing_params = Column(JSON)
+    etag = Column(String)
+
+
+class IssueMirror:
+    """Issues of a GitHub repo, kept in the local DB and looked up by title
+
+    The first sync lists the open issues, the next ones only those updated
+    since (open or not), with a conditional request: when nothing changed,
+    GitHub answers 304 without counting it in the rate limit. A mirror
+    synced less than ISSUE_MIRROR_MAX_AGE seconds ago is used as it is.
+    """
+
+    def __init__(self, repo, max_age=ISSUE_MIRROR_MAX_AGE):
+        """
+        :param GitHubRepo repo: mirrored repo
+        """
+        self.repo = repo
+        self.max_age = max_age
+
+    def get_state(self):
+        state = local_session.get(
+            IssueMirrorState, (self.repo.owner, self.repo.repo))
+        if state is None:
+            state = IssueMirrorState(owner=self.repo.owner,
+                                     repo=self.repo.repo)
+            local_session.add(state)
+        return state
+
+    def sync(self):
+        state = self.get_state()
+        if state.synced_at is not None and \
+                time.time() - state.synced_at < self.max_age:
+            return
+
+        if state.updated_until is None:
+            params = {'state': 'open', 'per_page': 100}
+        else:
+            params = {'state': 'all', 'since': state.updated_until,
+                      'sort': 'updated', 'direction': 'asc', 'per_page': 100}
+        etag = state.etag if state.listing_params == params else None
+        synced_at = time.time()
+        try:
+            issues, etag = self.repo.list_issues(params, etag)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.warning("Failed to sync issues of {}/{}, using them as "
+                            "they were: {}".format(
+                                self.repo.owner, self.repo.repo, e))
+            return
+
+        # in a savepoint, not to commit the jobs of an ingest_batch() early
+        with local_session.begin_nested():
+            if issues:
+                statement = sqlite_insert(MirroredIssue)
+                local_session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=[
+                            column.name for column
+                            in MirroredIssue.__table__.primary_key],
+                        set_={column: getattr(statement.excluded, column)
+                              for column in ('title', 'html_url', 'state',
+                                             'updated_at')}),
+                    [{'owner': self.repo.owner, 'repo': self.repo.repo,
+                      'number': issue['number'], 'title': issue['title'],
+                      'html_url': issue['html_url'],
+                      'state': issue['state'],
+                      'updated_at': issue['updated_at']}
+                     for issue in issues])
+                state.updated_until = max(
+                    [issue['updated_at'] for issue in issues] +
+                    [state.updated_until or ""])
+            state.synced_at = synced_at
+            state.listing_params = params
+            state.etag = etag
+        if not batch_ingest:
+            local_session.commit()
+
+    def get_issue_url(self, title):
+        """URL of the newest open issue with the given title, None if none"""
+        self.sync()
+        return local_session.query(MirroredIssue.html_url)\
+            .filter_by(owner=self.repo.owner, repo=self.repo.repo,
+                       title=title, state='open')\
+            .order_by(MirroredIssue.number.desc())\
+            .limit(1).scalar()
+
+
+def get_updates_status_repo():
+    """The updates-status repo, its issues looked up in the local mirror"""
+    global updates_status_repo
+    if updates_status_repo is None:
+        updates_status_repo = GitHubRepo(UPDATES_STATUS_REPO)
+        updates_status_repo.issue_mirror = IssueMirror(updates_status_repo)
+    return updates_status_repo
+
+
+class PackageManifestEntry(Base):
+    """Package installed in a job, as listed in one of its *packages.txt logs"""
+    __tablename__ = 'package_manifest'
+
+    job_id = Column(Integer, ForeignKey('job.job_id'), primary_key=True)
+    job = relationship(
+        JobData,
+        backref=backref("package_manifest", cascade="delete")
+    )
+    log = Column(String, primary_key=True)
+    # name in the log, before mapping to a component
+    raw_name = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    # empty if the package version has no release part
+    release = Column(String, primary_key=True)
+    # package_parser.DEB or RPM
+    package_format = Column(String)
+
+    def __init__(self, job_id, log, raw_name, version, release,
+                 package_format=None):
+        self.job_id = job_id
+        self.log = log
+        self.raw_name = raw_name
+        self.version = version
+        self.release = release
+        self.package_format = package_format
+
+    def get_full_version(self):
+        if self.release:
+            return "{}-{}".format(self.version, self.release)
+        return self.version
+
+
+class JobLineage(Base):
+    """Concluded job in the history of a test suite
+
+    Filled from job listings. Which ranges of job ids are known to be
+    complete is recorded separately, see LineageCoverage.
+    """
+    __tablename__ = 'job_lineage'
+
+    test = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    flavor = Column(String, primary_key=True)
+    machine = Column(String, primary_key=True)
+    job_id = Column(Integer, primary_key=True)
+    result = Column(String)
+    # None until the job is looked at
+    valid = Column(Boolean)
+
+    @staticmethod
+    def record(listed_jobs):
+        """Adds concluded jobs of a listing, keeping their known validity"""
+        rows = [{
+            'test': job['test'],
+            'version': job['settings']['VERSION'],
+            'flavor': job['settings']['FLAVOR'],
+            'machine': job['settings']['MACHINE'],
+            'job_id': job['id'],
+            'result': job['result'],
+        } for job in listed_jobs if job['result'] in CONCLUDED_RESULTS]
+        if not rows:
+            return
+        statement = sqlite_insert(JobLineage)
+        local_session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[column.name for column
+                                in JobLineage.__table__.primary_key],
+                set_={'result': statement.excluded.result}),
+            rows)
+
+    @staticmethod
+    def get_job_ids(lineage, low_job_id, high_job_id):
+        """Ids of recorded jobs in the given range, newest first
+
+        :param dict lineage: test, version, flavor and machine
+        """
+        return local_session.scalars(
+            sqlalchemy.select(JobLineage.job_id)
+            .filter_by(**lineage)
+            .where(JobLineage.job_id.between(low_job_id, high_job_id))
+            .order_by(JobLineage.job_id.desc())).all()
+
+
+class LineageCoverage(Base):
+    """Range of job ids in which all concluded jobs of a test suite are known
+
+    low_job_id is 0 when the range reaches the beginning of the history.
+    """
+    __tablename__ = 'job_lineage_coverage'
+
+    test = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    flavor = Column(String, primary_key=True)
+    machine = Column(String, primary_key=True)
+    low_job_id = Column(Integer, primary_key=True)
+    high_job_id = Column(Integer)
+
+    @staticmethod
+    def find(lineage, job_id):
+        """Range containing the job id, if any"""
+        return local_session.query(LineageCoverage)\
+            .filter_by(**lineage)\
+            .filter(LineageCoverage.low_job_id <= job_id)\
+            .filter(LineageCoverage.high_job_id >= job_id)\
+            .first()
+
+    @staticmethod
+    def add(lineage, low_job_id, high_job_id):
+        """Records a range, merging it with overlapping or adjacent ones"""
+        adjacent_ranges = local_session.query(LineageCoverage)\
+            .filter_by(**lineage)\
+            .filter(LineageCoverage.low_job_id <= high_job_id + 1)\
+            .filter(LineageCoverage.high_job_id >= low_job_id - 1)\
+            .all()
+        for coverage in adjacent_ranges:
+            low_job_id = min(low_job_id, coverage.low_job_id)
+            high_job_id = max(high_job_id, coverage.high_job_id)
+            local_session.delete(coverage)
+        local_session.flush()
+        local_session.add(LineageCoverage(
+            low_job_id=low_job_id, high_job_id=high_job_id, **lineage))
+
+    @staticmethod
+    def add_listing(lineage, listed_jobs, before, limit):
+        """Records the range covered by a listing of the test suite jobs
+
+        :param list listed_jobs: jobs listed with the given before= and
+            limit= parameters, and no result filter
+        """
+        if len(listed_jobs) < limit:
+            low_job_id = 0
+        else:
+            low_job_id = min(job['id'] for job in listed_jobs)
+        # jobs still running may conclude later, the range ends before them
+        high_job_id = min(
+            [before - 1] + [job['id'] - 1 for job in listed_jobs
+                            if job['state'] not in ('done', 'cancelled')])
+        if low_job_id <= high_job_id:
+            LineageCoverage.add(lineage, low_job_id, high_job_id)
+
+
 class TestFailureReason(enum.Enum):
     SKIPPED = "skipped"
     ERROR = "error"
@@ -595,12 +1153,24 @@ class TestFailure(Base):
     test_id = Column(Integer, primary_key=True)
     fail_reason = Column(Enum(TestFailureReason))
     relevant_error = Column(String)
-    fail_error = Column(String)
-    cleanup_error = Column(String)
+    # relevant error without the parts varying between runs, see
+    # lib/error_signatures.py
+    error_signature = Column(String)
+    # full error texts, loaded from test_failure_text only when used
+    text = relationship("TestFailureText", uselist=False,
+                        cascade="all, delete-orphan")
+    has_cleanup_error = Column(Boolean)
     timed_out = Column(Boolean)
     has_description = Column(Boolean)
     template = Column(String(50))
 
+    __table_args__ = (
+        # failures of given jobs (instability analysis, reports)
+        Index('ix_test_failures_job', job_id),
+        # history of a single test
+        Index('ix_test_failures_test', name, title, test_id, job_id),
+    )
+
     def __init__(self, name, title, description, job, test_id):
         self.name = name
         self.title = title
@@ -610,8 +1180,8 @@ class TestFailure(Base):
 
         self.fail_reason = TestFailureReason.UNKNOWN
         self.relevant_error = None
-        self.fail_error = None
-        self.cleanup_error = None
+        self.error_signature = None
+        self.has_cleanup_error = False
         self.timed_out = False
         self.template = self.guess_template()
 
@@ -627,17 +1197,26 @@ class TestFailure(Base):
         # a past failure that was fixed now
         self.fixed = False
 
-    @staticmethod
-    def exists_in_db(test_failure):
-        return local_session.get(TestFailure,
-                {"job_id": test_failure.job_id,
-                 "name": test_failure.name,
-                 "title": test_failure.title,
-                 "test_id": test_failure.test_id})
+    @property
+    def fail_error(self):
+        return self.text.fail_error if self.text else None
+
+    @property
+    def cleanup_error(self):
+        return self.text.cleanup_error if self.text else None
+
+    def set_errors(self, fail_error, cleanup_error):
+        self.has_cleanup_error = bool(cleanup_error)
+        if fail_error or cleanup_error:
+            self.text = TestFailureText(fail_error, cleanup_error)
+
+    def matches_error(self, error_regex):
+        """Whether the fail or cleanup error matches a compiled regex"""
+        return any(error and error_regex.search(error)
+                   for error in (self.fail_error, self.cleanup_error))
 
     def get_test_url(self):
-        return "{}/tests/{}#step/{}/{}".format(
-            OPENQA_URL, self.job_id, self.name, self.test_id)
+        return get_test_url(self.job_id, self.name, self.test_id)
 
     def is_valid(self):
         if self.name != "system_tests":
@@ -661,97 +1240,15 @@ class TestFailure(Base):
             return "default"
 
     def parse_description(self, description):
-
-        def get_relevant_error(max_chars=70):
-            """Returns the error line(s) that best summarises the error (heuristic)
-
-            The idea is to find the last traceback (when chained exceptions) and
-            return the last line. An example bellow shows the relevant line as -->
-
-            >    # test_003_cleanup_destroyed
-            >    # error:
-            >
-            >    Traceback (most recent call last):
-            >    File "/usr/lib/python3.8/site-packages/qubes/tests/integ/dispvm.py", line 94, in test_003_cleanup_destroyed
-            >        self.loop.run_until_complete(asyncio.wait_for(p.wait(), timeout))
-            >    File "/usr/lib64/python3.8/asyncio/base_events.py", line 616, in run_until_complete
-            >        return future.result()
-            >    File "/usr/lib64/python3.8/asyncio/tasks.py", line 501, in wait_for
-            >        raise exceptions.TimeoutError()
-            --> asyncio.exceptions.TimeoutError
-            >
-            >    # system-out:
-
-            :param int max_chars: maximum number of characters in result
-            """
-
-            # find relevant line(s)
-            try:
-                i = len(lines) - 1
-                while re.match(r"^\s", lines[i]): # non whitespace-starting
-                    i -= 1
-                while not re.match(r"^\s", lines[i]): # until it finds whitespace
-                    i -= 1
-
-                relev_line_prev = lines[i].strip()
-                relev_line = lines[i+1].strip()
-
-                # show relevant line (truncated if needed) and the previous one if
-                # there is enough space.
-                if len(relev_line) < max_chars - 30:
-                    max_len_prev_line = max_chars -4 -len(relev_line)
-                    return "{}... {}".format(
-                        relev_line_prev[:max_len_prev_line],
-                        relev_line)
-                if len(relev_line) <= max_chars:
-                    return relev_line
-                else:
-                    return relev_line[:max_chars-len("...")] + "..."
-            except IndexError:
-                logging.warning("Failed to extract error from: " + "\n".join(lines))
-                # just get the last line non-empty
-                line = [l for l in lines if l][-1]
-                if len(line) <= max_chars:
-                    return line
-                return line[:max_chars-len("...")] + "..."
-
-
-        max_chars=70
         if not self.has_description:
             return
-        else:
-            description = description.strip()
-
-        if "timed out" in description:
-            self.timed_out = True
-
-        # non-standard error messages / test descriptions
-        if "# system-out:" not in description:
-            if "# wait_serial expected:" in description:
-                self.fail_reason = TestFailureReason.WAIT_SERIAL
-            if "# Test died: " in description:
-                self.fail_reason = TestFailureReason.TEST_DIED
-
-            first_line = description.split("\n")[0]
-            self.relevant_error = first_line.strip()[:max_chars-3] + "..."
-            self.fail_error = description
-            return
-
-        (self.fail_error, self.cleanup_error)=description.split("# system-out:")
-        lines = self.fail_error.split("\n")
 
-        # test case status https://github.com/os-autoinst/openQA/blob/dae9f4e5/lib/OpenQA/Parser/Format/JUnit.pm#L84
-        if "# error:" in lines[1]:
-            self.fail_reason = TestFailureReason.ERROR
-        elif "# failure:" in lines[1]:
-            self.fail_reason = TestFailureReason.FAILURE
-        elif "# skipped:" in lines[1]:
-            self.fail_reason = TestFailureReason.SKIPPED
-            return
-        else:
-            self.fail_reason = TestFailureReason.UNKNOWN
-            return
-        self.relevant_error = get_relevant_error(max_chars=max_chars)
+        parsed = junit_parser.parse_description(description)
+        self.fail_reason = TestFailureReason(parsed.reason)
+        self.relevant_error = parsed.relevant_error
+        self.error_signature = error_signatures.normalize(parsed.relevant_error)
+        self.set_errors(parsed.fail_error, parsed.cleanup_error)
+        self.timed_out = parsed.timed_out
 
     def __str__(self):
         if not self.title:
@@ -762,11 +1259,11 @@ class TestFailure(Base):
         output = "{}: [{}]({})".format(self.name, title,
                                        self.get_test_url())
 
-        if self.timed_out and self.cleanup_error:
+        if self.timed_out and self.has_cleanup_error:
             output += " ({} + timeout + cleanup)".format(self.fail_reason.value)
         elif self.timed_out:
             output += " ({} + timed out)".format(self.fail_reason.value)
-        elif self.cleanup_error:
+        elif self.has_cleanup_error:
             output += " ({} + cleanup)".format(self.fail_reason.value)
         else:
             output += " ({})".format(self.fail_reason.value)
@@ -784,28 +1281,319 @@ class TestFailure(Base):
                 return self.title == getattr(other, "title")
         return False
 
+    def get_key(self):
+        return get_failure_key(self)
+
+
+class TestFailureText(Base):
+    """Full error texts of a TestFailure, compressed
+
+    Kept apart so that queries on test failures (instability analysis,
+    reports) do not read them.
+    """
+    __tablename__ = 'test_failure_text'
+
+    name = Column(String, primary_key=True)
+    title = Column(String, primary_key=True)
+    job_id = Column(Integer, primary_key=True)
+    test_id = Column(Integer, primary_key=True)
+    fail_error = Column(CompressedText)
+    cleanup_error = Column(CompressedText)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [name, title, job_id, test_id],
+            [TestFailure.name, TestFailure.title, TestFailure.job_id,
+             TestFailure.test_id]),
+    )
+
+    def __init__(self, fail_error, cleanup_error):
+        self.fail_error = fail_error
+        self.cleanup_error = cleanup_error
+
+
+class SuiteHistory(Base):
+    """Latest valid jobs of a test suite stored in the cache
+
+    Window of the flakiness statistics of its tests, see TestStats.
+    """
+    __tablename__ = 'suite_history'
+
+    job_name = Column(String, primary_key=True)
+    machine = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    flavor = Column(String, primary_key=True)
+    # ascending, at most STATS_WINDOW
+    job_ids = Column(JSON)
+
+    def __init__(self, job_name, machine, version, flavor):
+        self.job_name = job_name
+        self.machine = machine
+        self.version = version
+        self.flavor = flavor
+        self.job_ids = []
+
+    @staticmethod
+    def get_key(job, flavor_override=None):
+        return {
+            'job_name': job.job_name,
+            'machine': job.machine,
+            'version': job.version,
+            'flavor': flavor_override or job.flavor,
+        }
+
+    def get_job_ids(self, before, n):
+        """Ids of the last n jobs of the window older than the given job id"""
+        job_ids = [job_id for job_id in self.job_ids if job_id < before]
+        return job_ids[-n:] if n else []
+
+
+class PastFailure(collections.namedtuple(
+        'PastFailure', 'name title test_id job_id relevant_error')):
+    """Failure of a test in a past job, as kept in TestStats"""
+    __slots__ = ()
+
+    @property
+    def error_signature(self):
+        return error_signatures.normalize(self.relevant_error)
+
+    def get_test_url(self):
+        return get_test_url(self.job_id, self.name, self.test_id)
+
+
+class TestStats(Base):
+    """Flakiness statistics of a test, over the window of its test suite
+
+    Maintained as valid jobs are stored (see record_job()) rather than
+    computed when needed: the failures of the test within the latest
+    STATS_WINDOW jobs of the suite (SuiteHistory), from which fail and pass
+    counts and distinct errors over any shorter window follow.
+    """
+    __tablename__ = 'test_stats'
+
+    job_name = Column(String, primary_key=True)
+    machine = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    flavor = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    title = Column(String, primary_key=True)
+    test_id = Column(Integer, primary_key=True)
+    # [job id, relevant error] pairs, ascending by job id
+    failures = Column(JSON)
+    # start time of the latest job the test failed in
+    last_seen = Column(String)
+
+    def __init__(self, job_name, machine, version, flavor, name, title,
+                 test_id):
+        self.job_name = job_name
+        self.machine = machine
+        self.version = version
+        self.flavor = flavor
+        self.name = name
+        self.title = title
+        self.test_id = test_id
+        self.failures = []
+        self.last_seen = None
+
+    @staticmethod
+    def record_job(job):
+        """Adds a valid job to the statistics of its test suite"""
+        key = SuiteHistory.get_key(job)
+        history = local_session.get(SuiteHistory, key)
+        if history is None:
+            history = SuiteHistory(**key)
+            local_session.add(history)
+        if job.job_id in history.job_ids:
+            return
+        job_ids = sorted(history.job_ids + [job.job_id])[-STATS_WINDOW:]
+        if job.job_id not in job_ids:
+            # older than the whole window
+            return
+        history.job_ids = job_ids
+
+        failures = local_session.query(
+                TestFailure.name, TestFailure.title, TestFailure.test_id,
+                TestFailure.relevant_error)\
+            .filter(TestFailure.job_id == job.job_id).all()
+        if not failures:
+            return
+        tests = {
+            (stats.name, stats.title, stats.test_id): stats
+            for stats in local_session.query(TestStats).filter_by(**key)
+            .filter(tuple_(TestStats.name, TestStats.title,
+                           TestStats.test_id).in_(
+                [(name, title, test_id)
+                 for name, title, test_id, _ in failures]))}
+        for name, title, test_id, relevant_error in failures:
+            stats = tests.get((name, title, test_id))
+            if stats is None:
+                stats = TestStats(name=name, title=title, test_id=test_id,
+                                  **key)
+                local_session.add(stats)
+            stats.add_failure(job, relevant_error, job_ids[0])
+
+    def add_failure(self, job, relevant_error, oldest_job_id):
+        failures = [
+            failure for failure in self.failures
+            if failure[0] >= oldest_job_id]
+        failures.append([job.job_id, relevant_error])
+        failures.sort()
+        if failures[-1][0] == job.job_id:
+            self.last_seen = job.get_job_start_time()
+        self.failures = failures
+
+    def get_failures(self, job_ids):
+        """Failures of the test in the given jobs
+
+        :return list: PastFailure objects, ascending by job id
+        """
+        job_ids = set(job_ids)
+        return [
+            PastFailure(self.name, self.title, self.test_id, job_id,
+                        relevant_error)
+            for job_id, relevant_error in self.failures
+            if job_id in job_ids]
+
 
 class OpenQA:
     @staticmethod
-    def get_job(job_id):
+    def get_job(job_id, job_details=None):
         logging.debug("getting job {} ".format(job_id))
         job = local_session.get(JobData, {"job_id": job_id})
         if job is None:
-            parent_job_id = JobData.get_parent_job_id(job_id)
+            if job_details is None:
+                job_details = prefetched_job_details.pop(job_id, None)
+            if job_details is None:
+                job_details = OpenQA.prefetch_jobs([job_id])[job_id]
+            parent_job_id = JobData.get_parent_job_id(job_id, job_details)
             if parent_job_id is None:
                 logging.debug("creating orphan job for " + str(job_id))
-                job = OrphanJob(job_id)
+                job = OrphanJob(job_id, job_details=job_details)
             else:
                 logging.debug("creating child job for " + str(job_id))
-                job = ChildJob(job_id, parent_job_id)
+                job = ChildJob(job_id, parent_job_id, job_details=job_details)
         return job
 
-    def get_jobs(job_ids):
+    @staticmethod
+    def get_jobs(job_ids, full_details=False):
+        """Obtains jobs, creating those missing from the local DB
+
+        :param list job_ids: ids of jobs to get
+        :param bool full_details: download full details (test results, logs)
+            upfront for all created jobs, not only for those needing it
+        """
+        missing_job_ids = [
+            job_id for job_id in job_ids
+            if local_session.get(JobData, {"job_id": job_id}) is None]
+        prefetched_job_details.update(
+            OpenQA.prefetch_jobs(missing_job_ids, full_details=full_details))
+
         jobs = []
+        try:
+            with ingest_batch():
+                for job_id in job_ids:
+                    jobs += [OpenQA.get_job(job_id)]
+        finally:
+            # details of jobs created as children of an earlier job are
+            # picked from here too, drop whatever was left unused
+            prefetched_job_details.clear()
+        return jobs
+
+    @staticmethod
+    def prefetch_jobs(job_ids, full_details=False):
+        """Obtains details needed to create JobData for the given jobs
+
+        Settings and dependencies of all the jobs come from job listings,
+        in as few requests as possible. Full details are downloaded only
+        when asked for, or for failed jobs since telling whether those are
+        valid requires their test results.
+
+        :param list job_ids: ids of jobs to get details of
+        :param bool full_details: download full details for all jobs
+        :return dict: job id -> job details
+        """
+        listed_jobs = OpenQA.get_listed_jobs(job_ids)
+
+        result = {}
+        full_details_ids = []
         for job_id in job_ids:
-            jobs += [OpenQA.get_job(job_id)]
+            job = listed_jobs.get(job_id)
+            if full_details or job is None or job['result'] == 'failed' \
+                    or 'parents' not in job or 'children' not in job:
+                full_details_ids.append(job_id)
+            else:
+                result[job_id] = {'job': job}
+        result.update(OpenQA.fetch_jobs_details(full_details_ids))
+        return result
+
+    @staticmethod
+    def fetch_jobs_details(job_ids):
+        """Downloads details of the given jobs, up to fetch_workers at once
+
+        Only the download runs in worker threads, the returned details are
+        meant to be turned into JobData objects by the caller, since
+        local_session must only be used from a single thread.
+
+        :param list job_ids: ids of jobs to download
+        :return dict: job id -> job details
+        """
+        def fetch(job_id):
+            return http_cache.get(
+                "{}/jobs/{}/details".format(OPENQA_API, job_id)).json()
+
+        job_ids = list(dict.fromkeys(job_ids))
+        if fetch_workers <= 1 or len(job_ids) <= 1:
+            return {job_id: fetch(job_id) for job_id in job_ids}
+
+        logging.debug("fetching details of {} jobs".format(len(job_ids)))
+        with ThreadPoolExecutor(
+                max_workers=min(fetch_workers, len(job_ids))) as executor:
+            return dict(zip(job_ids, executor.map(fetch, job_ids)))
+
+    @staticmethod
+    def list_jobs(params):
+        """Queries the openQA job listing, remembering the finished jobs
+
+        :param list params: query parameters, as 'key=value' strings
+        :return list: jobs, as returned by openQA
+        """
+        if params:
+            params_string = '?' + "&".join(params)
+        else:
+            params_string = ''
+
+        response = http_client.get(OPENQA_API + '/jobs' + params_string)
+        response.raise_for_status()
+        data = response.json()
+
+        jobs = data.get('jobs', [])
+        job_listing_cache.add(jobs)
+        JobLineage.record(jobs)
         return jobs
 
+    @staticmethod
+    def get_listed_jobs(job_ids):
+        """Gets listing entries of the given jobs
+
+        Jobs not seen in an earlier listing are queried by their ids.
+
+        :return dict: job id -> job, for jobs known to openQA
+        """
+        listed_jobs = {}
+        missing_job_ids = []
+        for job_id in dict.fromkeys(job_ids):
+            job = job_listing_cache.get(job_id)
+            if job is None:
+                missing_job_ids.append(job_id)
+            else:
+                listed_jobs[job_id] = job
+        for i in range(0, len(missing_job_ids), JOB_LISTING_CHUNK):
+            chunk = missing_job_ids[i:i + JOB_LISTING_CHUNK]
+            for job in OpenQA.list_jobs(['ids={}'.format(
+                    ','.join(str(job_id) for job_id in chunk))]):
+                listed_jobs[job['id']] = job
+        return listed_jobs
+
     @staticmethod
     def get_latest_job_id(job_type='system_tests_update', build=None,
                           version=None, flavor=None, machine=None):
@@ -834,22 +1622,9 @@ class OpenQA:
         if machine:
             params.append('machine={}'.format(machine))
 
-        if params:
-            params_string = '?' + "&".join(params)
-        else:
-            params_string = ''
-
-        data = requests.get(
-            OPENQA_API + '/jobs' + params_string).json()
-
         jobs = []
-
-        try:
-            for job in data['jobs']:
-                jobs.append(job['id'])
-        except KeyError:
-            # no jobs found
-            pass
+        for job in OpenQA.list_jobs(params):
+            jobs.append(job['id'])
         return sorted(jobs)
 
     @staticmethod
@@ -859,25 +1634,12 @@ class OpenQA:
         params.append('version={}'.format(version))
         params.append('flavor={}'.format(flavor))
 
-        if params:
-            params_string = '?' + "&".join(params)
-        else:
-            params_string = ''
-
-        data = requests.get(
-            OPENQA_API + '/jobs' + params_string).json()
-
         jobs = []
-
-        try:
-            for job in data['jobs']:
-                # skip restarted job
-                if job['clone_id']:
-                    continue
-                jobs.append(job['id'])
-        except KeyError:
-            # no jobs found
-            pass
+        for job in OpenQA.list_jobs(params):
+            # skip restarted job
+            if job['clone_id']:
+                continue
+            jobs.append(job['id'])
         return sorted(jobs)
 
     @staticmethod
@@ -895,91 +1657,374 @@ class OpenQA:
         return job_ids
 
     @staticmethod
-    def get_n_jobs_like(reference_job, n, flavor_override=None):
-        """Obtains similar n number of concluded valid jobs
+    def get_build_manifest(jobs):
+        """Packages installed in jobs of a build
 
-        :param JobData reference_job: job whose params serve as a search base
-        :param str n: number of similar jobs to obtain
-        :param str flavor: overriding flavor
+        :return dict: (log name, raw package name) -> sorted tuple of its
+            versions
+        """
+        manifest = {}
+        package_formats = {}
+        for job in jobs:
+            for entry in job.get_package_manifest():
+                manifest.setdefault((entry.log, entry.raw_name), set()).add(
+                    entry.get_full_version())
+                if entry.package_format:
+                    package_formats[(entry.log, entry.raw_name)] = \
+                        entry.package_format
+
+        def sort_versions(package, versions):
+            package_format = package_formats.get(package, package_parser.RPM)
+            return tuple(sorted(versions, key=functools.cmp_to_key(
+                lambda a, b: package_parser.compare_version_strings(
+                    a, b, package_format))))
+
+        return {package: sort_versions(package, versions)
+                for package, versions in manifest.items()}
+
+    @staticmethod
+    def diff_manifests(old_manifest, new_manifest):
+        """Packages whose versions differ between two build manifests
+
+        :return list: (log name, raw package name, old versions,
+            new versions) tuples, sorted; versions are empty for packages
+            added or removed
         """
+        changes = []
+        for package in sorted(old_manifest.keys() | new_manifest.keys()):
+            old_versions = old_manifest.get(package, ())
+            new_versions = new_manifest.get(package, ())
+            if old_versions != new_versions:
+                changes.append((*package, old_versions, new_versions))
+        return changes
+
+    @staticmethod
+    def get_lineage_listing_params(lineage, before):
+        return [
+            'test={}'.format(lineage['test']),
+            'version={}'.format(lineage['version']),
+            'flavor={}'.format(lineage['flavor']),
+            'machine={}'.format(lineage['machine']),
+            'before={}'.format(before),
+            'limit={}'.format(LINEAGE_CHUNK),
+        ]
+
+    @staticmethod
+    def iter_lineage_job_ids(lineage, last_job_id):
+        """Ids of concluded jobs of a test suite, newest first
+
+        Ranges of job ids known to be complete in the local DB are read from
+        there, the rest is listed from openQA as needed, LINEAGE_CHUNK jobs
+        at a time, and recorded.
+
+        :param dict lineage: test, version, flavor and machine
+        :param int last_job_id: id to start at (included)
+        """
+        high_job_id = last_job_id
+        while high_job_id > 0:
+            coverage = LineageCoverage.find(lineage, high_job_id)
+            if coverage is not None:
+                yield from JobLineage.get_job_ids(
+                    lineage, coverage.low_job_id, high_job_id)
+                high_job_id = coverage.low_job_id - 1
+                continue
+
+            listed_jobs = OpenQA.list_jobs(OpenQA.get_lineage_listing_params(
+                lineage, high_job_id + 1))
+            LineageCoverage.add_listing(
+                lineage, listed_jobs, high_job_id + 1, LINEAGE_CHUNK)
+            for job in sorted(listed_jobs, key=lambda job: -job['id']):
+                if job['result'] in CONCLUDED_RESULTS:
+                    yield job['id']
+            if len(listed_jobs) < LINEAGE_CHUNK:
+                break
+            high_job_id = min(job['id'] for job in listed_jobs) - 1
+
+    @staticmethod
+    def get_lineage(reference_job, flavor_override=None):
+        """Test suite history the reference job is compared to"""
         test_suite  = reference_job.get_job_name()
         if '@' in test_suite:
             test_suite, machine = test_suite.rsplit('@', 1)
         else:
             test_suite, machine = test_suite, '64bit'
-        version     = reference_job.get_job_version()
         if flavor_override:
             flavor = flavor_override
         else:
             flavor = reference_job.get_job_flavor()
+        return {
+            'test': test_suite,
+            'version': reference_job.get_job_version(),
+            'flavor': flavor,
+            'machine': machine,
+        }
 
-        latest_job_id = OpenQA.get_latest_job_id(
-            job_type=test_suite, version=version, flavor=flavor, machine=machine)
-        if latest_job_id is None:
-            return []
-        margin = n * 2 # add margin for invalid jobs
-        max_history_len = max(latest_job_id - reference_job.job_id, 0) + margin
-
-        job_ids = OpenQA.get_latest_concluded_job_ids(
-                    test_suite, max_history_len, version, flavor, machine=machine)
-        if not job_ids:
-            return []
+    @staticmethod
+    def get_n_jobs_like(reference_job, n, flavor_override=None):
+        """Obtains similar n number of concluded valid jobs
 
-        if reference_job.job_id in job_ids:
-            ref_job_index = job_ids.index(reference_job.job_id)
-        else:
-            # try to find job with closest id before the reference job
-            # (indicating temporal closeness)
-            ref_job_distances = map(
-                lambda job_id: reference_job.job_id - job_id, job_ids)
-            ref_job_distances = filter( # remove jobs after reference job
-                lambda distance: distance > 0, ref_job_distances)
-            closest_job_id = reference_job.job_id - min(ref_job_distances)
-            ref_job_index = job_ids.index(closest_job_id)
+        :param JobData reference_job: job whose params serve as a search base
+        :param str n: number of similar jobs to obtain
+        :param str flavor: overriding flavor
+        """
+        lineage = OpenQA.get_lineage(reference_job, flavor_override)
+        job_ids = OpenQA.iter_lineage_job_ids(lineage, reference_job.job_id)
+        # skip the reference job, or the closest job before it (indicating
+        # temporal closeness) when it is not part of this history
+        next(job_ids, None)
 
-        potential_job_ids = job_ids[:ref_job_index]
+        candidates = (
+            local_session.get(JobLineage, dict(lineage, job_id=job_id))
+            for job_id in job_ids)
+        candidates = (entry for entry in candidates if entry.valid is not False)
 
         relevant_jobs = []
-        for job_id in reversed(potential_job_ids):
-            job = OpenQA.get_job(job_id)
-
-            if job.is_valid():
-                relevant_jobs = [job] + relevant_jobs
-            if len(relevant_jobs) >= n:
+        while len(relevant_jobs) < n:
+            # as many jobs as still missing, created at once
+            entries = list(itertools.islice(
+                candidates, n - len(relevant_jobs)))
+            if not entries:
                 break
+            jobs = OpenQA.get_jobs([entry.job_id for entry in entries])
+            for entry, job in zip(entries, jobs):
+                entry.valid = job.is_valid()
+                if entry.valid:
+                    relevant_jobs = [job] + relevant_jobs
+        # keep the history looked up and the validity of its jobs
+        local_session.commit()
         return relevant_jobs
 
 
+def get_failure_key(failure):
+    """Canonical key of a failed test (TestFailure, PastFailure), following
+    TestFailure.__eq__: name and title, or name and test id if untitled"""
+    if not failure.title:
+        return (failure.name, failure.test_id)
+    return (failure.name, failure.title)
+
+def get_failure_keys(failures):
+    """Keys of failures, to look them up with has_failure()"""
+    return {get_failure_key(failure) for failure in failures}
+
+def has_failure(keys, failure):
+    """Same as `failure in failures`, given get_failure_keys(failures)
+
+    `failure in failures` holds when one of the failures `f` has
+    `f == failure`, so when the key of `f` is one of the two below (a title
+    is never equal to a test id).
+    """
+    return (failure.name, failure.title) in keys or \
+        (failure.name, failure.test_id) in keys
+
+def get_test_url(job_id, test_name, test_id):
+    return "{}/tests/{}#step/{}/{}".format(
+        OPENQA_URL, job_id, test_name, test_id)
+
+def upgrade_job_details_storage(connection):
+    """Store job details as compressed JSON, with columns for common fields
+
+    The job table is rebuilt, adding the columns that hold the frequently
+    used fields of job details and fixing the types of version and flavor
+    (stored as numbers before, which turned "4.10" into 4.1).
+    """
+    if db_migrations.has_column(connection, JobData.__tablename__, 'result'):
+        return
+
+    table = JobData.__table__
+    new_table = sqlalchemy.Table(
+        table.name + "_new", sqlalchemy.MetaData(),
+        *[Column(column.name, column.type, primary_key=column.primary_key)
+          for column in table.columns])
+
+    connection.execute(CreateTable(new_table))
+    rows = connection.exec_driver_sql(
+        "SELECT job_id, job_type, valid, job_details FROM job")
+    for job_id, job_type, valid, pickled_details in rows.fetchall():
+        job_details = pickle.loads(pickled_details)
+        connection.execute(insert(new_table).values(
+            job_id=job_id, job_type=job_type, valid=valid,
+            job_details=job_details,
+            **JobData.columns_from_details(job_details)))
+
+    # tables referencing the job table by name keep working after this
+    connection.exec_driver_sql("DROP TABLE job")
+    connection.exec_driver_sql(
+        "ALTER TABLE {} RENAME TO job".format(new_table.name))
+
+def create_indexes(connection):
+    """Add indexes matching the queries made on the cache"""
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_job_job_name")
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+def move_failure_text(connection):
+    """Move full error texts of test failures to a compressed side table"""
+    if not db_migrations.has_column(
+            connection, TestFailure.__tablename__, 'fail_error'):
+        return
+
+    connection.exec_driver_sql(
+        "ALTER TABLE test_failures ADD COLUMN has_cleanup_error BOOLEAN")
+    connection.exec_driver_sql(
+        "UPDATE test_failures SET has_cleanup_error = "
+        "(cleanup_error IS NOT NULL AND cleanup_error != '')")
+
+    rows = connection.exec_driver_sql(
+        "SELECT name, title, job_id, test_id, fail_error, cleanup_error "
+        "FROM test_failures WHERE fail_error != '' OR cleanup_error != ''")
+    while True:
+        chunk = rows.fetchmany(1000)
+        if not chunk:
+            break
+        connection.execute(insert(TestFailureText.__table__), [
+            dict(name=name, title=title, job_id=job_id, test_id=test_id,
+                 fail_error=fail_error, cleanup_error=cleanup_error)
+            for name, title, job_id, test_id, fail_error, cleanup_error
+            in chunk])
+
+    connection.exec_driver_sql("ALTER TABLE test_failures DROP COLUMN fail_error")
+    connection.exec_driver_sql(
+        "ALTER TABLE test_failures DROP COLUMN cleanup_error")
+
+def build_flakiness_stats(connection):
+    """Compute flakiness statistics of the jobs already stored"""
+    histories = {}
+    rows = connection.exec_driver_sql(
+        "SELECT job_id, job_name, machine, version, flavor, t_started "
+        "FROM job WHERE valid ORDER BY job_id")
+    for job_id, job_name, machine, version, flavor, t_started in rows:
+        histories.setdefault(
+            (job_name, machine, version, flavor), []).append(
+                (job_id, t_started))
+
+    for key, jobs in histories.items():
+        jobs = jobs[-STATS_WINDOW:]
+        suite = dict(zip(('job_name', 'machine', 'version', 'flavor'), key))
+        connection.execute(insert(SuiteHistory.__table__).values(
+            job_ids=[job_id for job_id, _ in jobs], **suite))
+
+        start_times = dict(jobs)
+        tests = {}
+        failures = connection.execute(
+            sqlalchemy.select(
+                TestFailure.name, TestFailure.title, TestFailure.test_id,
+                TestFailure.job_id, TestFailure.relevant_error)
+            .where(TestFailure.job_id.in_(start_times)))
+        for name, title, test_id, job_id, relevant_error in failures:
+            tests.setdefault((name, title, test_id), []).append(
+                [job_id, relevant_error])
+        for (name, title, test_id), failures in tests.items():
+            failures.sort()
+            connection.execute(insert(TestStats.__table__).values(
+                name=name, title=title, test_id=test_id, failures=failures,
+                last_seen=start_times[failures[-1][0]], **suite))
+
+def add_error_signatures(connection):
+    """Add signatures of the relevant errors of test failures"""
+    if not db_migrations.has_column(
+            connection, TestFailure.__tablename__, 'error_signature'):
+        connection.exec_driver_sql(
+            "ALTER TABLE test_failures ADD COLUMN error_signature VARCHAR")
+
+    # a single pass over the table, computing signatures in Python
+    connection.connection.driver_connection.create_function(
+        "error_signature", 1, error_signatures.normalize, deterministic=True)
+    connection.exec_driver_sql(
+        "UPDATE test_failures SET error_signature = "
+        "error_signature(relevant_error) WHERE relevant_error IS NOT NULL")
+
+def add_package_formats(connection):
+    """Add the format (dpkg or rpm) of package manifest entries"""
+    if not db_migrations.has_column(
+            connection, PackageManifestEntry.__tablename__, 'package_format'):
+        connection.exec_driver_sql(
+            "ALTER TABLE package_manifest ADD COLUMN package_format VARCHAR")
+
+def reparse_package_manifests(connection):
+    """Drop package manifests stored with shortened versions"""
+    # parsed again from the logs of the jobs when needed
+    connection.exec_driver_sql("DELETE FROM package_manifest")
+
+# schema changes of the local DB, in order, see lib/db_migrations.py
+MIGRATIONS = [
+    upgrade_job_details_storage,
+    create_indexes,
+    move_failure_text,
+    build_flakiness_stats,
+    add_error_signatures,
+    add_package_formats,
+    reparse_package_manifests,
+]
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers (reports) do not block the writer (openqa_sync) and vice versa
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 def config_db_session(db_path=None, debug_db=False):
     if db_path is None:
         db_engine = create_engine("sqlite:///:memory:", echo=debug_db)
-        Base.metadata.create_all(db_engine)
     else:
         db_engine = create_engine("sqlite:///" + db_path, echo=debug_db)
+        event.listen(db_engine, "connect", set_sqlite_pragmas)
 
         if os.path.exists(db_path):
             logging.info("Connecting to local DB in '{}'".format(db_path))
         else:
             logging.info("Creating local DB in '{}'".format(db_path))
-            Base.metadata.create_all(db_engine)
+
+    if db_migrations.migrate(db_engine, Base.metadata, MIGRATIONS) \
+            and db_path is not None:
+        # give the space freed by migrations back
+        with db_engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT") as connection:
+            connection.exec_driver_sql("VACUUM")
 
     Session = sessionmaker(bind=db_engine)
     session = Session()
 
     return session
 
+@contextlib.contextmanager
+def ingest_batch():
+    """Commits jobs created within, and their failures, in a single transaction
+
+    Otherwise each new job is committed on its own.
+    """
+    global batch_ingest
+    if batch_ingest:
+        yield
+        return
+    batch_ingest = True
+    try:
+        yield
+    finally:
+        batch_ingest = False
+    local_session.commit()
+
 def get_db_session():
     global local_session
     return local_session
 
-def setup_openqa_environ(package_list, db_path=None, verbose=False):
+def setup_openqa_environ(package_list, db_path=None, verbose=False,
+                         fetch_concurrency=DEFAULT_FETCH_CONCURRENCY,
+                         http_cache_path=None):
     global name_mapping
     with open(package_list) as package_file:
         data = json.load(package_file)
     name_mapping = data
 
-    global local_session
+    global fetch_workers
+    fetch_workers = fetch_concurrency
+
+    http_cache.setup_cache(http_cache_path)
+
+    global local_session, updates_status_repo
     local_session = config_db_session(db_path, debug_db=False)
+    updates_status_repo = None
     if verbose:
         setup_logging()
 
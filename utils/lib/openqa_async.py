@@ -0,0 +1,438 @@
+"""asyncio counterpart of the OpenQA class, on aiohttp
+
+AsyncOpenQA queries openQA with up to `concurrency` requests in flight, for
+example the passed and failed job histories of a test suite at the same
+time. Responses go through the same cache as the synchronous code
+(lib/http_cache.py), and hydrated job details are handed to the usual
+JobData models, which are only ever created from the calling thread:
+
+    async with AsyncOpenQA() as openqa:
+        jobs = await openqa.get_jobs(job_ids, full_details=True)
+        await openqa.prefetch_ulogs(jobs)
+
+or, from synchronous code:
+
+    jobs = run(AsyncOpenQA.get_jobs, job_ids, full_details=True)
+"""
+import asyncio
+import json
+import logging
+import random
+import urllib.parse
+
+import aiohttp
+
+from lib import http_cache, http_client, openqa_api
+from lib.openqa_api import (
+    OpenQA,
+    JobData,
+    JobLineage,
+    LineageCoverage,
+    OPENQA_API,
+    CONCLUDED_RESULTS,
+    JOB_LISTING_CHUNK,
+    LINEAGE_CHUNK,
+    job_listing_cache,
+    prefetched_job_details,
+)
+
+# logs parsed by JobData methods (performance results, updated templates and
+# packages)
+PARSED_ULOGS = (
+    'system_tests-perf_test_results.txt',
+    'update-template-versions.txt',
+    'update2-template-versions.txt',
+)
+PARSED_ULOG_SUFFIXES = ('packages.txt',)
+
+
+def is_parsed_ulog(log):
+    return log in PARSED_ULOGS or log.endswith(PARSED_ULOG_SUFFIXES)
+
+
+class AsyncOpenQA:
+    def __init__(self, concurrency=None):
+        """
+        :param int concurrency: max number of requests in flight, the
+            --fetch-concurrency given to setup_openqa_environ() by default
+        """
+        if concurrency is None:
+            concurrency = openqa_api.fetch_workers
+        self.concurrency = max(concurrency, 1)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = None
+
+    async def __aenter__(self):
+        client = http_client.default_client
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=client.connect_timeout,
+                                          sock_read=client.read_timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, url, headers=None):
+        """GET the URL
+
+        Retried and guarded by the host circuit breaker like requests
+        made with lib/http_client.py.
+
+        :return tuple: aiohttp.ClientResponse (already released) and its body
+        :raises aiohttp.ClientResponseError: on an error status
+        """
+        client = http_client.default_client
+        breaker = client.get_breaker(urllib.parse.urlsplit(url).netloc)
+
+        if not breaker.allow():
+            raise http_client.CircuitOpenError(
+                "Not requesting {}, its host is failing".format(url))
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    async with self.session.get(
+                            url, headers=headers) as response:
+                        body = await response.read()
+            except (aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError) as e:
+                if attempt >= client.retries:
+                    breaker.record_failure()
+                    raise
+                reason = str(e) or type(e).__name__
+            else:
+                if response.status not in http_client.RETRY_STATUSES:
+                    breaker.record_success()
+                    response.raise_for_status()
+                    return response, body
+                if attempt >= client.retries:
+                    breaker.record_failure()
+                    response.raise_for_status()
+                reason = "HTTP {}".format(response.status)
+
+            delay = random.uniform(
+                0, min(http_client.MAX_BACKOFF, client.backoff * 2 ** attempt))
+            attempt += 1
+            logging.debug("GET {} failed ({}), retry {}/{} in {:.1f}s".format(
+                url, reason, attempt, client.retries, delay))
+            await asyncio.sleep(delay)
+
+    async def get(self, url, immutable=False):
+        """GET the URL, reusing a cached response when still valid
+
+        See http_cache.ResponseCache.get()
+
+        :return http_cache.CachedResponse: response
+        """
+        cache = http_cache.response_cache
+        entry = cache.lookup(url)
+        if cache.is_fresh(entry):
+            return entry
+
+        response, body = await self.request(
+            url, headers=cache.validation_headers(entry))
+        return cache.update(
+            url, entry, response.status, body,
+            response.charset or 'utf-8', response.headers,
+            immutable=immutable)
+
+    async def list_jobs(self, params):
+        """Queries the openQA job listing, remembering the finished jobs
+
+        See OpenQA.list_jobs()
+        """
+        if params:
+            params_string = '?' + "&".join(params)
+        else:
+            params_string = ''
+
+        _, body = await self.request(OPENQA_API + '/jobs' + params_string)
+        data = json.loads(body)
+
+        jobs = data.get('jobs', [])
+        job_listing_cache.add(jobs)
+        JobLineage.record(jobs)
+        return jobs
+
+    async def get_listed_jobs(self, job_ids):
+        """Gets listing entries of the given jobs
+
+        See OpenQA.get_listed_jobs()
+        """
+        listed_jobs = {}
+        missing_job_ids = []
+        for job_id in dict.fromkeys(job_ids):
+            job = job_listing_cache.get(job_id)
+            if job is None:
+                missing_job_ids.append(job_id)
+            else:
+                listed_jobs[job_id] = job
+        for jobs in await asyncio.gather(*[
+                self.list_jobs(['ids={}'.format(','.join(
+                    str(job_id)
+                    for job_id in missing_job_ids[i:i + JOB_LISTING_CHUNK]))])
+                for i in range(0, len(missing_job_ids), JOB_LISTING_CHUNK)]):
+            for job in jobs:
+                listed_jobs[job['id']] = job
+        return listed_jobs
+
+    async def fetch_jobs_details(self, job_ids):
+        """Downloads details of the given jobs
+
+        :return dict: job id -> job details
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        responses = await asyncio.gather(*[
+            self.get("{}/jobs/{}/details".format(OPENQA_API, job_id))
+            for job_id in job_ids])
+        return {job_id: response.json()
+                for job_id, response in zip(job_ids, responses)}
+
+    async def prefetch_jobs(self, job_ids, full_details=False):
+        """Obtains details needed to create JobData for the given jobs
+
+        See OpenQA.prefetch_jobs()
+        """
+        listed_jobs = await self.get_listed_jobs(job_ids)
+
+        result = {}
+        full_details_ids = []
+        for job_id in job_ids:
+            job = listed_jobs.get(job_id)
+            if full_details or job is None or job['result'] == 'failed' \
+                    or 'parents' not in job or 'children' not in job:
+                full_details_ids.append(job_id)
+            else:
+                result[job_id] = {'job': job}
+        result.update(await self.fetch_jobs_details(full_details_ids))
+        return result
+
+    async def get_jobs(self, job_ids, full_details=False):
+        """Obtains jobs, creating those missing from the local DB
+
+        Details of the jobs, and of their missing parents and children, are
+        all downloaded first. The JobData objects are then created
+        serially, from this thread.
+
+        :param list job_ids: ids of jobs to get
+        :param bool full_details: download full details (test results, logs)
+            upfront for the given jobs, not only for those needing it
+        """
+        db = openqa_api.get_db_session()
+        missing_job_ids = [
+            job_id for job_id in job_ids
+            if db.get(JobData, {"job_id": job_id}) is None]
+        jobs_details = await self.prefetch_jobs(
+            missing_job_ids, full_details=full_details)
+
+        # created along with the jobs
+        related_job_ids = []
+        for job_details in jobs_details.values():
+            job = job_details['job']
+            related_job_ids += job['parents']['Chained']
+            if not job['parents']['Chained']:
+                related_job_ids += job['children']['Chained']
+        related_job_ids = [
+            job_id for job_id in dict.fromkeys(related_job_ids)
+            if job_id not in jobs_details
+            and db.get(JobData, {"job_id": job_id}) is None]
+        jobs_details.update(await self.prefetch_jobs(related_job_ids))
+
+        prefetched_job_details.update(jobs_details)
+        jobs = []
+        try:
+            with openqa_api.ingest_batch():
+                for job_id in job_ids:
+                    jobs += [OpenQA.get_job(job_id)]
+        finally:
+            prefetched_job_details.clear()
+        return jobs
+
+    async def get_ulog(self, job, log):
+        """Downloads a log uploaded by the job
+
+        :return http_cache.CachedResponse: response, or None on failure
+        """
+        try:
+            return await self.get(job.get_ulog_url(log),
+                                  immutable=job.is_finished())
+        except aiohttp.ClientResponseError as e:
+            logging.debug("failed to get {} of job {}: {}".format(
+                log, job.job_id, e))
+            return None
+
+    async def prefetch_ulogs(self, jobs, logs=is_parsed_ulog):
+        """Downloads logs of the jobs into the response cache
+
+        Methods of JobData parsing those logs then find them there.
+
+        :param list jobs: JobData objects, with full details
+        :param logs: filter of log names to download
+        """
+        await asyncio.gather(*[
+            self.get_ulog(job, log)
+            for job in jobs
+            for log in job.get_full_job_details()['job']['ulogs']
+            if logs(log)])
+
+    async def get_latest_job_id(self, job_type='system_tests_update',
+                                build=None, version=None, flavor=None,
+                                machine=None):
+        jobs = await self.get_latest_job_ids(
+            job_type, build, version, history_len=1, flavor=flavor,
+            machine=machine)
+        if not jobs:
+            return None
+        return jobs[0]
+
+    async def get_latest_job_ids(self, job_type='system_tests_update',
+                                 build=None, version=None, history_len=100,
+                                 result=None, flavor=None, machine=None):
+        params = []
+        if job_type:
+            params.append('test={}'.format(job_type))
+        if build:
+            params.append('build={}'.format(build))
+        if version:
+            params.append('version={}'.format(version))
+        if history_len:
+            params.append('limit={}'.format(history_len))
+        if result:
+            params.append('result={}'.format(result))
+        if flavor:
+            params.append('flavor={}'.format(flavor))
+        if machine:
+            params.append('machine={}'.format(machine))
+
+        jobs = []
+        for job in await self.list_jobs(params):
+            jobs.append(job['id'])
+        return sorted(jobs)
+
+    async def get_jobs_ids_for_build(self, build, version, flavor):
+        params = []
+        params.append('build={}'.format(build))
+        params.append('version={}'.format(version))
+        params.append('flavor={}'.format(flavor))
+
+        jobs = []
+        for job in await self.list_jobs(params):
+            # skip restarted job
+            if job['clone_id']:
+                continue
+            jobs.append(job['id'])
+        return sorted(jobs)
+
+    async def get_latest_concluded_job_ids(self, test_suite, history_len,
+                                           version, flavor, machine=None):
+        success_jobs, failed_jobs = await asyncio.gather(
+            self.get_latest_job_ids(
+                test_suite, version=version, result="passed",
+                history_len=history_len, flavor=flavor, machine=machine),
+            self.get_latest_job_ids(
+                test_suite, version=version, result="failed",
+                history_len=history_len, flavor=flavor, machine=machine))
+
+        job_ids = sorted(success_jobs + failed_jobs)
+        job_ids = job_ids[-history_len:]
+        return job_ids
+
+    async def iter_lineage_job_ids(self, lineage, last_job_id):
+        """Ids of concluded jobs of a test suite, newest first
+
+        See OpenQA.iter_lineage_job_ids()
+        """
+        high_job_id = last_job_id
+        while high_job_id > 0:
+            coverage = LineageCoverage.find(lineage, high_job_id)
+            if coverage is not None:
+                for job_id in JobLineage.get_job_ids(
+                        lineage, coverage.low_job_id, high_job_id):
+                    yield job_id
+                high_job_id = coverage.low_job_id - 1
+                continue
+
+            listed_jobs = await self.list_jobs(
+                OpenQA.get_lineage_listing_params(lineage, high_job_id + 1))
+            LineageCoverage.add_listing(
+                lineage, listed_jobs, high_job_id + 1, LINEAGE_CHUNK)
+            for job in sorted(listed_jobs, key=lambda job: -job['id']):
+                if job['result'] in CONCLUDED_RESULTS:
+                    yield job['id']
+            if len(listed_jobs) < LINEAGE_CHUNK:
+                break
+            high_job_id = min(job['id'] for job in listed_jobs) - 1
+
+    async def get_n_jobs_like(self, reference_job, n, flavor_override=None):
+        """Obtains similar n number of concluded valid jobs
+
+        See OpenQA.get_n_jobs_like()
+        """
+        lineage = OpenQA.get_lineage(reference_job, flavor_override)
+        db = openqa_api.get_db_session()
+        job_ids = self.iter_lineage_job_ids(lineage, reference_job.job_id)
+        # the reference job, or the closest job before it
+        await anext(job_ids, None)
+
+        async def get_candidates(count):
+            entries = []
+            async for job_id in job_ids:
+                entry = db.get(JobLineage, dict(lineage, job_id=job_id))
+                if entry.valid is not False:
+                    entries.append(entry)
+                if len(entries) >= count:
+                    break
+            return entries
+
+        relevant_jobs = []
+        while len(relevant_jobs) < n:
+            # as many jobs as still missing, created at once
+            entries = await get_candidates(n - len(relevant_jobs))
+            if not entries:
+                break
+            jobs = await self.get_jobs([entry.job_id for entry in entries])
+            for entry, job in zip(entries, jobs):
+                entry.valid = job.is_valid()
+                if entry.valid:
+                    relevant_jobs = [job] + relevant_jobs
+        # keep the history looked up and the validity of its jobs
+        db.commit()
+        return relevant_jobs
+
+    async def get_n_jobs_like_each(self, reference_jobs, n,
+                                   flavor_override=None):
+        """get_n_jobs_like() for several jobs at once
+
+        Histories of different test suites (and machines) are looked up
+        concurrently. Jobs sharing one are handled in turn, newest first, so
+        that the listings made for a job serve the next ones.
+
+        :return dict: reference job -> list of similar jobs
+        """
+        jobs_by_lineage = {}
+        for job in reference_jobs:
+            lineage = OpenQA.get_lineage(job, flavor_override)
+            jobs_by_lineage.setdefault(
+                tuple(lineage.values()), []).append(job)
+
+        result = {}
+        async def get_lineage_jobs(jobs):
+            for job in sorted(jobs, key=lambda job: job.job_id, reverse=True):
+                result[job] = await self.get_n_jobs_like(
+                    job, n, flavor_override=flavor_override)
+
+        await asyncio.gather(*[
+            get_lineage_jobs(jobs) for jobs in jobs_by_lineage.values()])
+        return result
+
+
+def run(method, *args, concurrency=None, **kwargs):
+    """Calls a method of AsyncOpenQA from synchronous code
+
+    :param method: unbound AsyncOpenQA method, like AsyncOpenQA.get_jobs
+    """
+    async def call():
+        async with AsyncOpenQA(concurrency) as openqa:
+            return await method(openqa, *args, **kwargs)
+    return asyncio.run(call())
@@ -0,0 +1,311 @@
+"""Parser of package lists uploaded by jobs (*packages.txt logs)
+
+Two formats are found there, possibly mixed in a single log:
+- `dpkg -l` output of Debian based systems, where installed packages are
+  on lines starting with "ii", like
+  "ii  qubes-core-agent  4.3.10-1+deb12u1  amd64  Qubes core agent"
+- `rpm -qa` output of Fedora based systems, one NEVRA per line, like
+  "qubes-core-dom0-4.3.20-1.fc41.noarch"
+
+parse_packages() goes over a whole log at once and returns a
+PackageRecord for each package. Versions are ordered the way the
+respective package manager does it, see compare_versions().
+
+Updates-status issue titles name versions in a shorter form, see
+get_title_version().
+"""
+import collections
+import functools
+
+DEB = 'deb'
+RPM = 'rpm'
+
+RPM_ARCHES = frozenset((
+    'noarch', 'x86_64', 'i686', 'i586', 'i386', 'aarch64', 'armv7hl',
+    'ppc64le', 's390x', 'src',
+))
+
+
+class PackageRecord(collections.namedtuple(
+        'PackageRecord', 'name epoch version release arch format')):
+    """Installed package
+
+    epoch, release and arch are None when not given (Debian native packages
+    have no release, `rpm -qa` lists no epochs).
+    """
+    __slots__ = ()
+
+    @property
+    def base_release(self):
+        """Release without the distribution suffix ("+deb12u1", ".fc41")"""
+        if self.release is None:
+            return None
+        if self.format == DEB:
+            return self.release.split('+', maxsplit=1)[0]
+        return self.release.split('.', maxsplit=1)[0]
+
+    def get_full_version(self):
+        """Version as in the log: [epoch:]version[-release]"""
+        version = self.version
+        if self.epoch is not None:
+            version = "{}:{}".format(self.epoch, version)
+        if self.release is not None:
+            version = "{}-{}".format(version, self.release)
+        return version
+
+    def get_manifest_version(self):
+        """Version and release as kept in package manifests
+
+        :return tuple: version, with the epoch if any, and release (None if
+            there is none)
+        """
+        version = self.version
+        if self.epoch is not None:
+            version = "{}:{}".format(self.epoch, version)
+        return version, self.release
+
+    def __lt__(self, other):
+        if self.name != other.name:
+            return self.name < other.name
+        return compare_versions(self, other) < 0
+
+
+@functools.lru_cache(maxsize=16)
+def parse_packages(text):
+    """Parses a package list
+
+    Results are kept for the last logs parsed: the jobs of a build mostly
+    upload the same package lists (dom0, templates).
+
+    :param str text: content of a *packages.txt log
+    :return tuple: PackageRecord objects, in the order of the log
+    """
+    records = []
+    append = records.append
+    new_record = tuple.__new__
+    for line in text.split('\n'):
+        # `rpm -qa` lines are the most common
+        if ' ' not in line:
+            name, _, release = line.rpartition('-')
+            name, separator, version = name.rpartition('-')
+            if not separator or not name:
+                continue
+            release = release.rstrip('\r')
+            epoch = arch = None
+            base, dot, suffix = release.rpartition('.')
+            if dot and suffix in RPM_ARCHES:
+                release, arch = base, suffix
+            if ':' in version:
+                epoch, _, version = version.partition(':')
+            append(new_record(PackageRecord, (
+                name, epoch, version, release, arch, RPM)))
+
+        elif line.startswith('ii '):
+            columns = line.split(None, 4)
+            if len(columns) < 3:
+                continue
+            version = columns[2]
+            epoch = None
+            if ':' in version:
+                epoch, _, version = version.partition(':')
+            version, separator, release = version.rpartition('-')
+            if not separator:
+                version, release = release, None
+            append(new_record(PackageRecord, (
+                columns[1], epoch, version, release,
+                columns[3] if len(columns) > 3 else None, DEB)))
+
+    return tuple(records)
+
+
+def rpmvercmp(a, b):
+    """Compares version (or release) strings like rpm does
+
+    Strings are split into alphabetic and numeric segments, compared in
+    order: numbers numerically and above letters, "~" sorts before
+    anything (pre-releases) and "^" after the end of a string (snapshots).
+
+    :return int: -1, 0 or 1
+    """
+    if a == b:
+        return 0
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+    while i < len_a or j < len_b:
+        # separators are not compared, except for ~ and ^
+        while i < len_a and not a[i].isalnum() and a[i] not in '~^':
+            i += 1
+        while j < len_b and not b[j].isalnum() and b[j] not in '~^':
+            j += 1
+
+        if i < len_a and a[i] == '~' or j < len_b and b[j] == '~':
+            if i >= len_a or a[i] != '~':
+                return 1
+            if j >= len_b or b[j] != '~':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i < len_a and a[i] == '^' or j < len_b and b[j] == '^':
+            if i >= len_a:
+                return -1
+            if j >= len_b:
+                return 1
+            if a[i] != '^':
+                return 1
+            if b[j] != '^':
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i >= len_a or j >= len_b:
+            break
+
+        start_a, start_b = i, j
+        if a[i].isdigit():
+            while i < len_a and a[i].isdigit():
+                i += 1
+            while j < len_b and b[j].isdigit():
+                j += 1
+            if j == start_b:
+                # numeric segments are newer than alphabetic ones
+                return 1
+            segment_a = a[start_a:i].lstrip('0')
+            segment_b = b[start_b:j].lstrip('0')
+            if len(segment_a) != len(segment_b):
+                return 1 if len(segment_a) > len(segment_b) else -1
+        else:
+            while i < len_a and a[i].isalpha():
+                i += 1
+            while j < len_b and b[j].isalpha():
+                j += 1
+            if j == start_b:
+                return -1
+            segment_a = a[start_a:i]
+            segment_b = b[start_b:j]
+        if segment_a != segment_b:
+            return 1 if segment_a > segment_b else -1
+
+    if i >= len_a and j >= len_b:
+        return 0
+    return -1 if i >= len_a else 1
+
+
+def _dpkg_order(char):
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def dpkg_vercmp(a, b):
+    """Compares upstream versions (or revisions) like dpkg does
+
+    Non-digit parts are compared character by character, with letters
+    sorting before other characters and "~" before anything, even the end
+    of the string. Digit parts are compared numerically.
+
+    :return int: -1, 0 or 1
+    """
+    if a == b:
+        return 0
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+    while i < len_a or j < len_b:
+        while i < len_a and not a[i].isdigit() or \
+                j < len_b and not b[j].isdigit():
+            order_a = _dpkg_order(a[i]) \
+                if i < len_a and not a[i].isdigit() else 0
+            order_b = _dpkg_order(b[j]) \
+                if j < len_b and not b[j].isdigit() else 0
+            if order_a != order_b:
+                return 1 if order_a > order_b else -1
+            i += 1
+            j += 1
+
+        start_a, start_b = i, j
+        while i < len_a and a[i].isdigit():
+            i += 1
+        while j < len_b and b[j].isdigit():
+            j += 1
+        number_a = int(a[start_a:i] or 0)
+        number_b = int(b[start_b:j] or 0)
+        if number_a != number_b:
+            return 1 if number_a > number_b else -1
+    return 0
+
+
+def compare_versions(a, b):
+    """Compares versions of two packages: epoch, version, then release
+
+    Debian packages are compared like dpkg does, others like rpm.
+
+    :param PackageRecord a: package
+    :param PackageRecord b: package
+    :return int: -1, 0 or 1
+    """
+    vercmp = dpkg_vercmp if a.format == DEB and b.format == DEB \
+        else rpmvercmp
+    epoch_a, epoch_b = int(a.epoch or 0), int(b.epoch or 0)
+    if epoch_a != epoch_b:
+        return 1 if epoch_a > epoch_b else -1
+    return vercmp(a.version, b.version) or \
+        vercmp(a.release or '', b.release or '')
+
+
+def get_title_version(version, release, package_format):
+    """Version and release as named in updates-status issue titles
+    ("<package> v<version>-<release> (r<Qubes release>)")
+
+    Debian releases (or native versions) lose their '+' suffix, rpm
+    releases their distribution suffix. Epochs are kept.
+
+    :param str version: version of a package manifest entry, with the epoch
+    :param str release: release of a package manifest entry, may be None
+    :param str package_format: DEB, RPM, or None for manifest entries
+        stored before their format was, which are short already
+    :return tuple: version, release (None if there is none)
+    """
+    if package_format == DEB:
+        if release:
+            return version, release.split('+', 1)[0]
+        return version.split('+', 1)[0], None
+    if package_format == RPM and release:
+        return version, release.split('.', 1)[0]
+    return version, release
+
+
+def compare_version_strings(a, b, package_format=RPM):
+    """Compares "[epoch:]version[-release]" strings, like the ones of
+    package manifests
+
+    :param str package_format: DEB or RPM
+    :return int: -1, 0 or 1
+    """
+    return compare_versions(split_version(a, package_format),
+                            split_version(b, package_format))
+
+
+def split_version(full_version, package_format=RPM):
+    """
+    :return PackageRecord: nameless package of a version string
+    """
+    epoch = release = None
+    if ':' in full_version:
+        head, tail = full_version.split(':', 1)
+        if head.isdigit():
+            epoch, full_version = head, tail
+    if '-' in full_version:
+        # Debian upstream versions may contain '-', rpm ones may not
+        if package_format == DEB:
+            full_version, release = full_version.rsplit('-', 1)
+        else:
+            full_version, release = full_version.split('-', 1)
+    return tuple.__new__(PackageRecord, (
+        None, epoch, full_version, release, None, package_format))
+
+
+version_key = functools.cmp_to_key(compare_versions)
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Exports the local openQA cache (LOCAL_OPENQA_CACHE_PATH) to columnar files
+# (see lib/history_export.py), for analyses over many jobs: pandas, or
+# openqa_investigator.py --export-dir. Each run appends the jobs ingested
+# since the previous one: newer jobs, and older ones added to the cache
+# meanwhile (history fetched by reports and investigations).
+
+from argparse import ArgumentParser
+import os
+import sys
+
+from sqlalchemy import func
+
+from lib import history_export
+from lib.openqa_api import (
+    setup_openqa_environ,
+    get_db_session,
+    JobData,
+    PendingJob,
+    SyncState,
+)
+from openqa_sync import SYNC_NAME
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def get_high_job_id():
+    """Highest job id that can be exported for good
+
+    Jobs up to the one openqa_sync got to are final, except the ones it
+    still waits for. Without openqa_sync, all the jobs are.
+    """
+    db = get_db_session()
+    state = db.get(SyncState, SYNC_NAME)
+    if state is not None:
+        first_pending_job_id = db.query(func.min(PendingJob.job_id)).filter(
+            PendingJob.name == SYNC_NAME).scalar()
+        if first_pending_job_id is not None:
+            return min(state.last_job_id, first_pending_job_id - 1)
+        return state.last_job_id
+    return db.query(func.max(JobData.job_id)).scalar() or 0
+
+def get_low_job_id(export_dir):
+    """First job id of the next export"""
+    state = history_export.get_state(export_dir)
+    if state is not None:
+        return state.high_job_id + 1
+    return get_db_session().query(func.min(JobData.job_id)).scalar() or 0
+
+def main():
+    parser = ArgumentParser(
+        description="Export the local openQA cache to Arrow or Parquet files")
+
+    parser.add_argument(
+        '--db-path',
+        default=os.getenv("LOCAL_OPENQA_CACHE_PATH"),
+        help="Local openQA cache to export. "\
+            "Can be set via the env variable LOCAL_OPENQA_CACHE_PATH."
+    )
+
+    parser.add_argument(
+        '--export-dir',
+        default=os.getenv("LOCAL_OPENQA_EXPORT_PATH"),
+        help="Directory of the exported files, appended to by each run. "\
+            "Can be set via the env variable LOCAL_OPENQA_EXPORT_PATH."
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=history_export.FORMATS,
+        default=history_export.ARROW,
+        help="Format of the files: '{}' (Arrow IPC, memory-mapped when "
+             "read) or '{}' (smaller). Default: {}".format(
+                 history_export.ARROW, history_export.PARQUET,
+                 history_export.ARROW)
+    )
+
+    parser.add_argument(
+        '--from-id',
+        type=int,
+        help="First job id to export. Default: the one after the last "
+             "exported job, after exporting older jobs missing from the "
+             "export"
+    )
+
+    parser.add_argument(
+        '--to-id',
+        type=int,
+        help="Last job id to export. Default: the last one openqa_sync "
+             "synced, or the newest job without openqa_sync"
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Range of job ids exported to each file. "
+             "Default: {}".format(DEFAULT_BATCH_SIZE)
+    )
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="Enable debug logging."
+    )
+
+    args = parser.parse_args()
+
+    if not args.db_path:
+        parser.error("Error: --db-path or LOCAL_OPENQA_CACHE_PATH required.")
+    if not args.export_dir:
+        parser.error("Error: --export-dir or LOCAL_OPENQA_EXPORT_PATH "
+                     "required.")
+    if not history_export.available:
+        parser.error("Error: exporting needs pyarrow")
+
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    mapping_path = os.path.join(base_dir, "github_package_mapping.json")
+    setup_openqa_environ(mapping_path, args.db_path, verbose=args.verbose)
+
+    high_job_id = args.to_id
+    if high_job_id is None:
+        high_job_id = get_high_job_id()
+
+    connection = get_db_session().connection()
+    low_job_id = args.from_id
+    exported = {}
+    try:
+        if args.from_id is None:
+            exported = history_export.export_backfill(
+                connection, args.export_dir) or {}
+        while True:
+            if low_job_id is None:
+                low_job_id = get_low_job_id(args.export_dir)
+            rows = history_export.export(
+                connection, args.export_dir,
+                min(low_job_id + args.batch_size - 1, high_job_id),
+                low_job_id, args.format)
+            if rows is None:
+                break
+            for table, count in rows.items():
+                exported[table] = exported.get(table, 0) + count
+            low_job_id = None
+    except history_export.ExportError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    state = history_export.get_state(args.export_dir)
+    print("Exported {}, up to job {}".format(
+        ", ".join("{} {}".format(count, table)
+                  for table, count in exported.items()) or "nothing",
+        state.high_job_id if state else None), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,22 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 import logging
-from sqlalchemy import or_
-
+from sqlalchemy.orm import selectinload
+try:
+    import pyarrow.dataset as ds
+except ImportError:
+    # --export-dir not available
+    ds = None
+
+from lib import history_export
+from lib.error_signatures import ErrorClusters
 from lib.openqa_api import (
     setup_openqa_environ,
     get_db_session,
     JobData,
     TestFailure,
-    OpenQA
+    OpenQA,
+    DEFAULT_FETCH_CONCURRENCY
 )
 
 DEFAULT_Q_VERSION = "4.1"
@@ -49,17 +57,17 @@ def report_test_failure(job, test_failures):
 
     return report
 
-def plot_by_test(title, jobs, failures_q, test_suite, outfile=None):
+def plot_by_test(title, jobs, failures, test_suite, outfile=None):
     y_fn = lambda test: test.title
     hue_fn = lambda test: test.name
-    plot_strip(title, jobs, failures_q, test_suite, y_fn, hue_fn, outfile)
+    plot_strip(title, jobs, failures, test_suite, y_fn, hue_fn, outfile)
 
-def plot_by_template(title, jobs, failures_q, test_suite, outfile=None):
+def plot_by_template(title, jobs, failures, test_suite, outfile=None):
     group_by_template = lambda test: test.template
-    plot_strip(title, jobs, failures_q, test_suite, group_by_template,
+    plot_strip(title, jobs, failures, test_suite, group_by_template,
                outfile=outfile)
 
-def plot_by_error(title, jobs, failures_q, test_suite, outfile=None):
+def plot_by_error(title, jobs, failures, test_suite, outfile=None):
 
     def group_by_error(test):
         if test.relevant_error:
@@ -68,14 +76,64 @@ def plot_by_error(title, jobs, failures_q, test_suite, outfile=None):
             return "[empty error message]"
 
     group_by_template = lambda test: test.template
-    plot_strip(title, jobs, failures_q, test_suite, group_by_error,
+    plot_strip(title, jobs, failures, test_suite, group_by_error,
+               hue_fn=group_by_template, outfile=outfile)
+
+def group_by_signature(test):
+    if test.error_signature:
+        return test.error_signature
+    else:
+        return "[empty error message]"
+
+def plot_by_signature(title, jobs, failures, test_suite, outfile=None):
+    group_by_template = lambda test: test.template
+    plot_strip(title, jobs, failures, test_suite, group_by_signature,
                hue_fn=group_by_template, outfile=outfile)
 
-def plot_by_worker(title, jobs, failures_q, test_suite, outfile):
-    y_fn = lambda test: str(test.job.worker)
-    plot_strip(title, jobs, failures_q, test_suite, y_fn, outfile=outfile)
+def plot_by_cluster(title, jobs, failures, test_suite, outfile=None):
+    clusters = ErrorClusters(test.error_signature for test in failures)
 
-def plot_strip(title, jobs, failures_q, test_suite, y_fn, hue_fn=None,
+    def group_by_cluster(test):
+        return clusters.get(group_by_signature(test))
+
+    group_by_template = lambda test: test.template
+    plot_strip(title, jobs, failures, test_suite, group_by_cluster,
+               hue_fn=group_by_template, outfile=outfile)
+
+def report_error_clusters(jobs, failures):
+    """
+    Prints the failures grouped by similar errors, most frequent first
+    """
+    failures = [failure for failure in failures if failure.error_signature]
+    clusters = ErrorClusters(failure.error_signature for failure in failures)
+    failures_by_cluster = {}
+    for failure in failures:
+        failures_by_cluster.setdefault(
+            clusters.get(failure.error_signature), []).append(failure)
+
+    report = ""
+    signatures_by_cluster = clusters.get_clusters()
+    for cluster, cluster_failures in sorted(
+            failures_by_cluster.items(), key=lambda item: -len(item[1])):
+        job_ids = sorted({failure.job_id for failure in cluster_failures})
+        tests = sorted({"{}/{}".format(failure.name, failure.title)
+                        for failure in cluster_failures})
+        report += "\n## `{}`\n\n".format(cluster)
+        report += "{} failures of {} tests in {}/{} jobs ({} to {})\n\n"\
+            .format(len(cluster_failures), len(tests), len(job_ids),
+                    len(jobs), job_ids[0], job_ids[-1])
+        for signature in signatures_by_cluster[cluster]:
+            report += "* signature `{}`\n".format(signature)
+        for test in tests:
+            report += "* test {}\n".format(test)
+    return report
+
+def plot_by_worker(title, jobs, failures, test_suite, outfile):
+    workers = {job.job_id: job.worker for job in jobs}
+    y_fn = lambda test: str(workers[test.job_id])
+    plot_strip(title, jobs, failures, test_suite, y_fn, outfile=outfile)
+
+def plot_strip(title, jobs, failures, test_suite, y_fn, hue_fn=None,
                outfile=None):
     """ Plots tests's failures along the jobs axis. Good for telling the
     evolution of a test's failure along time.
@@ -91,7 +149,8 @@ def plot_strip(title, jobs, failures_q, test_suite, y_fn, hue_fn=None,
 
     Args:
         title (list): title and subtitle of the test.
-        jobs (list): a list of all the JobData.
+        jobs (list): a list of all the JobData (or exported jobs).
+        failures (list): TestFailure (or exported failures) of these jobs.
         test_suite (str): test suite.
         y_fn (function(TestFailure)): function to group the results by.
         hue_fn (function(TestFailure)): function to color the results by.
@@ -104,10 +163,12 @@ def plot_strip(title, jobs, failures_q, test_suite, y_fn, hue_fn=None,
     y_data = []
     z_data = []
 
+    failures_by_job_id = {}
+    for test in failures:
+        failures_by_job_id.setdefault(test.job_id, []).append(test)
+
     for job in jobs:
-        job_test_failures = failures_q\
-            .filter(TestFailure.job_id == job.job_id).all()
-        for test in job_test_failures:
+        for test in failures_by_job_id.get(job.job_id, []):
             x_data += [str(job.job_id)]
             y_data += [y_fn(test)]
             if hue_fn:
@@ -157,6 +218,80 @@ def plot_strip(title, jobs, failures_q, test_suite, y_fn, hue_fn=None,
     else:
         plt.show()
 
+def get_history(suite, version, flavor, history_len, test_name_regex=None,
+                test_title_regex=None, error=None, with_texts=False):
+    """Latest valid jobs of a test suite on openQA, stored in the local DB,
+    and their failures
+
+    :param bool with_texts: load the full error texts with the failures
+    :return tuple: list of JobData, oldest first, and list of TestFailure
+    """
+    history_len_with_margin = history_len*2 # account for invalid jobs
+
+    # populate database
+    db = get_db_session()
+    concluded_job_ids = OpenQA.get_latest_concluded_job_ids(
+        suite, history_len_with_margin, version, flavor)
+    OpenQA.get_jobs(concluded_job_ids)
+
+    jobs_reversed_query = db.query(JobData)\
+            .filter(JobData.valid == True)\
+            .filter(JobData.job_name == suite)\
+            .filter(JobData.version == version)\
+            .filter(JobData.flavor == flavor)\
+            .where(JobData.job_id.in_(concluded_job_ids))\
+            .order_by(JobData.job_id.desc())\
+            .limit(history_len) # order_by in order to truncate the limit
+
+    failures_q = db.query(TestFailure)\
+                   .join(jobs_reversed_query.subquery())
+
+    # apply filters
+    if test_name_regex is not None:
+        failures_q = failures_q\
+            .filter(TestFailure.name.regexp_match(test_name_regex))\
+            .filter(TestFailure.title.regexp_match(test_title_regex))
+
+    if error or with_texts:
+        failures_q = failures_q.options(selectinload(TestFailure.text))
+    failures = failures_q.all()
+    if error:
+        # error texts are stored compressed, so they are matched here
+        error_regex = re.compile(error)
+        failures = [failure for failure in failures
+                    if failure.matches_error(error_regex)]
+
+    jobs_reversed = jobs_reversed_query.all()
+    return list(reversed(jobs_reversed)), failures
+
+def get_exported_history(export_dir, suite, version, flavor, history_len,
+                         test_name_regex=None, test_title_regex=None):
+    """Latest valid jobs of a test suite, and their failures, from files
+    written by openqa_export.py; nothing is looked up on openQA
+
+    :return tuple: lists of exported jobs, oldest first, and failures
+    """
+    jobs = history_export.read_rows(
+        export_dir, "jobs",
+        (ds.field("valid") == True) &
+        (ds.field("job_name") == suite) &
+        (ds.field("version") == version) &
+        (ds.field("flavor") == flavor))
+    jobs = sorted(jobs, key=lambda job: job.job_id)[-history_len:]
+
+    failures = history_export.read_rows(
+        export_dir, "test_failures",
+        ds.field("job_id").isin([job.job_id for job in jobs]))
+    if test_name_regex is not None:
+        # like regexp_match() in the DB
+        failures = [
+            failure for failure in failures
+            if failure.name is not None
+            and re.search(test_name_regex, failure.name)
+            and failure.title is not None
+            and re.search(test_title_regex, failure.title)]
+    return jobs, failures
+
 def main():
     parser = ArgumentParser(
         description="Look for unstable tests")
@@ -198,7 +333,11 @@ def main():
 
     parser.add_argument(
         "--output",
-        help="Select output format (report/plot_error/plot_templates/plot_tests)")
+        help="Select output format (report/report_clusters/plot_errors/"
+             "plot_signatures/plot_clusters/plot_templates/plot_tests/"
+             "plot_worker); signatures are errors without VM names, PIDs, "
+             "addresses, ports and times, clusters group similar "
+             "signatures")
 
     parser.add_argument(
         "--outdir",
@@ -218,12 +357,37 @@ def main():
             "Stored in memory only if not set. "
     )
 
+    parser.add_argument(
+        '--export-dir',
+        help="Read the job history from files written by openqa_export.py "\
+            "instead of openQA and the local DB (all outputs but 'report', "\
+            "without --error)."
+    )
+
+    parser.add_argument(
+        '--fetch-concurrency',
+        type=int,
+        default=DEFAULT_FETCH_CONCURRENCY,
+        help="Number of openQA job details downloaded in parallel. "
+             "Default: {}".format(DEFAULT_FETCH_CONCURRENCY)
+    )
+
+    parser.add_argument(
+        '--http-cache-path',
+        default=os.getenv("LOCAL_OPENQA_HTTP_CACHE_PATH"),
+        help="Directory for caching downloaded openQA job details and logs. "\
+            "Can be set via the env variable LOCAL_OPENQA_HTTP_CACHE_PATH. "\
+            "Cached in memory only if not set. "
+    )
+
     parser.set_defaults(output="report")
     args = parser.parse_args()
 
     base_dir = os.path.abspath(os.path.dirname(__file__))
     mapping_path = os.path.join(base_dir, "github_package_mapping.json")
-    setup_openqa_environ(mapping_path, args.db_path, verbose=args.verbose)
+    setup_openqa_environ(mapping_path, args.db_path, verbose=args.verbose,
+                         fetch_concurrency=args.fetch_concurrency,
+                         http_cache_path=args.http_cache_path)
 
     try:
         (test_name_regex, test_title_regex) = args.test.split('/')
@@ -232,69 +396,64 @@ def main():
         test_title_regex = "*"
 
     history_len = args.last
-    history_len_with_margin = history_len*2 # account for invalid jobs
-
-    # populate database
-    db = get_db_session()
-    concluded_job_ids = OpenQA.get_latest_concluded_job_ids(
-        args.suite, history_len_with_margin,
-        args.version, args.flavor)
-    OpenQA.get_jobs(concluded_job_ids)
-
-    jobs_reversed_query = db.query(JobData)\
-            .filter(JobData.valid == True)\
-            .filter(JobData.job_name == args.suite)\
-            .filter(JobData.version == args.version)\
-            .filter(JobData.flavor == args.flavor)\
-            .where(JobData.job_id.in_(concluded_job_ids))\
-            .order_by(JobData.job_id.desc())\
-            .limit(history_len) # order_by in order to truncate the limit
-
-    failures_q = db.query(TestFailure)\
-                   .join(jobs_reversed_query.subquery())
-
-    # apply filters
-    if args.test:
-        failures_q = failures_q\
-            .filter(TestFailure.name.regexp_match(test_name_regex))\
-            .filter(TestFailure.title.regexp_match(test_title_regex))
-
-    if args.error:
-        failures_q = failures_q.filter(or_(
-                TestFailure.fail_error.regexp_match(args.error),
-                TestFailure.cleanup_error.regexp_match(args.error)))
 
-    jobs_reversed = jobs_reversed_query.all()
-    jobs = reversed(jobs_reversed)
+    if args.export_dir:
+        if not history_export.available:
+            parser.error("Error: --export-dir needs pyarrow")
+        if args.output == "report" or args.error:
+            parser.error("Error: full error texts are not exported, "
+                         "--export-dir works only with the other outputs "
+                         "and without --error")
+        jobs, failures = get_exported_history(
+            args.export_dir, args.suite, args.version, args.flavor,
+            history_len, test_name_regex if args.test else None,
+            test_title_regex if args.test else None)
+    else:
+        # the report shows the full error texts
+        jobs, failures = get_history(
+            args.suite, args.version, args.flavor, history_len,
+            test_name_regex if args.test else None,
+            test_title_regex if args.test else None, args.error,
+            with_texts=args.output == "report")
 
     # output format
     report = ""
 
-    if args.output not in ["report"]:
-        jobs = list(jobs)
+    if args.output not in ["report", "report_clusters"]:
         plot_filepath = args.outdir+"plot.png" if args.outdir else None
         if len(jobs) == 0:
             print("No jobs found")
             return
 
     if args.output == "report":
+        failures_by_job_id = {}
+        for failure in failures:
+            failures_by_job_id.setdefault(failure.job_id, []).append(failure)
         for job in jobs:
-            test_failures = failures_q\
-                .filter(TestFailure.job_id == job.job_id).all()
-            report += report_test_failure(job, test_failures)
+            report += report_test_failure(
+                job, failures_by_job_id.get(job.job_id, []))
+
+    elif args.output == "report_clusters":
+        report = report_error_clusters(jobs, failures)
 
     elif args.output == "plot_tests":
         title = "Failure By Test\n"
-        plot_by_test(title, jobs, failures_q, args.suite, plot_filepath)
+        plot_by_test(title, jobs, failures, args.suite, plot_filepath)
     elif args.output == "plot_templates":
         title = "Failure By Template\n"
-        plot_by_template(title, jobs, failures_q, args.suite, plot_filepath)
+        plot_by_template(title, jobs, failures, args.suite, plot_filepath)
     elif args.output == "plot_errors":
         title = "Failure By Error\n"
-        plot_by_error(title, jobs, failures_q, args.suite, plot_filepath)
+        plot_by_error(title, jobs, failures, args.suite, plot_filepath)
+    elif args.output == "plot_signatures":
+        title = "Failure By Error Signature\n"
+        plot_by_signature(title, jobs, failures, args.suite, plot_filepath)
+    elif args.output == "plot_clusters":
+        title = "Failure By Error Cluster\n"
+        plot_by_cluster(title, jobs, failures, args.suite, plot_filepath)
     elif args.output == "plot_worker":
         title = "Failure By Worker\n"
-        plot_by_worker(title, jobs, failures_q, args.suite, plot_filepath)
+        plot_by_worker(title, jobs, failures, args.suite, plot_filepath)
 
     else:
         print("Error: '{}' is not a valid output format".format(args.output))
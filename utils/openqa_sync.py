@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+# Keeps the local openQA cache (LOCAL_OPENQA_CACHE_PATH) warm: ingests
+# finished jobs, with their test failures and performance results, in job id
+# order, remembering how far it got. With it running, github_reporting.py and
+# openqa_investigator.py find the job history locally.
+
+from argparse import ArgumentParser
+import logging
+import os
+import sys
+import time
+
+import requests
+
+from lib.openqa_api import (
+    setup_openqa_environ,
+    get_db_session,
+    JobData,
+    OpenQA,
+    PendingJob,
+    SyncState,
+    job_listing_cache,
+    DEFAULT_FETCH_CONCURRENCY,
+    JOB_LISTING_CHUNK
+)
+
+SYNC_NAME = "jobs"
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_INTERVAL = 300
+# how many job ids back to start from on the first run
+DEFAULT_BACKLOG = 1000
+# unfinished jobs are looked at again on each run, for that many hours
+DEFAULT_PENDING_HOURS = 48
+
+# jobs in other states are looked at again on the next run
+FINAL_STATES = ('done', 'cancelled')
+
+
+def get_last_job_id():
+    state = get_db_session().get(SyncState, SYNC_NAME)
+    if state is None:
+        return None
+    return state.last_job_id
+
+def set_last_job_id(job_id):
+    db = get_db_session()
+    state = db.get(SyncState, SYNC_NAME)
+    if state is None:
+        state = SyncState(name=SYNC_NAME)
+        db.add(state)
+    state.last_job_id = job_id
+
+def get_newest_job_id():
+    jobs = OpenQA.list_jobs(['limit=1'])
+    if not jobs:
+        return 0
+    return jobs[0]['id']
+
+def select_jobs(listed_jobs, versions=None, flavors=None):
+    """Jobs of a listing to ingest"""
+    return [
+        job for job in listed_jobs
+        if job['state'] == 'done'
+        and (not versions or job['settings']['VERSION'] in versions)
+        and (not flavors or job['settings']['FLAVOR'] in flavors)]
+
+def add_pending_jobs(job_ids):
+    db = get_db_session()
+    now = time.time()
+    for job_id in job_ids:
+        if db.get(PendingJob, (SYNC_NAME, job_id)) is None:
+            db.add(PendingJob(name=SYNC_NAME, job_id=job_id, first_seen=now))
+
+def ingest_pending_jobs(max_age, versions=None, flavors=None):
+    """Ingests the jobs found unfinished by earlier runs that are finished now
+
+    Jobs still unfinished after max_age seconds are given up on.
+
+    :return int: number of ingested jobs
+    """
+    db = get_db_session()
+    pending_jobs = {pending.job_id: pending for pending in
+                    db.query(PendingJob).filter_by(name=SYNC_NAME)}
+    job_ids = sorted(pending_jobs)
+    listed_jobs = {}
+    for i in range(0, len(job_ids), JOB_LISTING_CHUNK):
+        chunk = job_ids[i:i + JOB_LISTING_CHUNK]
+        for job in OpenQA.list_jobs(['ids={}'.format(
+                ','.join(str(job_id) for job_id in chunk))]):
+            listed_jobs[job['id']] = job
+
+    now = time.time()
+    finished_jobs = []
+    for job_id, pending in pending_jobs.items():
+        job = listed_jobs.get(job_id)
+        if job is not None and job['state'] in FINAL_STATES:
+            finished_jobs.append(job)
+        elif job is None:
+            logging.info("Job {} is gone, no longer waiting for it".format(
+                job_id))
+        elif now - pending.first_seen > max_age:
+            logging.warning(
+                "Job {} is still {} after {:.0f} hours, giving up on "
+                "it".format(job_id, job['state'],
+                            (now - pending.first_seen) / 3600))
+        else:
+            continue
+        db.delete(pending)
+
+    finished_jobs = select_jobs(finished_jobs, versions, flavors)
+    if pending_jobs:
+        logging.info("Ingesting {} of {} jobs unfinished earlier".format(
+            len(finished_jobs), len(pending_jobs)))
+    ingest_jobs(finished_jobs)
+    return len(finished_jobs)
+
+def ingest_jobs(listed_jobs):
+    """Stores finished jobs with their failures and performance results"""
+    db = get_db_session()
+
+    # jobs created as children of an earlier job may have been stored
+    # before they finished
+    for listed_job in listed_jobs:
+        job = db.get(JobData, {"job_id": listed_job['id']})
+        if job is not None and job.result != listed_job['result']:
+            job.refresh(OpenQA.prefetch_jobs([job.job_id])[job.job_id])
+
+    for job in OpenQA.get_jobs([job['id'] for job in listed_jobs]):
+        if job.result == 'failed':
+            job.get_results()
+        if job.job_name.endswith('perf'):
+            job.get_performance_data()
+
+    db.commit()
+
+def sync(batch_size, start_id=None, versions=None, flavors=None,
+         pending_hours=DEFAULT_PENDING_HOURS):
+    """Ingests jobs finished since the last run
+
+    Jobs not finished yet are kept apart and ingested by a later run, once
+    they are, see ingest_pending_jobs().
+
+    :return int: number of ingested jobs
+    """
+    last_job_id = get_last_job_id()
+    newest_job_id = get_newest_job_id()
+    if last_job_id is None:
+        if start_id is not None:
+            last_job_id = start_id - 1
+        else:
+            last_job_id = max(newest_job_id - DEFAULT_BACKLOG, 0)
+
+    ingested = ingest_pending_jobs(pending_hours * 3600, versions, flavors)
+    job_listing_cache.clear()
+
+    window_start = last_job_id
+    while window_start < newest_job_id:
+        window_end = min(window_start + batch_size, newest_job_id)
+        listed_jobs = OpenQA.list_jobs([
+            'after={}'.format(window_start),
+            'before={}'.format(window_end + 1)])
+
+        unfinished_job_ids = [job['id'] for job in listed_jobs
+                              if job['state'] not in FINAL_STATES]
+        listed_jobs = select_jobs(listed_jobs, versions, flavors)
+
+        logging.info("Ingesting {} jobs between {} and {}".format(
+            len(listed_jobs), window_start + 1, window_end))
+        ingest_jobs(listed_jobs)
+        ingested += len(listed_jobs)
+
+        add_pending_jobs(unfinished_job_ids)
+        set_last_job_id(window_end)
+        get_db_session().commit()
+
+        job_listing_cache.clear()
+        window_start = window_end
+
+    return ingested
+
+def main():
+    parser = ArgumentParser(
+        description="Keep the local openQA cache up to date")
+
+    parser.add_argument(
+        '--db-path',
+        default=os.getenv("LOCAL_OPENQA_CACHE_PATH"),
+        help="Local openQA cache to fill. "\
+            "Can be set via the env variable LOCAL_OPENQA_CACHE_PATH."
+    )
+
+    parser.add_argument(
+        '--loop',
+        action='store_true',
+        help="Keep running, syncing every --interval seconds. "
+             "Without it, catch up once and exit."
+    )
+
+    parser.add_argument(
+        '--interval',
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help="Seconds between syncs with --loop. "
+             "Default: {}".format(DEFAULT_INTERVAL)
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Range of job ids ingested (and committed) at once. "
+             "Default: {}".format(DEFAULT_BATCH_SIZE)
+    )
+
+    parser.add_argument(
+        '--start-id',
+        type=int,
+        help="Job id to start from on the first sync. "
+             "Default: {} jobs before the newest one".format(DEFAULT_BACKLOG)
+    )
+
+    parser.add_argument(
+        '--pending-hours',
+        type=float,
+        default=DEFAULT_PENDING_HOURS,
+        help="Hours to wait for unfinished jobs to finish before giving up "
+             "on them. Default: {}".format(DEFAULT_PENDING_HOURS)
+    )
+
+    parser.add_argument(
+        '--version',
+        action='append',
+        help="Only ingest jobs of this Qubes version (can be repeated)."
+    )
+
+    parser.add_argument(
+        '--flavor',
+        action='append',
+        help="Only ingest jobs of this flavor (can be repeated)."
+    )
+
+    parser.add_argument(
+        '--fetch-concurrency',
+        type=int,
+        default=DEFAULT_FETCH_CONCURRENCY,
+        help="Number of openQA job details downloaded in parallel. "
+             "Default: {}".format(DEFAULT_FETCH_CONCURRENCY)
+    )
+
+    parser.add_argument(
+        '--http-cache-path',
+        default=os.getenv("LOCAL_OPENQA_HTTP_CACHE_PATH"),
+        help="Directory for caching downloaded openQA job details and logs. "\
+            "Can be set via the env variable LOCAL_OPENQA_HTTP_CACHE_PATH."
+    )
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="Enable debug logging."
+    )
+
+    args = parser.parse_args()
+
+    if not args.db_path:
+        parser.error("Error: --db-path or LOCAL_OPENQA_CACHE_PATH required.")
+        return
+
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    mapping_path = os.path.join(base_dir, "github_package_mapping.json")
+    setup_openqa_environ(mapping_path, args.db_path, verbose=args.verbose,
+                         fetch_concurrency=args.fetch_concurrency,
+                         http_cache_path=args.http_cache_path)
+    if not args.verbose:
+        logging.basicConfig(format='%(asctime)s %(name)s: %(message)s',
+                            level=logging.INFO)
+
+    while True:
+        try:
+            ingested = sync(args.batch_size, args.start_id,
+                            args.version, args.flavor, args.pending_hours)
+            print("Ingested {} jobs, synced up to job {}".format(
+                ingested, get_last_job_id()), file=sys.stderr)
+        except requests.exceptions.RequestException as e:
+            get_db_session().rollback()
+            if not args.loop:
+                raise
+            print("Sync failed: {}".format(e), file=sys.stderr)
+        except Exception:
+            # unexpected job data or database errors, the next sync starts
+            # again from the last commit
+            get_db_session().rollback()
+            if not args.loop:
+                raise
+            logging.exception("Sync failed")
+
+        if not args.loop:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
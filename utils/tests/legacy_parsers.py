@@ -0,0 +1,77 @@
+# Parsers replaced by the ones of lib/, kept as they were to check that the
+# new ones give the same results.
+
+import logging
+import re
+
+from lib.junit_parser import ParsedDescription
+
+
+def legacy_parse_description(description, max_chars=70):
+    """TestFailure.parse_description before lib/junit_parser.py, as the
+    reference of its behavior"""
+    result = ParsedDescription()
+
+    def get_relevant_error(max_chars=70):
+        # find relevant line(s)
+        try:
+            i = len(lines) - 1
+            while re.match(r"^\s", lines[i]): # non whitespace-starting
+                i -= 1
+            while not re.match(r"^\s", lines[i]): # until it finds whitespace
+                i -= 1
+
+            relev_line_prev = lines[i].strip()
+            relev_line = lines[i+1].strip()
+
+            # show relevant line (truncated if needed) and the previous one if
+            # there is enough space.
+            if len(relev_line) < max_chars - 30:
+                max_len_prev_line = max_chars -4 -len(relev_line)
+                return "{}... {}".format(
+                    relev_line_prev[:max_len_prev_line],
+                    relev_line)
+            if len(relev_line) <= max_chars:
+                return relev_line
+            else:
+                return relev_line[:max_chars-len("...")] + "..."
+        except IndexError:
+            logging.warning("Failed to extract error from: " + "\n".join(lines))
+            # just get the last line non-empty
+            line = [l for l in lines if l][-1]
+            if len(line) <= max_chars:
+                return line
+            return line[:max_chars-len("...")] + "..."
+
+    description = description.strip()
+
+    if "timed out" in description:
+        result.timed_out = True
+
+    # non-standard error messages / test descriptions
+    if "# system-out:" not in description:
+        if "# wait_serial expected:" in description:
+            result.reason = "wait serial expected"
+        if "# Test died: " in description:
+            result.reason = "test died"
+
+        first_line = description.split("\n")[0]
+        result.relevant_error = first_line.strip()[:max_chars-3] + "..."
+        result.fail_error = description
+        return result
+
+    (result.fail_error, result.cleanup_error)=description.split("# system-out:")
+    lines = result.fail_error.split("\n")
+
+    if "# error:" in lines[1]:
+        result.reason = "error"
+    elif "# failure:" in lines[1]:
+        result.reason = "failure"
+    elif "# skipped:" in lines[1]:
+        result.reason = "skipped"
+        return result
+    else:
+        result.reason = "unknown"
+        return result
+    result.relevant_error = get_relevant_error(max_chars=max_chars)
+    return result
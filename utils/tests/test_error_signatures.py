@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# Unit tests of lib/error_signatures.py. Run from utils/:
+# python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib.error_signatures import ErrorClusters, normalize
+
+
+class NormalizeTest(unittest.TestCase):
+    def assertSignature(self, error, signature):
+        self.assertEqual(normalize(error), signature)
+
+    def test_none(self):
+        self.assertIsNone(normalize(None))
+
+    def test_unchanged(self):
+        self.assertSignature(
+            "AssertionError: False is not true : qrexec-client failed",
+            "AssertionError: False is not true : qrexec-client failed")
+
+    def test_vms(self):
+        self.assertSignature(
+            "AssertionError: vm disp1264 failed at 0x162ccc2d",
+            "AssertionError: vm disp<n> failed at <hex>")
+        self.assertSignature(
+            "qubesadmin.exc.QubesVMError: test-inst-vm2-abc: start failed",
+            "qubesadmin.exc.QubesVMError: test-inst-vm<n>: start failed")
+
+    def test_times(self):
+        self.assertSignature(
+            "timed out at 2026-05-03T12:34:56.789+02:00",
+            "timed out at <time>")
+        self.assertSignature("started 12:34:56, stopped 1:02:03",
+                             "started <time>, stopped <time>")
+
+    def test_ids(self):
+        self.assertSignature(
+            "volume 123e4567-e89b-12d3-a456-426614174000 busy",
+            "volume <uuid> busy")
+        self.assertSignature("object 3f2a9c1b7e not found",
+                             "object <hex> not found")
+        # only digits or only letters are not hashes
+        self.assertSignature("error 12345678 in deadbeefcafe",
+                             "error 12345678 in deadbeefcafe")
+
+    def test_network(self):
+        self.assertSignature("cannot connect to 10.137.0.5:8080",
+                             "cannot connect to <ip>:<port>")
+        self.assertSignature("listening on port 12345",
+                             "listening on port <port>")
+
+    def test_pids(self):
+        self.assertSignature("qrexec-daemon[4242]: pid=4243 exited",
+                             "qrexec-daemon[<pid>]: pid=<pid> exited")
+
+    def test_same_signature(self):
+        self.assertEqual(
+            normalize("vm disp12 at 0xdead crashed (pid 77)"),
+            normalize("vm disp9034 at 0xbeef crashed (pid 1024)"))
+
+
+class ErrorClustersTest(unittest.TestCase):
+    def test_similar(self):
+        first = "AssertionError: qvm-run failed with code 1 in the test VM"
+        second = "AssertionError: qvm-run failed with code 2 in the test VM"
+        other = "TimeoutError: Timeout waiting for the window of gedit"
+        clusters = ErrorClusters([first, first, second, other, None])
+        # named after the most frequent signature
+        self.assertEqual(clusters.get(second), first)
+        self.assertEqual(clusters.get(other), other)
+        self.assertEqual(clusters.get_clusters(),
+                         {first: [first, second], other: [other]})
+
+
+if __name__ == '__main__':
+    unittest.main()
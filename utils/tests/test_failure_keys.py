@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+# Unit tests of the lookups of failed tests in lib/openqa_api.py: failure
+# keys and the flakiness statistics kept per test (TestStats). Run from
+# utils/: python3 -m unittest discover tests
+
+import itertools
+import os
+import sys
+import types
+import unittest
+from unittest import mock
+
+import sqlalchemy.orm
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib import openqa_api
+from lib.openqa_api import (
+    PastFailure, SuiteHistory, TestFailure, TestStats, get_failure_key,
+    get_failure_keys, has_failure)
+
+MAPPING_PATH = os.path.join(UTILS_DIR, "github_package_mapping.json")
+
+
+def make_failure(name, title, test_id):
+    """TestFailure with only the fields compared by __eq__"""
+    sqlalchemy.orm.configure_mappers()
+    failure = TestFailure.__mapper__.class_manager.new_instance()
+    failure.name = name
+    failure.title = title
+    failure.test_id = test_id
+    return failure
+
+
+class FailureKeyTest(unittest.TestCase):
+    FIELDS = [
+        ("TC_00_Basic", "test_000_qubes_create", 1),
+        ("TC_00_Basic", "test_001_qubes_start", 2),
+        ("TC_00_Basic", "", 3),
+        ("TC_00_Basic", None, 4),
+        ("TC_20_DispVM", "test_000_qubes_create", 1),
+        ("TC_20_DispVM", "", 1),
+    ]
+
+    def test_key(self):
+        self.assertEqual(get_failure_key(make_failure("a", "t", 1)),
+                         ("a", "t"))
+        self.assertEqual(get_failure_key(make_failure("a", "", 1)), ("a", 1))
+        self.assertEqual(get_failure_key(PastFailure("a", None, 2, 7, None)),
+                         ("a", 2))
+
+    def test_same_as_eq(self):
+        # any subset of failures, looked up with any failure, titled or not,
+        # with the same or another test id
+        candidates = [
+            make_failure(name, title, test_id)
+            for name, title, test_id in itertools.product(
+                ["TC_00_Basic", "TC_20_DispVM"],
+                ["test_000_qubes_create", "test_001_qubes_start", "", None],
+                [1, 2, 3, 4])]
+        candidates += [PastFailure(failure.name, failure.title,
+                                   failure.test_id, 1, None)
+                       for failure in candidates]
+        for size in range(len(self.FIELDS) + 1):
+            for fields in itertools.combinations(self.FIELDS, size):
+                failures = [make_failure(*field) for field in fields]
+                keys = get_failure_keys(failures)
+                for candidate in candidates:
+                    self.assertEqual(
+                        has_failure(keys, candidate), candidate in failures,
+                        (fields, candidate))
+
+
+class TestStatsWindowTest(unittest.TestCase):
+    KEY = {'job_name': "system_tests_basic", 'machine': "64bit",
+           'version': "4.3", 'flavor': "pull-requests"}
+
+    def setUp(self):
+        openqa_api.setup_openqa_environ(MAPPING_PATH)
+        self.session = openqa_api.local_session
+        patcher = mock.patch.object(openqa_api, 'STATS_WINDOW', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.session.close()
+
+    def record(self, job_id, failing_tests):
+        for name in failing_tests:
+            self.session.execute(TestFailure.__table__.insert().values(
+                name=name, title="test_000", job_id=job_id, test_id=1,
+                relevant_error="error in job {}".format(job_id)))
+        job = types.SimpleNamespace(
+            job_id=job_id,
+            get_job_start_time=lambda: "2026-01-{:02d}".format(job_id),
+            **self.KEY)
+        TestStats.record_job(job)
+        self.session.flush()
+
+    def get_window(self):
+        return self.session.get(SuiteHistory, self.KEY).job_ids
+
+    def get_failed_jobs(self, name):
+        stats = self.session.get(
+            TestStats, dict(self.KEY, name=name, title="test_000", test_id=1))
+        if stats is None:
+            return []
+        return [failure.job_id
+                for failure in stats.get_failures(self.get_window())]
+
+    def test_window_slides(self):
+        for job_id in range(1, 6):
+            self.record(job_id, ["TC_00_Basic"] if job_id != 3 else [])
+        self.assertEqual(self.get_window(), [3, 4, 5])
+        self.assertEqual(self.get_failed_jobs("TC_00_Basic"), [4, 5])
+        stats = self.session.get(TestStats, dict(
+            self.KEY, name="TC_00_Basic", title="test_000", test_id=1))
+        # older failures are dropped with the next failure
+        self.assertEqual([job_id for job_id, _ in stats.failures], [4, 5])
+        self.assertEqual(stats.last_seen, "2026-01-05")
+
+    def test_older_jobs(self):
+        for job_id in (2, 4, 5):
+            self.record(job_id, ["TC_00_Basic"])
+        # within the window, out of order
+        self.record(3, ["TC_20_DispVM"])
+        self.assertEqual(self.get_window(), [3, 4, 5])
+        self.assertEqual(self.get_failed_jobs("TC_00_Basic"), [4, 5])
+        self.assertEqual(self.get_failed_jobs("TC_20_DispVM"), [3])
+        # older than the whole window
+        self.record(1, ["TC_20_DispVM"])
+        self.assertEqual(self.get_window(), [3, 4, 5])
+        self.assertEqual(self.get_failed_jobs("TC_20_DispVM"), [3])
+
+    def test_recorded_once(self):
+        self.record(1, ["TC_00_Basic"])
+        TestStats.record_job(types.SimpleNamespace(job_id=1, **self.KEY))
+        self.assertEqual(self.get_window(), [1])
+        self.assertEqual(self.get_failed_jobs("TC_00_Basic"), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# Unit tests of lib/flakiness_model.py, skipped without numpy and scipy.
+# Run from utils/: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib import flakiness_model
+from lib.flakiness_model import FailureMatrix, estimate
+
+
+@unittest.skipUnless(flakiness_model.available, "numpy or scipy missing")
+class EstimateTest(unittest.TestCase):
+    def setUp(self):
+        self.job_ids = list(range(1, 21))
+
+    def get_estimates(self, failures, **kwargs):
+        result = estimate(FailureMatrix(self.job_ids, failures), **kwargs)
+        return {test: (failures, low, high, unstable)
+                for test, failures, low, high, unstable in zip(
+                    result.tests, result.failures, result.low, result.high,
+                    result.unstable)}
+
+    def test_rates(self):
+        failures = [(job_id, "flaky", "error") for job_id in range(1, 11)]
+        failures += [(1, "rare", "error")]
+        estimates = self.get_estimates(failures)
+
+        count, low, high, unstable = estimates["flaky"]
+        self.assertEqual(count, 10)
+        self.assertLess(low, 0.5)
+        self.assertGreater(high, 0.5)
+        self.assertTrue(unstable)
+        # one failure in 20 jobs is no evidence of a 5% failure rate
+        count, low, high, unstable = estimates["rare"]
+        self.assertEqual(count, 1)
+        self.assertLess(low, flakiness_model.MIN_FLAKE_RATE)
+        self.assertFalse(unstable)
+
+    def test_always_failing(self):
+        failures = [(job_id, "broken", "same error")
+                    for job_id in self.job_ids]
+        failures += [(job_id, "varying", "error {}".format(job_id % 2))
+                     for job_id in self.job_ids]
+        estimates = self.get_estimates(failures)
+        self.assertFalse(estimates["broken"][3])
+        # failing every time, but not in the same way
+        self.assertTrue(estimates["varying"][3])
+
+    def test_other_jobs_ignored(self):
+        # and a test fails at most once per job
+        failures = [(1, "test", "error"), (1, "test", "other error"),
+                    (100, "test", "error")]
+        self.assertEqual(self.get_estimates(failures)["test"][0], 1)
+
+    def test_intervals(self):
+        failures = [(job_id, "test", "error") for job_id in range(1, 6)]
+        for interval in flakiness_model.INTERVALS:
+            with self.subTest(interval=interval):
+                _, low, high, _ = self.get_estimates(
+                    failures, interval=interval)["test"]
+                self.assertLess(low, 5 / 20)
+                self.assertGreater(high, 5 / 20)
+                # narrower with less confidence
+                _, narrow_low, narrow_high, _ = self.get_estimates(
+                    failures, interval=interval, confidence=0.5)["test"]
+                self.assertGreater(narrow_low, low)
+                self.assertLess(narrow_high, high)
+
+    def test_no_jobs(self):
+        self.job_ids = []
+        result = estimate(FailureMatrix([], [(1, "test", "error")]))
+        self.assertEqual(result.runs, 0)
+        self.assertEqual(len(result.unstable), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
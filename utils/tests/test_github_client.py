@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+# Unit tests of the retries and throttling of lib/github_client.py, with
+# lib/http_client.py requests and sleeps replaced. Run from utils/:
+# python3 -m unittest discover tests
+
+import json
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib import github_client
+from lib.github_client import GitHubClient
+
+
+class Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(body if body is not None else {})
+        self.headers = headers or {}
+        self.ok = status_code < 400
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class GitHubClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = GitHubClient()
+        self.responses = []
+        self.requests = []
+        self.sleeps = []
+
+        def request(method, url, **kwargs):
+            self.requests.append((method, url))
+            return self.responses.pop(0)
+
+        for patcher in (
+                mock.patch.object(github_client.http_client, 'request',
+                                  request),
+                mock.patch.object(github_client.time, 'sleep',
+                                  self.sleeps.append)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def rate_headers(self, remaining, limit=5000, reset_in=3600):
+        return {'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Limit': str(limit),
+                'X-RateLimit-Reset': str(time.time() + reset_in)}
+
+    def test_retry_after(self):
+        limited = Response(403, {'message': "You have exceeded a secondary "
+                                            "rate limit"},
+                           {'Retry-After': '7'})
+        self.responses = [limited, Response(201)]
+        response = self.client.post("https://api.github.com/x", json={})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.requests), 2)
+        self.assertTrue(limited.closed)
+        # the Retry-After wait, the mutation interval is within it
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertAlmostEqual(self.sleeps[0], 7, delta=0.5)
+        self.assertEqual(self.client.stats['rate_limited'], 1)
+
+    def test_secondary_limit_backoff(self):
+        self.responses = [Response(429), Response(429), Response(200)]
+        self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(len(self.requests), 3)
+        waits = [round(delay) for delay in self.sleeps]
+        self.assertEqual(waits, [github_client.SECONDARY_LIMIT_WAIT,
+                                 2 * github_client.SECONDARY_LIMIT_WAIT])
+
+    def test_gives_up(self):
+        self.responses = [Response(429)
+                          for _ in range(github_client.RATE_LIMIT_RETRIES + 1)]
+        with self.assertLogs(level='WARNING'):
+            response = self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(self.requests),
+                         github_client.RATE_LIMIT_RETRIES + 1)
+
+    def test_wait_too_long(self):
+        self.responses = [Response(403, headers={
+            'Retry-After': str(github_client.DEFAULT_MAX_WAIT + 1)})]
+        with self.assertLogs(level='WARNING'):
+            response = self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.sleeps, [])
+
+    def test_not_rate_limited(self):
+        # permissions
+        self.responses = [Response(403, {'message': "Resource not "
+                                                    "accessible"})]
+        response = self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.client.stats['rate_limited'], 0)
+
+    def test_budget(self):
+        self.responses = [Response(200, headers=self.rate_headers(4000)),
+                          Response(200)]
+        self.client.request('GET', "https://api.github.com/x")
+        self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(self.sleeps, [])
+
+        # spaced out over the time left once low
+        self.responses = [Response(200, headers=self.rate_headers(
+            250, reset_in=100)), Response(200)]
+        self.client.request('GET', "https://api.github.com/x")
+        self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertAlmostEqual(self.sleeps[0], 100 / 200, delta=0.05)
+
+        # the reset waited for at the reserve
+        self.responses = [Response(200, headers=self.rate_headers(
+            github_client.DEFAULT_RESERVE, reset_in=100)), Response(200)]
+        self.client.request('GET', "https://api.github.com/x")
+        self.client.request('GET', "https://api.github.com/x")
+        self.assertAlmostEqual(self.sleeps[-1], 100, delta=1)
+
+    def test_graphql_budget(self):
+        self.responses = [Response(200, headers=self.rate_headers(
+            github_client.DEFAULT_RESERVE, reset_in=100)), Response(200)]
+        self.client.graphql("query { viewer { login } }")
+        # REST requests have their own budget
+        self.client.request('GET', "https://api.github.com/x")
+        self.assertEqual(self.sleeps, [])
+        self.assertEqual(self.requests[0],
+                         ('POST', github_client.GRAPHQL_URL))
+
+    def test_mutation_interval(self):
+        self.responses = [Response(200), Response(200), Response(200)]
+        self.client.post("https://api.github.com/x")
+        self.client.request('GET', "https://api.github.com/x")
+        self.client.patch("https://api.github.com/x")
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertLessEqual(self.sleeps[0], github_client.MUTATION_INTERVAL)
+        self.assertGreater(self.sleeps[0],
+                           github_client.MUTATION_INTERVAL - 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+# Checks lib/junit_parser.py against the heuristics it replaced, on the
+# descriptions in data/descriptions (text_data of failed JUnit test cases,
+# one per file). Run from utils/: python3 -m unittest discover tests
+
+import glob
+import logging
+import os
+import sys
+import unittest
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib.junit_parser import DescriptionParser, TracebackFrame
+from legacy_parsers import legacy_parse_description
+
+CORPUS_DIR = os.path.join(UTILS_DIR, "tests", "data", "descriptions")
+
+
+def read_corpus():
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.txt"))):
+        with open(path) as f:
+            corpus[os.path.basename(path)] = f.read()
+    return corpus
+
+
+class DescriptionParserTest(unittest.TestCase):
+    def setUp(self):
+        self.corpus = read_corpus()
+        self.parser = DescriptionParser()
+        # warnings of the heuristics about descriptions they cannot handle
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_corpus(self):
+        self.assertGreaterEqual(len(self.corpus), 10)
+
+    def test_same_as_legacy(self):
+        for name, description in self.corpus.items():
+            with self.subTest(description=name):
+                expected = legacy_parse_description(description)
+                result = self.parser.parse(description)
+                # traceback frames are new
+                result.frames = ()
+                self.assertEqual(result, expected)
+
+    def test_frames(self):
+        result = self.parser.parse(self.corpus["01-error-timeout.txt"])
+        self.assertEqual(result.frames[0], TracebackFrame(
+            "/usr/lib/python3.11/site-packages/qubes/tests/integ/dispvm.py",
+            94, "test_003_cleanup_destroyed"))
+        self.assertEqual(len(result.frames), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
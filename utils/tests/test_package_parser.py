@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+# Unit tests of lib/package_parser.py: parsing of package lists and version
+# ordering. Run from utils/: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+UTILS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTILS_DIR)
+
+from lib.package_parser import (
+    DEB, RPM, PackageRecord, compare_version_strings, dpkg_vercmp,
+    get_title_version, parse_packages, rpmvercmp, split_version)
+
+
+class RpmVercmpTest(unittest.TestCase):
+    def assertOrdered(self, older, newer):
+        self.assertEqual(rpmvercmp(older, newer), -1)
+        self.assertEqual(rpmvercmp(newer, older), 1)
+
+    def test_equal(self):
+        self.assertEqual(rpmvercmp("1.0", "1.0"), 0)
+        # separators are not compared
+        self.assertEqual(rpmvercmp("1.0", "1_0"), 0)
+        self.assertEqual(rpmvercmp("1.01", "1.1"), 0)
+
+    def test_numeric(self):
+        self.assertOrdered("1.9", "1.10")
+        self.assertOrdered("1.0", "1.0.1")
+        self.assertOrdered("2.9999", "10.0")
+
+    def test_alpha(self):
+        self.assertOrdered("1.0a", "1.0b")
+        # numeric segments are newer than alphabetic ones
+        self.assertOrdered("1.a", "1.1")
+
+    def test_tilde(self):
+        self.assertOrdered("1.0~rc1", "1.0")
+        self.assertOrdered("1.0~rc1", "1.0~rc2")
+        self.assertOrdered("1.0~~", "1.0~")
+
+    def test_caret(self):
+        self.assertOrdered("1.0", "1.0^20240101")
+        self.assertOrdered("1.0^20240101", "1.0.1")
+        self.assertOrdered("1.0~rc1", "1.0^git1")
+
+
+class DpkgVercmpTest(unittest.TestCase):
+    def assertOrdered(self, older, newer):
+        self.assertEqual(dpkg_vercmp(older, newer), -1)
+        self.assertEqual(dpkg_vercmp(newer, older), 1)
+
+    def test_equal(self):
+        self.assertEqual(dpkg_vercmp("1.0", "1.0"), 0)
+        self.assertEqual(dpkg_vercmp("1.01", "1.1"), 0)
+
+    def test_numeric(self):
+        self.assertOrdered("1.9", "1.10")
+        self.assertOrdered("1.0", "1.0.1")
+
+    def test_tilde(self):
+        self.assertOrdered("1.0~rc1", "1.0")
+        self.assertOrdered("1.0~~", "1.0~")
+
+    def test_letters_before_other_characters(self):
+        self.assertOrdered("1.0a", "1.0+")
+        self.assertOrdered("1.0", "1.0a")
+
+
+class CompareVersionStringsTest(unittest.TestCase):
+    def test_epoch(self):
+        for package_format in (DEB, RPM):
+            with self.subTest(package_format=package_format):
+                self.assertEqual(compare_version_strings(
+                    "1:1.0-1", "2.0-1", package_format), 1)
+                self.assertEqual(compare_version_strings(
+                    "0:1.0-1", "1.0-1", package_format), 0)
+
+    def test_release(self):
+        self.assertEqual(compare_version_strings(
+            "4.3.10-1+deb12u1", "4.3.10-1", DEB), 1)
+        self.assertEqual(compare_version_strings(
+            "4.3.20-1.fc41", "4.3.20-2.fc41", RPM), -1)
+
+    def test_split_version(self):
+        self.assertEqual(
+            split_version("1:2.1.12-stable-8", DEB),
+            PackageRecord(None, "1", "2.1.12-stable", "8", None, DEB))
+        self.assertEqual(
+            split_version("4.3.20-1.fc41", RPM),
+            PackageRecord(None, None, "4.3.20", "1.fc41", None, RPM))
+
+
+class ParsePackagesTest(unittest.TestCase):
+    LOG = (
+        "ii  qubes-core-agent  4.3.10-1+deb12u1  amd64  Qubes core agent\n"
+        "ii  libevent-dev  2.1.12-stable-8  amd64  event notification\n"
+        "ii  tzdata  2024a  all  time zone data\n"
+        "rc  removed-package  1.0-1  amd64  removed\n"
+        "qubes-core-dom0-4.3.20-1.fc41.noarch\n"
+        "perl-Time-Local-2:1.350-5.fc41.noarch\n"
+        "gpg-pubkey-d1b2c3a4-5f6e7d8c\n"
+        "\n")
+
+    def test_records(self):
+        self.assertEqual(parse_packages(self.LOG), (
+            PackageRecord("qubes-core-agent", None, "4.3.10", "1+deb12u1",
+                          "amd64", DEB),
+            PackageRecord("libevent-dev", None, "2.1.12-stable", "8",
+                          "amd64", DEB),
+            PackageRecord("tzdata", None, "2024a", None, "all", DEB),
+            PackageRecord("qubes-core-dom0", None, "4.3.20", "1.fc41",
+                          "noarch", RPM),
+            PackageRecord("perl-Time-Local", "2", "1.350", "5.fc41",
+                          "noarch", RPM),
+            PackageRecord("gpg-pubkey", None, "d1b2c3a4", "5f6e7d8c",
+                          None, RPM),
+        ))
+
+    def test_title_version(self):
+        titles = [get_title_version(*record.get_manifest_version(),
+                                    record.format)
+                  for record in parse_packages(self.LOG)]
+        self.assertEqual(titles, [
+            ("4.3.10", "1"),
+            ("2.1.12-stable", "8"),
+            ("2024a", None),
+            ("4.3.20", "1"),
+            ("2:1.350", "5"),
+            ("d1b2c3a4", "5f6e7d8c"),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()